@@ -0,0 +1,416 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Control flow graph and static cycle estimates
+#
+# The code reachable from the entry points (found the same way as
+# "-d --flow") is split into basic blocks. Each block gets a best and
+# worst cycle cost: indexed reads that may cross a page cost one more in
+# the worst case, and a branch costs 2 not taken and 3 taken, or 4 if the
+# target is in another page.
+#
+# Subroutines are the entry points and every JSR target. For those without
+# loops the best and worst case from entry to RTS are worked out, counting
+# the subroutines they call. For every loop the cost of one iteration, from
+# the loop head round to the branch back, is worked out the same way, with
+# any inner loop counted as a single pass. Anything that can't be bounded
+# (a loop inside the subroutine, recursion, a call outside the code) is
+# reported as unbounded, null in the JSON.
+#
+# Timings are for a 6502 with the standard cycle counts. .SYS is counted
+# as 2 cycles.
+
+import json
+import utilities
+import disassembler
+
+# Cycles by addressing mode for instructions that read memory, and the
+# modes where crossing a page costs an extra cycle
+READ = { 'Imm': 2, 'ZPage': 3, 'ZPageX': 4, 'ZPageY': 4, 'Abs': 4, 'AbsX': 4, 'AbsY': 4, 'IndX': 6, 'IndY': 5 }
+STORE = { 'ZPage': 3, 'ZPageX': 4, 'ZPageY': 4, 'Abs': 4, 'AbsX': 5, 'AbsY': 5, 'IndX': 6, 'IndY': 6 }
+MODIFY = { 'Imp': 2, 'ZPage': 5, 'ZPageX': 6, 'Abs': 6, 'AbsX': 7 }
+PAGED = ('AbsX', 'AbsY', 'IndY')
+
+STORES = ('STA', 'STX', 'STY')
+MODIFIES = ('ASL', 'LSR', 'ROL', 'ROR', 'INC', 'DEC')
+
+IMPLIED = { 'BRK': 7, 'RTS': 6, 'RTI': 6, 'PHA': 3, 'PHP': 3, 'PHX': 3, 'PHY': 3,
+            'PLA': 4, 'PLP': 4, 'PLX': 4, 'PLY': 4, 'JMP': 3, 'JSR': 6 }
+
+# Instructions that end a path through a subroutine
+RETURNS = ('RTS', 'RTI', 'BRK')
+
+# Base cycles and whether a page crossing can add one, for each opcode
+def cycleTable():
+    table = []
+    dis = disassembler.Disassembler
+    for opcode in range(256):
+        mnemonic = dis.mnemonics[opcode]
+        mode = dis.modes[opcode]
+        if mnemonic in IMPLIED:
+            table.append((IMPLIED[mnemonic], False))
+        elif mnemonic in MODIFIES:
+            table.append((MODIFY.get(mode, 2), False))
+        elif mnemonic in STORES:
+            table.append((STORE.get(mode, 4), False))
+        elif mode in READ:
+            table.append((READ[mode], mode in PAGED))
+        else:
+            table.append((2, False))
+    return table
+
+CYCLES = cycleTable()
+
+class Block:
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.instructions = []
+        self.best = 0
+        self.worst = 0
+        self.edges = []         # (successor, best, worst) cost of the last instruction
+        self.calls = []
+        self.exits = False
+
+class Analysis:
+
+    _mem = None
+    _loaded = None
+    _starts = None
+    _blocks = None
+    _functions = None
+    _loops = None
+    _backedges = None
+    _bounds = None
+
+    def __init__(self, code, entries=None):
+        dis = disassembler.Disassembler()
+        segments = utilities.segments(code)
+        if entries == None:
+            entries = [dis.entry(segments)]
+        self._starts, labels = dis.analyze(segments, entries)
+        self._mem, self._loaded = dis.memory(segments)
+        self._functions = set(a for a in entries if a in self._starts)
+        for vector in dis.VECTORS:
+            if self._loaded[vector] and self._loaded[vector + 1]:
+                address = self._mem[vector] + (self._mem[vector + 1] << 8)
+                if address in self._starts:
+                    self._functions.add(address)
+        self._bounds = {}
+        self.build()
+        self._loops = self.findLoops()
+
+    ################################
+    # Graph
+
+    def instruction(self, pc):
+        mem = self._mem
+        opcode = mem[pc]
+        mode = disassembler.Disassembler.modes[opcode]
+        size = disassembler.Disassembler.lengths[opcode]
+        operand = None
+        if size == 2:
+            operand = mem[pc + 1]
+        elif size == 3:
+            operand = mem[pc + 1] + (mem[pc + 2] << 8)
+        return opcode, disassembler.Disassembler.mnemonics[opcode], mode, size, operand
+
+    # Cycles for the instruction at pc, other than a branch
+    def cost(self, pc):
+        opcode, mnemonic, mode, size, operand = self.instruction(pc)
+        cycles, paged = CYCLES[opcode]
+        # An index can only carry into the next page if the base isn't at
+        # the start of one
+        if paged and (mode == 'IndY' or operand & 0xFF != 0):
+            return cycles, cycles + 1
+        return cycles, cycles
+
+    def branchTarget(self, pc):
+        offset = self._mem[pc + 1]
+        return (pc + 1 + (offset if offset < 0x80 else offset - 0x100)) & 0xFFFF
+
+    def build(self):
+        starts = self._starts
+        leaders = set(self._functions)
+        for pc in starts:
+            opcode, mnemonic, mode, size, operand = self.instruction(pc)
+            if mode == 'Branch':
+                leaders.add(self.branchTarget(pc))
+                leaders.add(pc + size)
+            elif mnemonic == 'JSR':
+                leaders.add(operand)
+                self._functions.add(operand)
+            elif mnemonic == 'JMP':
+                leaders.add(operand)
+        leaders = set(pc for pc in leaders if pc in starts)
+
+        self._blocks = {}
+        for leader in sorted(leaders):
+            block = Block(leader)
+            pc = leader
+            while True:
+                opcode, mnemonic, mode, size, operand = self.instruction(pc)
+                block.instructions.append(pc)
+                block.end = pc + size - 1
+                following = pc + size
+                if mode == 'Branch':
+                    target = self.branchTarget(pc)
+                    taken = 3 if (target & 0xFF00) == (following & 0xFF00) else 4
+                    block.edges.append((following, 2, 2))
+                    block.edges.append((target, taken, taken))
+                    break
+                best, worst = self.cost(pc)
+                if mnemonic == 'JSR':
+                    block.calls.append(operand)
+                if mnemonic == 'JMP':
+                    block.edges.append((operand, best, worst))
+                    break
+                if mnemonic in RETURNS:
+                    block.best += best
+                    block.worst += worst
+                    block.exits = True
+                    break
+                block.best += best
+                block.worst += worst
+                if following not in starts:
+                    block.exits = True      # Runs into data or off the end
+                    break
+                if following in leaders:
+                    block.edges.append((following, 0, 0))
+                    break
+                pc = following
+            # A jump out of the code that was found ends the path there
+            for edge in list(block.edges):
+                if edge[0] not in leaders:
+                    block.edges.remove(edge)
+                    block.best += edge[1]
+                    block.worst += edge[2]
+                    block.exits = True
+            self._blocks[leader] = block
+
+    # Blocks reachable from start without following a call
+    def reachable(self, start):
+        seen = set()
+        work = [start]
+        while work:
+            address = work.pop()
+            if address in seen or address not in self._blocks:
+                continue
+            seen.add(address)
+            work.extend(edge[0] for edge in self._blocks[address].edges)
+        return seen
+
+    # Natural loops: for each edge back to a block that dominates its
+    # source in a depth first walk, the blocks that reach the source
+    # without passing through the head
+    def findLoops(self):
+        backedges = set()
+        for function in sorted(self._functions):
+            if function not in self._blocks:
+                continue
+            state = {}
+            stack = [(function, iter(self._blocks[function].edges))]
+            state[function] = 1
+            while stack:
+                address, edges = stack[-1]
+                edge = next(edges, None)
+                if edge == None:
+                    state[address] = 2
+                    stack.pop()
+                    continue
+                successor = edge[0]
+                if state.get(successor) == 1:
+                    backedges.add((address, successor))
+                elif successor not in state:
+                    state[successor] = 1
+                    stack.append((successor, iter(self._blocks[successor].edges)))
+
+        predecessors = {}
+        for block in self._blocks.values():
+            for edge in block.edges:
+                predecessors.setdefault(edge[0], []).append(block.start)
+        loops = []
+        for tail, head in sorted(backedges, key=lambda e: (e[1], e[0])):
+            body = set([head])
+            work = [tail]
+            while work:
+                address = work.pop()
+                if address not in body:
+                    body.add(address)
+                    work.extend(predecessors.get(address, []))
+            loops.append((head, tail, body))
+        self._backedges = backedges
+        return loops
+
+    ################################
+    # Bounds
+
+    # Best and worst cycles of a block, including the subroutines it calls.
+    # None if a call can't be bounded.
+    def blockCost(self, block, stack):
+        best = block.best
+        worst = block.worst
+        for callee in block.calls:
+            bound = self.subroutine(callee, stack)
+            if bound[0] == None:
+                return None, None
+            best += bound[0]
+            worst = worst + bound[1] if worst != None and bound[1] != None else None
+        return best, worst
+
+    # Shortest and longest path costs from start to any exit, or to the
+    # edge stop back to the loop head, over the blocks in nodes with the
+    # loop back edges removed
+    def paths(self, start, nodes, stop, stack):
+        results = {}
+        for address in self.postorder(start, nodes):
+            block = self._blocks[address]
+            cost = self.blockCost(block, stack)
+            if cost[0] == None:
+                return None, None
+            options = []
+            if block.exits and stop == None:
+                options.append((0, 0))
+            for successor, edgebest, edgeworst in block.edges:
+                if (address, successor) == stop:
+                    options.append((edgebest, edgeworst))
+                elif (address, successor) in self._backedges or results.get(successor) == None:
+                    continue
+                else:
+                    best, worst = results[successor]
+                    options.append((edgebest + best, edgeworst + worst if worst != None else None))
+            if not options:
+                results[address] = None
+                continue
+            best = cost[0] + min(option[0] for option in options)
+            worst = None
+            if cost[1] != None and None not in [option[1] for option in options]:
+                worst = cost[1] + max(option[1] for option in options)
+            results[address] = (best, worst)
+        return results.get(start) or (None, None)
+
+    # The blocks in nodes reachable from start, each after its successors
+    def postorder(self, start, nodes):
+        order = []
+        seen = set([start])
+        stack = [(start, iter(self._blocks[start].edges))]
+        while stack:
+            address, edges = stack[-1]
+            edge = next(edges, None)
+            if edge == None:
+                order.append(address)
+                stack.pop()
+                continue
+            successor = edge[0]
+            if successor in nodes and successor not in seen and (address, successor) not in self._backedges:
+                seen.add(successor)
+                stack.append((successor, iter(self._blocks[successor].edges)))
+        return order
+
+    # Best and worst cycles from a subroutine's entry to its return, not
+    # counting the JSR. The worst case is None if the subroutine loops.
+    def subroutine(self, entry, stack=()):
+        if entry in self._bounds:
+            return self._bounds[entry]
+        if entry in stack or entry not in self._blocks:
+            return None, None
+        nodes = self.reachable(entry)
+        bound = self.paths(entry, nodes, None, stack + (entry,))
+        if any(head in nodes for head, tail, body in self._loops):
+            bound = (bound[0], None)
+        self._bounds[entry] = bound
+        return bound
+
+    # Best and worst cycles for one time round a loop
+    def iteration(self, loop):
+        head, tail, body = loop
+        return self.paths(head, body, (tail, head), ())
+
+    ################################
+    # Results
+
+    # Cycle counts for each instruction, as text for the assembler listing
+    def cycles(self):
+        result = {}
+        for block in self._blocks.values():
+            for pc in block.instructions:
+                opcode, mnemonic, mode, size, operand = self.instruction(pc)
+                if mode == 'Branch':
+                    target = self.branchTarget(pc)
+                    taken = 3 if (target & 0xFF00) == ((pc + 2) & 0xFF00) else 4
+                    result[pc] = "2/{0}".format(taken)
+                else:
+                    best, worst = self.cost(pc)
+                    result[pc] = str(best) if best == worst else "{0}-{1}".format(best, worst)
+        return result
+
+    def report(self):
+        blocks = []
+        for address in sorted(self._blocks):
+            block = self._blocks[address]
+            edgebest = min([edge[1] for edge in block.edges] or [0])
+            edgeworst = max([edge[2] for edge in block.edges] or [0])
+            blocks.append({ "start": block.start, "end": block.end,
+                            "best": block.best + edgebest, "worst": block.worst + edgeworst,
+                            "successors": [edge[0] for edge in block.edges],
+                            "calls": block.calls })
+        subroutines = []
+        for entry in sorted(self._functions):
+            if entry in self._blocks:
+                best, worst = self.subroutine(entry)
+                subroutines.append({ "entry": entry, "best": best, "worst": worst })
+        loops = []
+        for loop in self._loops:
+            best, worst = self.iteration(loop)
+            loops.append({ "head": loop[0], "tail": loop[1], "blocks": sorted(loop[2]),
+                           "best": best, "worst": worst })
+        return { "blocks": blocks, "subroutines": subroutines, "loops": loops }
+
+    def json(self):
+        return json.dumps(self.report(), indent=1)
+
+    # Disassembly by block with the cycles of each instruction, followed by
+    # the subroutine and loop bounds
+    def listing(self):
+        report = self.report()
+        text = self.cycles()
+        formatter = disassembler.Formatter()
+        dis = disassembler.Disassembler()
+        lines = []
+        for block in report["blocks"]:
+            lines.append("; block ${0:04X}-${1:04X}  best {2}  worst {3}  successors {4}".format(block["start"],
+                block["end"], block["best"], block["worst"],
+                " ".join("${0:04X}".format(a) for a in block["successors"]) or "none"))
+            for pc in self._blocks[block["start"]].instructions:
+                lines.append("{0:>5}  {1}".format(text[pc], formatter.format(dis.decode(self._mem, pc))))
+        lines.append("")
+        for sub in report["subroutines"]:
+            lines.append("; subroutine ${0:04X}  best {1}  worst {2}".format(sub["entry"],
+                self.bound(sub["best"]), self.bound(sub["worst"])))
+        for loop in report["loops"]:
+            lines.append("; loop ${0:04X}-${1:04X}  per iteration best {2}  worst {3}".format(loop["head"],
+                self._blocks[loop["tail"]].end, self.bound(loop["best"]), self.bound(loop["worst"])))
+        return lines
+
+    def bound(self, value):
+        return "unbounded" if value == None else value
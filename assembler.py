@@ -22,24 +22,89 @@
 ################################
 # 6502 Assembler class
 
+import os
+import re
 import settings
 
 class Assembler:
 
     _filename = None
-    _line = None
+    _source = None
+    _srcfile = None
     _linenum = 0
     _errors = None
-    _ptr = 0
+    _diagnostics = None
+    _print = True
+    _tokens = None
+    _tokptr = 0
     _code = []
+    _segments = None
     _pass = 0
     _labels = {}
     _base = 0
 
+    # Relocatable assembly. _rel is the relocation of the value the
+    # expression parser last returned: None if it is absolute, "" if it is
+    # relative to the start of this module, or the name of an imported
+    # symbol. _relpart records a < or > applied to such a value.
+    _relocatable = False
+    _labelrel = None
+    _rel = None
+    _relpart = None
+    _relocs = None
+    _imports = None
+    _exports = None
+
+    # Optimizing assembly repeats the first pass until every label settles,
+    # or reports an error after MAX_PASSES repeats, so forward references
+    # get the shortest encoding, and turns branches
+    # that can't reach their target into an inverted branch over a JMP.
+    # _relaxed holds the ordinal numbers of the branches rewritten that way.
+    _optimize = False
+    _relaxed = None
+    _branchnum = 0
+
+    MAX_PASSES = 16
+
+    # Peephole optimization. Every statement that emits code is numbered
+    # and recorded in _stmts as (number, segment, address, bytes, labelled,
+    # data, target) where target is the label a branch or jump names.
+    # After a pass the optimizer turns that into _rewrites, a replacement
+    # opcode or peephole.DELETE per statement number, which the next pass
+    # applies as it emits the code. _notes explains each rewrite.
+    _peephole = False
+    _optimizer = None
+    _rewrites = None
+    _notes = None
+    _stmts = None
+    _stmtnum = 0
+    _labelled = False
+    _target = None
+
+    # Listing of the final pass: (address, bytes, file, linenum, text, note,
+    # instruction) where instruction is False for data and directives
+    _listing = None
+    _note = None
+    _instruction = False
+
     _value = 0
     _str = None
     _oldtoken = None
 
+    # Source line feed. Each entry is an iterator over (file, linenum, tokens,
+    # text) tuples; includes and macro expansions push a new iterator on top.
+    _input = None
+    _macros = None
+    _sources = None
+
+    MAX_NESTING = 32
+
+    # Tokenized files shared by every Assembler in the process, keyed by
+    # absolute path and validated against the file's mtime and size. Each
+    # entry also maps the text of every line to its tokens, so when a file
+    # changes only the lines that changed are tokenized again.
+    _files = {}
+
     # Tokens
     EOL = 0
     INT = 1
@@ -63,79 +128,447 @@ class Assembler:
     LSQUARE = 19
     RSQUARE = 20
 
-    def __init__(self, filename):
+    # Tokens that can follow a complete operand
+    ENDS = (EOL, COMMA, RPAREN)
+
+    # source, if given, is the program itself as a string, an iterable of
+    # lines or a file-like object, and filename only names it in errors and
+    # locates its includes.
+    def __init__(self, filename, relocatable=False, optimize=False, peephole=False, listing=False, source=None):
         self._filename = filename
-        
+        self._source = source
+        self._relocatable = relocatable
+        self._optimize = optimize
+        self._peephole = peephole
+        self._listing = [] if listing else None
+        self._labels = {}
+        self._labelrel = {}
+        self._imports = []
+        self._exports = []
+
     def assemble(self):
-        for self._pass in (1, 2):
-            self._linenum = 0
-            self._errors = 0
-            self._code = []
-            self._base = settings.BASE_PC
-            
-            f = open(self._filename, 'r')
-            for self._line in f:
-                self._linenum += 1
-                self._ptr = 0
-                self._oldtoken = None
+        self._sources = []
+        self._relaxed = set()
+        self._rewrites = {}
+        self._notes = {}
+        if self._source != None:
+            source = self.readtext(self._filename, self._source)
+        else:
+            source = self.readsource(self._filename)
+        self._pass = 1
+        self.assemblepass(source)
+        settled = True
+        if self._optimize or self._peephole:
+            for n in range(self.MAX_PASSES):
+                labels = dict(self._labels)
+                relaxed = len(self._relaxed)
+                rewrites = self._rewrites
+                if self._peephole:
+                    if self._optimizer == None:
+                        import peephole
+                        self._optimizer = peephole.Peephole()
+                    self._rewrites, self._notes = self._optimizer.optimize(self._stmts, self._labels)
+                self.assemblepass(source)
+                if self._labels == labels and len(self._relaxed) == relaxed and self._rewrites == rewrites:
+                    break
+            else:
+                settled = False
+        self._pass = 2
+        self.assemblepass(source)
+        if not settled:
+            # The code may not agree with its own labels
+            self._srcfile, self._linenum = self._filename, 0
+            self.error("Labels did not settle after {0} passes".format(self.MAX_PASSES))
+        return [seg for seg in self._segments if len(seg[1]) > 0]
+
+    def assemblepass(self, source):
+        self._errors = 0
+        self._diagnostics = []
+        self._code = []
+        self._base = settings.BASE_PC
+        self._segments = [[self._base, self._code]]
+        self._relocs = []
+        if self._relocatable:
+            self._base = 0
+            self._segments = [[0, self._code]]
+        self._macros = {}
+        self._branchnum = 0
+        self._stmts = []
+        self._stmtnum = 0
+        self._labelled = False
+        self._input = [iter(source)]
+
+        listing = self._listing != None and self._pass == 2
+        line = self.nextline()
+        while line != None:
+            if listing:
+                code = self._code
+                start = len(code)
+                self._note = None
+                self._instruction = False
+            self.statement(line)
+            if listing:
+                if self._code is not code:
+                    code = self._code
+                    start = 0
+                self._listing.append((self._base + start, code[start:], line[0], line[1], line[3],
+                    self._note, self._instruction))
+            line = self.nextline()
+
+    def statement(self, line):
+        self._srcfile, self._linenum, self._tokens = line[0:3]
+        self._tokptr = 0
+        self._oldtoken = None
+        token = self.gettoken()
+        while token != self.EOL:
+            if token == self.LABEL and self._str.upper() in self._macros:
+                self.expandmacro(self._macros[self._str.upper()])
+                break
+            elif token == self.LABEL:
+                label = self._str
                 token = self.gettoken()
-                while token != self.EOL:
-                    if token == self.LABEL:
-                        label = self._str
-                        token = self.gettoken()
-                        if token == self.EQU:
-                            value = self.expression(0, 65535)
-                            if value != None:
-                                self._labels[label] = value
-                            break
-                        self._labels[label] = self._base + len(self._code)
-                        if token == self.COLON:
-                            token = self.gettoken()
-                        continue
-                    elif token == self.STAR:
-                        # This is supposed to set the address at which the
-                        # code is assembled. Not much point right now so ignore it.
-                        break
-                    elif token == self.MNEMONIC:
-                        self.instructions[self._str.upper()](self)
-                        break
-                    else:
-                        self.error ("Syntax Error")
-                        break
-            f.close()
-        return self._code
+                if token == self.EQU:
+                    value = self.expression(0, 65535)
+                    if value != None:
+                        self._labels[label] = value
+                        self.setlabelrel(label, self._rel)
+                    break
+                self._labels[label] = self._base + len(self._code)
+                self._labelled = True
+                if self._relocatable:
+                    self._labelrel[label] = ""
+                if token == self.COLON:
+                    token = self.gettoken()
+                continue
+            elif token == self.STAR:
+                if self.gettoken() != self.EQU:
+                    self.error ("= expected")
+                else:
+                    self.origin(self.address())
+                break
+            elif token == self.MNEMONIC:
+                if not self._peephole and self._listing == None:
+                    self.instructions[self._str](self)
+                    break
+                code = self._code
+                start = len(code)
+                data = self._str.startswith(".") and self._str != ".SYS"
+                self._instruction = not data
+                self._target = None
+                self.instructions[self._str](self)
+                if self._code is code and len(code) > start:
+                    self.rewrite(start, data)
+                break
+            else:
+                self.error ("Syntax Error")
+                break
     
     def errorcount(self):
         return self._errors
-    
+
+    # Errors of the last assembly as (file, linenum, message) tuples
+    def diagnostics(self):
+        return self._diagnostics
+
+    def symbols(self):
+        return dict(self._labels)
+
+    # Start assembling at a new address. Code is returned as a list of
+    # [address, bytes] segments so gaps between origins cost nothing.
+    def origin(self, address):
+        if address == None:
+            return
+        if self._relocatable:
+            self.error ("Origin not allowed in a relocatable module")
+            return
+        if len(self._code) == 0:
+            self._segments[-1][0] = address
+        elif address != self._base + len(self._code):
+            self._code = []
+            self._segments.append([address, self._code])
+        else:
+            return
+        self._base = address
+
+    # Relocatable object for the linker: the code assembled at address 0,
+    # the symbols it exports and imports and the operands to patch.
+    def object(self):
+        exports = {}
+        for name in self._exports:
+            if name in self._labels:
+                exports[name] = [self._labels[name], self._labelrel.get(name) == ""]
+        return { "code": self._code,
+                 "exports": exports,
+                 "imports": self._imports,
+                 "relocs": self._relocs }
+
+    # Every file read while assembling, used to validate cached output
+    def sources(self):
+        return self._sources
+
+    # Source listing of the last assembly, one entry per line, with the
+    # peephole rewrites made on each line. cycles, if given, maps the
+    # address of each instruction to a cycle count shown beside it. Bytes
+    # left unresolved by errors show as ??.
+    def listing(self, cycles=None):
+        lines = []
+        for address, code, srcfile, linenum, text, note, instruction in self._listing or []:
+            data = " ".join("??" if b == None else "{0:02X}".format(b) for b in code[0:3])
+            if cycles != None:
+                data = "{0:<9} {1:>5}".format(data, cycles.get(address, "") if code else "")
+            lines.append("{0:04X}  {1:<9} {2:>5}  {3}".format(address, data, linenum, text))
+            for n in range(3, len(code), 3):
+                data = " ".join("??" if b == None else "{0:02X}".format(b) for b in code[n:n + 3])
+                lines.append("{0:04X}  {1:<9}".format(address + n, data))
+            if note != None:
+                lines.append("{0:22}; peephole: {1}".format("", note))
+        return lines
+
+    # Line information of the last assembly: (address, bytes, file, linenum,
+    # text, instruction) for every source line, including expanded macros
+    def lineinfo(self):
+        return [entry[0:5] + entry[6:] for entry in self._listing or []]
+
+    ################################
+    # Peephole rewrites
+
+    # Record the statement that just emitted code from start onwards and
+    # apply the rewrite the optimizer chose for it on the previous pass.
+    def rewrite(self, start, data):
+        self._stmtnum += 1
+        if self._peephole:
+            import peephole
+            self._stmts.append((self._stmtnum, len(self._segments), self._base + start, self._code[start:],
+                self._labelled, data, self._target))
+            op = self._rewrites.get(self._stmtnum)
+            if op == peephole.DELETE:
+                del self._code[start:]
+                self._relocs = [reloc for reloc in self._relocs if reloc[0] < start]
+                self._note = self._notes.get(self._stmtnum, "removed")
+            elif op != None:
+                self._code[start] = op
+                self._note = self._notes.get(self._stmtnum)
+            else:
+                self._note = self._notes.get(self._stmtnum)
+        self._labelled = False
+
+    ################################
+    # Source files, includes and macros
+
+    # Return the tokenized lines of filename, reusing an earlier
+    # tokenization if the file hasn't changed since.
+    def readsource(self, filename):
+        if filename not in self._sources:
+            self._sources.append(filename)
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        stamp = (st.st_mtime, st.st_size)
+        cached = self._files.get(path)
+        if cached != None and cached[0] == stamp:
+            return cached[1]
+        known = {}
+        f = open(filename, 'r')
+        lines = self.readtext(filename, f, known, cached[2] if cached != None else None)
+        f.close()
+        self._files[path] = (stamp, lines, known)
+        return lines
+
+    # Tokenize source held in memory: a string, an iterable of lines or a
+    # file-like object. The tokens of each distinct line are put in known,
+    # and taken from previous if it has them.
+    def readtext(self, filename, text, known=None, previous=None):
+        if isinstance(text, str):
+            text = text.splitlines()
+        if known == None:
+            known = {}
+        lines = []
+        for n, line in enumerate(text, 1):
+            tokens = known.get(line)
+            if tokens == None:
+                tokens = previous.get(line) if previous != None else None
+                if tokens == None:
+                    tokens = self.tokenize(line)
+                known[line] = tokens
+            lines.append((filename, n, tokens, line.rstrip()))
+        return lines
+
+    def nextline(self):
+        while self._input:
+            line = next(self._input[-1], None)
+            if line != None:
+                return line
+            self._input.pop()
+        return None
+
+    def pushlines(self, lines):
+        if len(self._input) > self.MAX_NESTING:
+            self.error ("Include or macro nesting too deep")
+            return
+        self._input.append(iter(lines))
+
+    # Collect the lines up to the directive that closes a .MACRO or .REPT
+    # block, allowing for nested blocks of the same kind. The block must end
+    # in the same file or expansion it started in.
+    def readblock(self, opener, closer):
+        lines = []
+        depth = 0
+        for line in self._input[-1]:
+            first = line[2][0]
+            if first[0] == self.MNEMONIC and first[1] == opener:
+                depth += 1
+            elif first[0] == self.MNEMONIC and first[1] == closer:
+                if depth == 0:
+                    return lines
+                depth -= 1
+            lines.append(line)
+        self.error ("Missing " + closer)
+        return lines
+
+    # Split the rest of the line into comma separated token lists. Commas
+    # inside parentheses or before an index register belong to the
+    # argument, as in ($30),Y or $400,X.
+    def macroargs(self):
+        args = []
+        arg = []
+        depth = 0
+        while self._tokptr < len(self._tokens):
+            token = self._tokens[self._tokptr]
+            if token[0] == self.EOL:
+                break
+            self._tokptr += 1
+            nexttoken = self._tokens[self._tokptr][0] if self._tokptr < len(self._tokens) else self.EOL
+            indexed = nexttoken == self.XREG or nexttoken == self.YREG
+            if token[0] == self.COMMA and depth == 0 and not indexed:
+                args.append(arg)
+                arg = []
+                continue
+            if token[0] == self.LPAREN:
+                depth += 1
+            elif token[0] == self.RPAREN:
+                depth -= 1
+            arg.append(token)
+        if arg or args:
+            args.append(arg)
+        return args
+
+    # Substitute the arguments for the parameters on the token level and
+    # feed the resulting lines back through the statement loop.
+    def expandmacro(self, macro):
+        params, body = macro
+        args = self.macroargs()
+        if len(args) > len(params):
+            self.error ("Too many macro arguments")
+            return
+        subst = {}
+        for i in range(len(params)):
+            subst[params[i]] = args[i] if i < len(args) else []
+        lines = []
+        for srcfile, linenum, tokens, text in body:
+            expanded = []
+            for token in tokens:
+                if token[0] == self.LABEL and token[1] in subst:
+                    expanded.extend(subst[token[1]])
+                else:
+                    expanded.append(token)
+            lines.append((srcfile, linenum, expanded, text))
+        self.pushlines(lines)
+
     def error(self, str):
         if self._pass == 2:
-            print ("PY6502: {0} ({1}) : error: {2}".format(self._filename, self._linenum, str))
+            self._diagnostics.append((self._srcfile, self._linenum, str))
+            if self._print:
+                print ("PY6502: {0} ({1}) : error: {2}".format(self._srcfile, self._linenum, str))
             self._errors += 1
 
     ################################
-    # Parse instruction operands
+    # Tokenizer
+
+    # One master pattern matches and classifies the next token. Each line is
+    # split into (kind, value, error) tuples once and the token list is then
+    # replayed by gettoken on both passes. Errors found while scanning are
+    # carried on the token so they are only reported on the second pass.
+    _tokenpattern = re.compile(r"""\s*(?:
+          (?P<EOL>;|$)
+        | (?P<CHAR>'(?:.'?)?)
+        | (?P<STRING>"[^"]*"?)
+        | (?P<HEX>\$[0-9A-Fa-f]*)
+        | (?P<DEC>[0-9]+)
+        | (?P<IDENT>[A-Za-z.][A-Za-z0-9._]*)
+        | (?P<PUNCT>[#(),+\-=*:<>\[\]])
+        | (?P<BAD>.)
+        )""", re.VERBOSE)
+
+    _punctuation = {
+        '#': HASH,
+        '(': LPAREN,
+        ')': RPAREN,
+        ',': COMMA,
+        '+': PLUS,
+        '-': MINUS,
+        '=': EQU,
+        '*': STAR,
+        ':': COLON,
+        '<': LARROW,
+        '>': RARROW,
+        '[': LSQUARE,
+        ']': RSQUARE
+        }
 
-    def getnumber(self, base):
-        value = 0
-        size = 0
-        ch = self._line[self._ptr]
-        while self._ptr < len(self._line):
-            ch = self._line[self._ptr]
-            if ch.isdigit():
-                value = (value * base) + ord(ch) - 48
-            elif ch >= 'A' and ch <= 'F' and base == 16:
-                value = (value * base) + (ord(ch) - 65) + 10
-            elif ch >= 'a' and ch <= 'f' and base == 16:
-                value = (value * base) + (ord(ch) - 97) + 10
+    # Identifier text to token, filled in on first sight of each spelling
+    _identifiers = {}
+
+    def identifier(self, text):
+        token = self._identifiers.get(text)
+        if token == None:
+            upper = text.upper()
+            if upper in self.instructions:
+                token = (self.MNEMONIC, upper, None)
+            elif upper == "A":
+                token = (self.AREG, text, None)
+            elif upper == "X":
+                token = (self.XREG, text, None)
+            elif upper == "Y":
+                token = (self.YREG, text, None)
             else:
+                token = (self.LABEL, text, None)
+            self._identifiers[text] = token
+        return token
+
+    def tokenize(self, line):
+        tokens = []
+        for m in self._tokenpattern.finditer(line):
+            kind = m.lastgroup
+            text = m.group(kind)
+            if kind == 'IDENT':
+                tokens.append(self.identifier(text))
+            elif kind == 'PUNCT':
+                tokens.append((self._punctuation[text], None, None))
+            elif kind == 'DEC':
+                tokens.append((self.INT, int(text), None))
+            elif kind == 'HEX':
+                if len(text) > 1:
+                    tokens.append((self.INT, int(text[1:], 16), None))
+                else:
+                    tokens.append((self.INT, None, "Missing value"))
+            elif kind == 'STRING':
+                if len(text) > 1 and text[-1] == '"':
+                    tokens.append((self.STRING, text[1:-1], None))
+                else:
+                    tokens.append((self.STRING, text[1:], "Unexpected end of line"))
+            elif kind == 'CHAR':
+                if len(text) == 3:
+                    tokens.append((self.INT, ord(text[1]), None))
+                elif len(text) == 2:
+                    tokens.append((self.INT, ord(text[1]), "Missing '"))
+                else:
+                    tokens.append((self.INT, None, "Unexpected end of line"))
+            elif kind == 'BAD':
+                tokens.append((self.EOL, None, "Unexpected character"))
                 break
-            self._ptr += 1
-            size += 1
-        if size == 0:
-            self.error ("Missing value")
-            return None
-        return value
+            else:
+                break
+        tokens.append((self.EOL, None, None))
+        return tokens
 
     # Push the specified token back into a 1-item deep stack so that
     # gettoken returns that next time. Used for lookahead.
@@ -147,114 +580,30 @@ class Assembler:
             token = self._oldtoken
             self._oldtoken = None
             return token
-        if self._ptr >= len(self._line):
-            return self.EOL
-        ch = self._line[self._ptr]
-        while ch.isspace():
-            self._ptr += 1
-            if self._ptr == len(self._line):
-                return self.EOL
-            ch = self._line[self._ptr]
-        if ch == '\'':
-            self._ptr += 1
-            if self._ptr < len(self._line):
-                self._value = ord(self._line[self._ptr])
-                self._ptr += 1
-                if self._ptr == len(self._line):
-                    self.error ("Unexpected end of line")
-                elif self._line[self._ptr] != '\'':
-                    self.error ("Missing '")
-                else:
-                    self._ptr += 1
-            return self.INT
-        if ch == '"':
-            self._ptr += 1
-            str_list = []
-            while self._ptr < len(self._line) and self._line[self._ptr] != '"':
-                str_list.append(self._line[self._ptr])
-                self._ptr += 1
-            if self._ptr == len(self._line):
-                self.error ("Unexpected end of line")
-            else:
-                self._str = ''.join(str_list)
-                self._ptr += 1
-            return self.STRING
-        if ch == ';':
-            self._ptr = len(self._line)
-            return self.EOL
-        if ch == '#':
-            self._ptr += 1
-            return self.HASH
-        if ch == '(':
-            self._ptr += 1
-            return self.LPAREN
-        if ch == ')':
-            self._ptr += 1
-            return self.RPAREN
-        if ch == ',':
-            self._ptr += 1
-            return self.COMMA
-        if ch == '+':
-            self._ptr += 1
-            return self.PLUS
-        if ch == '-':
-            self._ptr += 1
-            return self.MINUS
-        if ch == '=':
-            self._ptr += 1
-            return self.EQU
-        if ch == '*':
-            self._ptr += 1
-            return self.STAR
-        if ch == ':':
-            self._ptr += 1
-            return self.COLON
-        if ch == '<':
-            self._ptr += 1
-            return self.LARROW
-        if ch == '>':
-            self._ptr += 1
-            return self.RARROW
-        if ch == '[':
-            self._ptr += 1
-            return self.LSQUARE
-        if ch == ']':
-            self._ptr += 1
-            return self.RSQUARE
-        if ch == '$':
-            self._ptr += 1
-            self._value = self.getnumber(16)
-            return self.INT
-        if ch.isdigit():
-            self._value = self.getnumber(10)
-            return self.INT
-        if ch.isalpha() or ch == '.':
-            str_list = []
-            while ch.isalnum() or ch == '.' or ch == '_':
-                str_list.append(ch)
-                self._ptr += 1
-                if self._ptr == len(self._line):
-                    break
-                ch = self._line[self._ptr]
-            self._str = ''.join(str_list)
-            if self._str.upper() in self.instructions:
-                return self.MNEMONIC
-            if self._str == "A" or self._str == "a":
-                return self.AREG
-            if self._str == "X" or self._str == "x":
-                return self.XREG
-            if self._str == "Y" or self._str == "y":
-                return self.YREG
-            return self.LABEL
-        self.error ("Unexpected character")
-        return self.EOL
+        token, value, err = self._tokens[self._tokptr]
+        if err != None:
+            self.error (err)
+            self._tokptr += 1
+        elif token != self.EOL:
+            self._tokptr += 1
+        if token == self.INT:
+            self._value = value
+        elif value != None:
+            self._str = value
+        return token
+
+    ################################
+    # Parse instruction operands
 
     def parsenumber(self):
         neg = 1
         value = None
+        self._rel = None
         token = self.gettoken()
         if token == self.STAR:
-            return settings.BASE_PC + len(self._code)
+            if self._relocatable:
+                self._rel = ""
+            return self._base + len(self._code)
         if token == self.LSQUARE:
             value = self.parseop1()
             if self.gettoken() != self.RSQUARE:
@@ -262,9 +611,13 @@ class Assembler:
             return value
         if token == self.LARROW:
             value = self.parsenumber()
+            if self._rel != None:
+                self._relpart = ('L', value)
             return value & 0xFF if value != None else value
         if token == self.RARROW:
             value = self.parsenumber()
+            if self._rel != None:
+                self._relpart = ('H', value)
             return (value >> 8) & 0xFF if value != None else value
         if token == self.MINUS:
             token = self.gettoken()
@@ -273,59 +626,97 @@ class Assembler:
             token = self.gettoken()
             neg = 1
         if token == self.LABEL:
-            if self._str in self._labels:
-                value = self._labels[self._str]
-                token = self.INT
-            elif self._pass == 1:
-                value = 0x100
-            else:
-                self.error ("Undefined label: " + self._str)
+            value = self.labelvalue(self._str)
         elif token == self.INT and self._value != None:
             value = self._value
         elif token == self.STRING and len(self._str) == 1:
             value = ord(self._str[0])
         else:
             self.error ("Value expected")
+        if neg == -1 and self._rel != None:
+            self.error ("Invalid relocatable expression")
         return value if value == None else value * neg
 
+    # Value of a label, setting _rel to its relocation. Undefined labels
+    # are $100 on the first pass and an error on the second.
+    def labelvalue(self, label):
+        if label in self._labels:
+            if self._relocatable:
+                self._rel = self._labelrel.get(label)
+            return self._labels[label]
+        if self._pass == 1:
+            return 0x100
+        self.error ("Undefined label: " + label)
+        return None
+
     # Parse multiplication operator
     def parseop2(self):
         value = self.parsenumber()
+        rel = self._rel
         while value != None:
             token = self.gettoken()
             if token == self.STAR:
                 value2 = self.parsenumber()
                 if value2 == None:
                     break
+                if rel != None or self._rel != None:
+                    self.error ("Invalid relocatable expression")
                 value = value * value2
                 continue
             self.pushtoken(token)
             break
+        self._rel = rel
         return value
 
-    # Parse addition and subtraction operators
+    # Parse addition and subtraction operators. A relocatable value may be
+    # offset by a constant, and two values relative to the same base may be
+    # subtracted to give a constant.
     def parseop1(self):
         value = self.parseop2()
+        rel = self._rel
         while value != None:
             token = self.gettoken()
             if token == self.PLUS:
                 value2 = self.parseop2()
                 if value2 == None:
                     break
+                if rel != None and self._rel != None:
+                    self.error ("Invalid relocatable expression")
+                elif rel == None:
+                    rel = self._rel
                 value = value + value2
                 continue
             if token == self.MINUS:
                 value2 = self.parseop2()
                 if value2 == None:
                     break
+                if self._rel == rel:
+                    rel = None
+                elif self._rel != None:
+                    self.error ("Invalid relocatable expression")
                 value = value - value2
                 continue
             self.pushtoken(token)
             break
+        self._rel = rel
         return value
             
+    # A lone number or label, the usual operand, is taken straight from the
+    # tokens rather than through the operator parsers.
     def expression(self, min, max):
-        value = self.parseop1()
+        self._relpart = None
+        token, value, err = self._tokens[self._tokptr]
+        if self._oldtoken == None and err == None and (token == self.INT and value != None or token == self.LABEL) \
+                and self._tokens[self._tokptr + 1][0] in self.ENDS:
+            self._tokptr += 1
+            self._rel = None
+            if token == self.LABEL:
+                self._str = value
+                value = self.labelvalue(value)
+            else:
+                self._value = value
+        else:
+            value = self.parseop1()
         if value != None and (value < min or value > max):
             self.error("Value out of range")
             return None
@@ -342,7 +733,13 @@ class Assembler:
 
     def operand(self):
         v = { 'type': None, 'value': None }
-        token = self.gettoken()
+        self._rel = None
+        self._relpart = None
+        # A label or number is left unread so address() can take it straight
+        # from the tokens
+        peek = self._tokens[self._tokptr][0] if self._oldtoken == None else None
+        unread = peek == self.LABEL or peek == self.INT
+        token = peek if unread else self.gettoken()
         if token == self.HASH:
             v['type'] = 'Imm'
             v['value'] = self.literal()
@@ -361,7 +758,7 @@ class Assembler:
                     if self.gettoken() != self.YREG:
                         self.error ("Y expected")
                     else:
-                        if value <= 0xFF:
+                        if value == None or value <= 0xFF and self._rel == None:
                             v['type'] = 'IndY'
                         else:
                             self.error ("Value out of range")
@@ -369,7 +766,7 @@ class Assembler:
                 if self.gettoken() != self.XREG:
                     self.error ("X expected")
                 else:
-                    if value <= 0xFF:
+                    if value == None or value <= 0xFF and self._rel == None:
                         v['type'] = 'IndX'
                     else:
                         self.error ("Value out of range")
@@ -377,28 +774,46 @@ class Assembler:
                     self.error (") expected")
             else:
                 self.error ("Syntax error")
-        elif token == self.LABEL:
-            token = self.INT
-            if self._str in self._labels:
-                self._value = self._labels[self._str]
-            elif self._pass == 1:
-                self._value = 0x100
-            else:
-                self.error ("Undefined label: " + self._str)
+        elif token == self.LABEL or token == self.INT or token == self.STAR or token == self.LSQUARE:
+            if not unread:
+                self.pushtoken(token)
+            self._value = self.address()
+            token = self.INT if self._value != None else self.EOL
         if token == self.INT:
             v['value'] = self._value
+            zpage = self._value <= 0xFF and self._rel == None
             if self.gettoken() != self.COMMA:
-                v['type'] = 'ZPage' if self._value <= 0xFF else 'Abs'
+                v['type'] = 'ZPage' if zpage else 'Abs'
             else:
                 token = self.gettoken()
                 if token == self.XREG:
-                    v['type'] = 'ZPageX' if self._value <= 0xFF else 'AbsX'
+                    v['type'] = 'ZPageX' if zpage else 'AbsX'
                 elif token == self.YREG:
-                    v['type'] = 'ZPageY' if self._value <= 0xFF else 'AbsY'
+                    v['type'] = 'ZPageY' if zpage else 'AbsY'
                 else:
                     self.error ("Unknown address syntax")
+        v['rel'] = self._rel
+        v['part'] = self._relpart
         return v
 
+    # Record a relocation for an operand of size bytes about to be stored at
+    # the end of the code, if its value depends on where the module is linked.
+    def addreloc(self, v, size):
+        if v['rel'] == None or self._pass != 2:
+            return
+        if size == 2:
+            self._relocs.append([len(self._code), 'W', v['rel'], v['value']])
+        elif v['part'] != None:
+            self._relocs.append([len(self._code), v['part'][0], v['rel'], v['part'][1]])
+        else:
+            self._relocs.append([len(self._code), 'B', v['rel'], v['value']])
+
+    def setlabelrel(self, label, rel):
+        if rel != None:
+            self._labelrel[label] = rel
+        elif label in self._labelrel:
+            del self._labelrel[label]
+
     def no_operand(self):
         v = self.operand()
         if v['type'] != None:
@@ -500,14 +915,19 @@ class Assembler:
             self._code.append(0xC8)
 
     def fnJMP(self):
+        token, value, err = self._tokens[self._tokptr]
+        if self._oldtoken == None and token == self.LABEL and self._tokens[self._tokptr + 1][0] == self.EOL:
+            self._target = value
         v = self.operand()
         if v['value'] != None:
             if v['type'] == 'Abs' or v['type'] == 'ZPage':
                 self._code.append(0x4C)
+                self.addreloc(v, 2)
                 self._code.append(v['value'] & 0xFF)
                 self._code.append((v['value'] >> 8) & 0xFF)
             elif v['type'] == 'Ind':
                 self._code.append(0x6C)
+                self.addreloc(v, 2)
                 self._code.append(v['value'] & 0xFF)
                 self._code.append((v['value'] >> 8) & 0xFF)
             else:
@@ -518,6 +938,7 @@ class Assembler:
         if v['value'] != None:
             if v['type'] == 'Abs' or v['type'] == 'ZPage':
                 self._code.append(0x20)
+                self.addreloc(v, 2)
                 self._code.append(v['value'] & 0xFF)
                 self._code.append((v['value'] >> 8) & 0xFF)
             else:
@@ -654,55 +1075,137 @@ class Assembler:
             token = self.gettoken()
 
     def fnWORD(self):
+        value = self.address()
+        while value != None:
+            self.addreloc({ 'value': value, 'rel': self._rel, 'part': None }, 2)
+            self._code.append(value & 0xFF)
+            self._code.append((value >> 8) & 0xFF)
+            if self.gettoken() != self.COMMA:
+                break
+            value = self.address()
+
+    def fnORG(self):
+        self.origin(self.address())
+
+    def fnIMPORT(self):
+        for name in self.namelist():
+            if not self._relocatable:
+                self.error ("External symbols need a relocatable module")
+            elif name not in self._imports:
+                self._imports.append(name)
+            self._labels[name] = 0
+            self._labelrel[name] = name
+
+    def fnEXPORT(self):
+        for name in self.namelist():
+            if self._pass == 2 and name not in self._labels:
+                self.error ("Undefined label: " + name)
+            elif self._labelrel.get(name, "") != "":
+                self.error ("Imported symbol cannot be exported: " + name)
+            elif name not in self._exports:
+                self._exports.append(name)
+
+    def namelist(self):
+        names = []
         token = self.gettoken()
-        while token == self.INT:
-            self._code.append(self._value & 0xFF)
-            self._code.append((self._value >> 8) & 0xFF)
+        while token == self.LABEL:
+            names.append(self._str)
             if self.gettoken() != self.COMMA:
+                return names
+            token = self.gettoken()
+        self.error ("Label expected")
+        return names
+
+    def fnINCLUDE(self):
+        if self.gettoken() != self.STRING:
+            self.error ("File name expected")
+            return
+        filename = self._str
+        if not os.path.isabs(filename):
+            local = os.path.join(os.path.dirname(self._srcfile), filename)
+            if os.path.exists(local):
+                filename = local
+        try:
+            lines = self.readsource(filename)
+        except (IOError, OSError):
+            self.error ("Cannot open include file: " + self._str)
+            return
+        self.pushlines(lines)
+
+    def fnMACRO(self):
+        if self.gettoken() != self.LABEL:
+            self.error ("Macro name expected")
+            self.readblock('.MACRO', '.ENDM')
+            return
+        name = self._str.upper()
+        params = []
+        token = self.gettoken()
+        while token == self.LABEL:
+            params.append(self._str)
+            token = self.gettoken()
+            if token != self.COMMA:
                 break
             token = self.gettoken()
+        if token != self.EOL:
+            self.error ("Macro parameter expected")
+        self._macros[name] = (params, self.readblock('.MACRO', '.ENDM'))
+
+    def fnENDM(self):
+        self.error (".ENDM without .MACRO")
+
+    def fnREPT(self):
+        count = self.expression(0, 65535)
+        body = self.readblock('.REPT', '.ENDR')
+        if count != None:
+            self.pushlines(body * count)
+
+    def fnENDR(self):
+        self.error (".ENDR without .REPT")
 
     def storeCode(self, imm, zpage, zpagex, zpagey, abs, absx, absy, indx, indy, acc):
         v = self.operand()
-        if v['type'] == None or v['type'] == 'Acc' and acc != None:
-            self._code.append(acc)
+        mode = v['type']
+        code = self._code
+        if mode == None or mode == 'Acc' and acc != None:
+            code.append(acc)
+            return
+        if mode == 'ZPageX' and zpagex == None and absx != None:
+            mode = 'AbsX'
+        if mode == 'ZPageY' and zpagey == None and absy != None:
+            mode = 'AbsY'
+        op = None
+        if mode == 'Imm':
+            op = imm
+        elif mode == 'ZPage':
+            op = zpage
+        elif mode == 'ZPageX':
+            op = zpagex
+        elif mode == 'ZPageY':
+            op = zpagey
+        elif mode == 'IndX':
+            op = indx
+        elif mode == 'IndY':
+            op = indy
+        elif mode == 'Abs':
+            op = abs
+        elif mode == 'AbsX':
+            op = absx
+        elif mode == 'AbsY':
+            op = absy
+        if op == None:
+            self.error ("Addressing mode not allowed for instruction")
+            return
+        value = v['value']
+        code.append(op)
+        if mode[0] == 'A':
+            if v['rel'] != None:
+                self.addreloc(v, 2)
+            code.append(value & 0xFF)
+            code.append((value >> 8) & 0xFF)
         else:
-            if v['type'] == 'ZPageX' and zpagex == None and absx != None:
-                v['type'] = 'AbsX'
-            if v['type'] == 'ZPageY' and zpagey == None and absy != None:
-                v['type'] = 'AbsY'
-            if v['type'] == 'Imm' and imm != None:
-                self._code.append(imm)
-                self._code.append(v['value'])
-            elif v['type'] == 'ZPage' and zpage != None:
-                self._code.append(zpage)
-                self._code.append(v['value'])
-            elif v['type'] == 'ZPageX' and zpagex != None:
-                self._code.append(zpagex)
-                self._code.append(v['value'])
-            elif v['type'] == 'ZPageY' and zpagey != None:
-                self._code.append(zpagey)
-                self._code.append(v['value'])
-            elif v['type'] == 'Abs' and abs != None:
-                self._code.append(abs)
-                self._code.append(v['value'] & 0xFF)
-                self._code.append((v['value'] >> 8) & 0xFF)
-            elif v['type'] == 'AbsX' and absx != None:
-                self._code.append(absx)
-                self._code.append(v['value'] & 0xFF)
-                self._code.append((v['value'] >> 8) & 0xFF)
-            elif v['type'] == 'AbsY' and absy != None:
-                self._code.append(absy)
-                self._code.append(v['value'] & 0xFF)
-                self._code.append((v['value'] >> 8) & 0xFF)
-            elif v['type'] == 'IndX' and indx != None:
-                self._code.append(indx)
-                self._code.append(v['value'])
-            elif v['type'] == 'IndY' and indy != None:
-                self._code.append(indy)
-                self._code.append(v['value'])
-            else:
-                self.error ("Addressing mode not allowed for instruction")
+            if v['rel'] != None:
+                self.addreloc(v, 1)
+            code.append(value)
 
     def storeBranch(self, op):
         token = self.gettoken()
@@ -710,14 +1213,33 @@ class Assembler:
             self._code.append(op)
             self._code.append(self._value & 0xFF)
         elif token == self.LABEL:
-            if self._str in self._labels:
+            value = 0
+            known = self._str in self._labels
+            if known:
                 value = self._labels[self._str]
-            elif self._pass == 1:
-                value = 0
-            else:
+                if self._labelrel.get(self._str, "") != "":
+                    self.error ("Branch to external symbol: " + self._str)
+            elif self._pass == 2:
                 self.error ("Undefined label: " + self._str)
+            self._branchnum += 1
+            self._target = self._str
+            offset = (value - self._base) - (len(self._code) + 1)
+            if self._optimize and known and self._pass == 1 and (offset < -128 or offset > 127):
+                self._relaxed.add(self._branchnum)
+            if self._branchnum in self._relaxed:
+                # Branch on the opposite condition over a JMP to the target.
+                # The offset is relative to the operand like any other branch.
+                self._code.append(op ^ 0x20)
+                self._code.append(4)
+                self._code.append(0x4C)
+                self.addreloc({ 'value': value, 'rel': self._labelrel.get(self._str), 'part': None }, 2)
+                self._code.append(value & 0xFF)
+                self._code.append((value >> 8) & 0xFF)
+                return
+            if known and (offset < -128 or offset > 127):
+                self.error ("Branch out of range")
             self._code.append(op)
-            self._code.append(((value - self._base) - len(self._code)) & 0xFF)
+            self._code.append(offset & 0xFF)
         else:
             self.error ("Label expected")
 
@@ -787,5 +1309,62 @@ class Assembler:
         'TYA': fnTYA,
         '.BYTE': fnBYTE,
         '.WORD': fnWORD,
-        '.SYS': fnSYS
+        '.SYS': fnSYS,
+        '.ORG': fnORG,
+        '.IMPORT': fnIMPORT,
+        '.EXPORT': fnEXPORT,
+        '.INCLUDE': fnINCLUDE,
+        '.MACRO': fnMACRO,
+        '.ENDM': fnENDM,
+        '.REPT': fnREPT,
+        '.ENDR': fnENDR
         }
+
+################################
+# In-memory assembly
+#
+# assemble() runs the assembler over source held in memory and returns a
+# Result instead of printing errors, for programs that generate code on
+# the fly and don't want to go through a file.
+
+class Result:
+
+    segments = None
+    symbols = None
+    diagnostics = None
+
+    def __init__(self, segments, symbols, diagnostics):
+        self.segments = segments
+        self.symbols = symbols
+        self.diagnostics = diagnostics
+
+    def ok(self):
+        return len(self.diagnostics) == 0
+
+    # The code as one block of bytes from the lowest to the highest address
+    # assembled, with any gaps between segments zero filled. Raises
+    # ValueError naming the errors if the assembly failed, as code with
+    # errors has bytes missing.
+    def bytes(self):
+        if not self.ok():
+            raise ValueError("Assembly failed: " + "; ".join("{0} ({1}) : {2}".format(*d) for d in self.diagnostics))
+        if len(self.segments) == 0:
+            return b""
+        start = min(address for address, code in self.segments)
+        end = max(address + len(code) for address, code in self.segments)
+        image = bytearray(end - start)
+        for address, code in self.segments:
+            image[address - start:address - start + len(code)] = bytearray(code)
+        return bytes(image)
+
+    # First address of bytes()
+    def address(self):
+        return min(address for address, code in self.segments) if self.segments else settings.BASE_PC
+
+# source is a string, an iterable of lines or a file-like object. name is
+# used in diagnostics and includes are looked up relative to it.
+def assemble(source, name="<source>", optimize=False, peephole=False):
+    asm = Assembler(name, optimize=optimize, peephole=peephole, source=source)
+    asm._print = False
+    segments = asm.assemble()
+    return Result(segments, asm.symbols(), asm.diagnostics())
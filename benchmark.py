@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Startup benchmark
+#
+#  python benchmark.py [-n N] [<asmfile>]
+#    runs py6502.py -a, -d and -x on asmfile (test1.asm by default) N times each in a fresh
+#    interpreter and prints the median time of each, next to an interpreter that only imports what
+#    every run needs. Then prints the time taken to import each module on its own. The source is
+#    copied to a temporary directory so nothing is written beside it. Import times include the
+#    standard library modules each one pulls in.
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+MODULES = ("settings", "utilities", "disassembler", "assembler", "simulator", "peephole", "analysis")
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Median wall time in milliseconds of running command count times
+def timeRuns(command, count, cwd):
+    times = []
+    for n in range(count):
+        start = time.time()
+        subprocess.call(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    times.sort()
+    return 1000 * times[len(times) // 2]
+
+# Cumulative import time in milliseconds of module alone, from -X importtime
+def importTime(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd=here,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000.0
+    return None
+
+parser = argparse.ArgumentParser(description="Time py6502 startup")
+parser.add_argument("-n", type=int, dest="count", default=20, metavar="N", help="runs of each command")
+parser.add_argument("filename", nargs="?", default=os.path.join(here, "test1.asm"), metavar="asmfile")
+args = parser.parse_args()
+
+work = tempfile.mkdtemp()
+try:
+    source = os.path.join(work, os.path.basename(args.filename))
+    shutil.copy(args.filename, source)
+    py6502 = [sys.executable, os.path.join(here, "py6502.py"), "-q"]
+    subprocess.call(py6502 + ["-a", source], stdout=subprocess.DEVNULL)
+    print ("Median of {0} runs:".format(args.count))
+    print ("  {0:<34} {1:7.1f} ms".format("python -c 'import argparse, json'",
+        timeRuns([sys.executable, "-c", "import argparse, json"], args.count, work)))
+    for option, name in (("-a", source), ("-d", source + ".out"), ("-x", source + ".out")):
+        print ("  {0:<34} {1:7.1f} ms".format("py6502.py " + option,
+            timeRuns(py6502 + [option, name], args.count, work)))
+    print ("Import times:")
+    for module in MODULES:
+        ms = importTime(module)
+        print ("  {0:<34} {1:>7}".format(module, "{0:.1f} ms".format(ms) if ms != None else "-"))
+finally:
+    shutil.rmtree(work)
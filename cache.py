@@ -0,0 +1,130 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# On-disk cache of assembler output
+#
+# Entries are JSON files named after a SHA-1 of the main source and its
+# absolute path, the settings that affect code generation and the
+# assembler itself, along with the peephole optimizer when it is used.
+# Each entry also records the absolute path and digest of every other file
+# read while assembling (includes) so a change to any of them invalidates
+# the entry.
+
+import os
+import json
+import hashlib
+import settings
+
+class Cache:
+
+    _directory = None
+    _salt = None
+    _peepholeSalt = None
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    # Hex digest of a file's contents, or None if it can't be read
+    def digest(self, filename):
+        try:
+            f = open(filename, 'rb')
+            data = f.read()
+            f.close()
+        except (IOError, OSError):
+            return None
+        return hashlib.sha1(data).hexdigest()
+
+    # Anything other than the source that changes the assembled output. The
+    # peephole optimizer only counts when it is used.
+    def salt(self, options=""):
+        if self._salt == None:
+            import assembler
+            self._salt = "{0}:{1}:{2}".format(settings.BASE_PC, settings.MEMORY_SIZE,
+                self.digest(assembler.__file__))
+        if "P" not in options:
+            return self._salt
+        if self._peepholeSalt == None:
+            import peephole
+            self._peepholeSalt = self._salt + "".join(":{0}".format(self.digest(name)) for name in peephole.sources())
+        return self._peepholeSalt
+
+    def key(self, kind, *parts):
+        h = hashlib.sha1(kind.encode())
+        for part in parts:
+            h.update(b"\0")
+            h.update(part.encode() if not isinstance(part, bytes) else part)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self._directory, key + ".json")
+
+    def load(self, key):
+        try:
+            f = open(self.path(key), "r")
+            entry = json.load(f)
+            f.close()
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    # Write via a temporary file so concurrent readers never see a partial entry
+    def store(self, key, entry):
+        try:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            tmp = "{0}.{1}.tmp".format(self.path(key), os.getpid())
+            f = open(tmp, "w")
+            json.dump(entry, f)
+            f.close()
+            getattr(os, "replace", os.rename)(tmp, self.path(key))
+        except (IOError, OSError):
+            pass
+
+    ################################
+    # Assembler output
+
+    # options distinguishes assembler settings given on the command line
+    def assemblyKey(self, filename, options):
+        source = self.digest(filename)
+        if source == None:
+            return None
+        return self.key("asm", source, os.path.abspath(filename), self.salt(options), options)
+
+    # Return the cached code for filename or None if it must be assembled
+    def lookupAssembly(self, filename, options=""):
+        key = self.assemblyKey(filename, options)
+        if key == None:
+            return None
+        entry = self.load(key)
+        if entry == None:
+            return None
+        for name, digest in entry["sources"]:
+            if self.digest(name) != digest:
+                return None
+        return entry["code"]
+
+    def storeAssembly(self, filename, code, sources, options=""):
+        key = self.assemblyKey(filename, options)
+        if key == None:
+            return
+        deps = [[os.path.abspath(name), self.digest(name)] for name in sources if name != filename]
+        self.store(key, { "code": code, "sources": deps })
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Thin client for server.py
+#
+#  python client.py [--socket PATH] [py6502.py options] <file>
+#    does what py6502.py does with -a, -d (with --flow and --entry), -x, -l, -O, --peephole and -q,
+#    but has the server do the work. Files are read and written here, except that the server reads
+#    the source for -a itself so includes are found. A run takes its input from --input FILE, not
+#    the keyboard, and stops after --budget instructions.
+
+import os
+import sys
+import json
+import socket
+import argparse
+import settings
+
+class Client:
+
+    _socket = None
+    _file = None
+
+    def __init__(self, path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._file = self._socket.makefile("rb")
+
+    # Send a request and return the reply
+    def request(self, **request):
+        self._socket.sendall((json.dumps(request) + "\n").encode())
+        line = self._file.readline()
+        if not line:
+            return {"ok": False, "error": "Server closed the connection"}
+        return json.loads(line.decode())
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+# The reply's results, or exit with its error
+def check(reply):
+    if not reply["ok"]:
+        print ("Error: " + reply["error"])
+        sys.exit(1)
+    return reply
+
+def load(infile):
+    try:
+        f = open(infile, "r")
+        code = json.load(f)
+        f.close()
+    except:
+        print ("Error: Could not decode input file: " + infile)
+        sys.exit()
+    return code
+
+parser = argparse.ArgumentParser(description="Send py6502 jobs to server.py")
+parser.add_argument("--socket", dest="socket", default=settings.SERVER_SOCKET, metavar="PATH", help="server socket")
+parser.add_argument("-a", "--assemble", action="store_true", dest="assemble", default=False, help="assemble the code in FILE")
+parser.add_argument("-d", "--disassemble", action="store_true", dest="disassemble", default=False, help="disassemble the code in FILE")
+parser.add_argument("--entry", action="append", dest="entries", default=None, metavar="ADDR", help="entry point in hex for --flow, may be repeated")
+parser.add_argument("--flow", action="store_true", dest="flow", default=False, help="disassemble by following the flow of control")
+parser.add_argument("--input", dest="input", default=None, metavar="FILE", help="take the program's input from the bytes of FILE")
+parser.add_argument("--budget", type=int, dest="budget", default=settings.SERVER_BUDGET, metavar="N", help="instructions allowed for -x")
+parser.add_argument("-l", "--listing", action="store_true", dest="listing", default=False, help="write an assembler listing to FILE.lst")
+parser.add_argument("-O", "--optimize", action="store_true", dest="optimize", default=False, help="optimize instruction encoding and branches")
+parser.add_argument("--peephole", action="store_true", dest="peephole", default=False, help="peephole optimize the assembled code")
+parser.add_argument("-q", "--quiet", action="store_true", dest="quiet", default=False, help="quiet mode")
+parser.add_argument("-x", "--execute", action="store_true", dest="execute", default=False, help="execute the code in FILE")
+parser.add_argument("filename", metavar="filename")
+args = parser.parse_args()
+
+try:
+    client = Client(args.socket)
+except (IOError, OSError):
+    print ("Error: Could not connect to the server at " + args.socket)
+    sys.exit(1)
+
+infile = args.filename
+code = None
+
+if args.assemble:
+    if not args.quiet:
+        print ("Assembling...")
+    reply = check(client.request(op="assemble", file=os.path.abspath(infile), optimize=args.optimize,
+                                 peephole=args.peephole, listing=args.listing))
+    for srcfile, linenum, message in reply["diagnostics"]:
+        print ("PY6502: {0} ({1}) : error: {2}".format(os.path.relpath(srcfile), linenum, message))
+    code = reply["code"]
+    if args.listing:
+        f = open(infile + ".lst", "w")
+        for line in reply["listing"]:
+            f.write(line + "\n")
+        f.close()
+    if reply["diagnostics"]:
+        sys.exit()
+    infile = infile + ".out"
+    f = open(infile, "w")
+    json.dump(code, f)
+    f.close()
+
+if args.disassemble:
+    if not args.quiet:
+        print ("Disassembling...")
+    if code == None:
+        code = load(infile)
+    try:
+        entries = [int(address.lstrip("$"), 16) for address in args.entries] if args.entries else None
+    except ValueError:
+        print ("Error: Invalid entry point")
+        sys.exit()
+    reply = check(client.request(op="disassemble", code=code, flow=args.flow, entries=entries))
+    sys.stdout.write("".join(line + "\n" for line in reply["lines"]))
+
+if args.execute:
+    if code == None:
+        code = load(infile)
+    text = ""
+    if args.input:
+        try:
+            f = open(args.input, "rb")
+            text = f.read().decode("latin-1")
+            f.close()
+        except IOError:
+            print ("Error: Could not read input file: " + args.input)
+            sys.exit()
+    if not args.quiet:
+        print ("Executing...")
+    reply = check(client.request(op="run", code=code, input=text, budget=args.budget))
+    sys.stdout.write(reply["output"])
+    if not args.quiet:
+        registers = reply["registers"]
+        flags = reply["flags"]
+        print ("Execution Completed")
+        print ("Processor state at end of execution:")
+        print ("\nRegisters:")
+        print ("  A = {0:02X}".format(registers["A"]))
+        print ("  X = {0:02X}".format(registers["X"]))
+        print ("  Y = {0:02X}".format(registers["Y"]))
+        print (" SP = {0:02X}".format(registers["S"]))
+        print ("Flags:")
+        print (" D{0} : C{1} : I{2} : N{3} : Z{4} : O{5}".format(flags["D"], flags["C"], flags["I"], flags["N"], flags["Z"], flags["O"]))
+
+client.close()
@@ -0,0 +1,198 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Code coverage of guest programs
+#
+# A simulator hook that keeps three bitmaps of the 64K address space, one
+# bit per address: instructions executed, conditional branches taken and
+# conditional branches not taken. Coverage files hold the three bitmaps so
+# the results of many runs are combined by ORing them together.
+#
+# Reports map addresses back to source lines through the assembler listing
+# and come as an lcov tracefile or as the listing with each line marked.
+
+import os
+import disassembler
+
+MAGIC = b"PY6502COV1\n"
+SIZE = 0x10000 // 8
+
+class Coverage:
+
+    _executed = None
+    _taken = None
+    _nottaken = None
+    _branch = -1
+    _branches = None
+
+    BIT = (1, 2, 4, 8, 16, 32, 64, 128)
+
+    def __init__(self):
+        self._executed = bytearray(SIZE)
+        self._taken = bytearray(SIZE)
+        self._nottaken = bytearray(SIZE)
+        self._branches = bytearray(256)
+        for opcode in range(256):
+            if disassembler.Disassembler.modes[opcode] == "Branch":
+                self._branches[opcode] = 1
+
+    ################################
+    # Simulator hook
+
+    def step(self, sim):
+        pc = sim._pc
+        if self._branch >= 0:
+            self.outcome(pc)
+        self._executed[pc >> 3] |= self.BIT[pc & 7]
+        if self._branches[sim._mem[pc]]:
+            self._branch = pc
+
+    def finish(self, sim):
+        if self._branch >= 0:
+            self.outcome(sim._pc)
+
+    # Record whether the branch at _branch went anywhere but the next
+    # instruction
+    def outcome(self, pc):
+        branch = self._branch
+        bitmap = self._nottaken if pc == branch + 2 else self._taken
+        bitmap[branch >> 3] |= self.BIT[branch & 7]
+        self._branch = -1
+
+    ################################
+    # Queries
+
+    def bit(self, bitmap, address):
+        return bitmap[address >> 3] & self.BIT[address & 7] != 0
+
+    def executed(self, address):
+        return self.bit(self._executed, address)
+
+    def taken(self, address):
+        return self.bit(self._taken, address)
+
+    def nottaken(self, address):
+        return self.bit(self._nottaken, address)
+
+    ################################
+    # Files
+
+    def merge(self, other):
+        for mine, theirs in ((self._executed, other._executed), (self._taken, other._taken),
+                             (self._nottaken, other._nottaken)):
+            merged = int.from_bytes(bytes(mine), "little") | int.from_bytes(bytes(theirs), "little")
+            mine[:] = merged.to_bytes(SIZE, "little")
+
+    def save(self, filename):
+        f = open(filename, "wb")
+        f.write(MAGIC + bytes(self._executed) + bytes(self._taken) + bytes(self._nottaken))
+        f.close()
+
+    # Merge in the coverage saved in filename. Returns False if it isn't a
+    # coverage file.
+    def load(self, filename):
+        f = open(filename, "rb")
+        data = f.read()
+        f.close()
+        if not data.startswith(MAGIC) or len(data) != len(MAGIC) + 3 * SIZE:
+            return False
+        other = Coverage()
+        start = len(MAGIC)
+        other._executed = bytearray(data[start:start + SIZE])
+        other._taken = bytearray(data[start + SIZE:start + 2 * SIZE])
+        other._nottaken = bytearray(data[start + 2 * SIZE:])
+        self.merge(other)
+        return True
+
+    ################################
+    # Reports. entries are the assembler's line information, as returned
+    # by Assembler.lineinfo().
+
+    # The instructions on a line: the offsets in its bytes where one starts
+    def instructions(self, code):
+        offsets = []
+        pc = 0
+        while pc < len(code):
+            offsets.append(pc)
+            pc += disassembler.Disassembler.lengths[code[pc]]
+        return offsets
+
+    def lcov(self, entries):
+        files = {}
+        for address, code, srcfile, linenum, text, instruction in entries:
+            if not code or not instruction:
+                continue
+            lines = files.setdefault(srcfile, {})
+            record = lines.setdefault(linenum, [0, []])
+            for offset in self.instructions(code):
+                pc = address + offset
+                record[0] |= self.executed(pc)
+                if disassembler.Disassembler.modes[code[offset]] == "Branch":
+                    record[1].append(pc)
+        out = []
+        for srcfile in sorted(files):
+            lines = files[srcfile]
+            out.append("TN:")
+            out.append("SF:" + os.path.abspath(srcfile))
+            block = 0
+            found = 0
+            hit = 0
+            for linenum in sorted(lines):
+                executed, branches = lines[linenum]
+                out.append("DA:{0},{1}".format(linenum, 1 if executed else 0))
+                for pc in branches:
+                    if self.executed(pc):
+                        taken = "1" if self.taken(pc) else "0"
+                        nottaken = "1" if self.nottaken(pc) else "0"
+                    else:
+                        taken = nottaken = "-"
+                    out.append("BRDA:{0},{1},0,{2}".format(linenum, block, taken))
+                    out.append("BRDA:{0},{1},1,{2}".format(linenum, block, nottaken))
+                    found += 2
+                    hit += (taken == "1") + (nottaken == "1")
+                    block += 1
+            out.append("BRF:{0}".format(found))
+            out.append("BRH:{0}".format(hit))
+            out.append("LF:{0}".format(len(lines)))
+            out.append("LH:{0}".format(sum(1 for l in lines.values() if l[0])))
+            out.append("end_of_record")
+        return out
+
+    # The listing with a mark on every line that holds instructions: "+"
+    # executed, "-" never executed, and for branches whether they were
+    # taken (T) or fell through (N)
+    def listing(self, entries):
+        out = []
+        for address, code, srcfile, linenum, text, instruction in entries:
+            mark = "      "
+            if code and instruction:
+                executed = False
+                outcomes = ""
+                for offset in self.instructions(code):
+                    pc = address + offset
+                    executed |= self.executed(pc)
+                    if disassembler.Disassembler.modes[code[offset]] == "Branch":
+                        outcomes += ("T" if self.taken(pc) else "") + ("N" if self.nottaken(pc) else "")
+                        outcomes = outcomes or "-"
+                mark = "{0} {1:<4}".format("+" if executed else "-", outcomes)
+            out.append("{0}{1:04X}  {2:>5}  {3}".format(mark, address, linenum, text))
+        return out
@@ -21,254 +21,559 @@
 
 ################################
 # 6502 Disassembler class
+#
+# Decoding and formatting are separate steps. instructions() is a generator
+# that yields one Instruction record per instruction:
+#
+#     address   where the instruction is loaded
+#     raw       its bytes (fewer than the mode needs if the code ends first)
+#     mnemonic  "LDA", ".SYS", or ".BYTE" for a byte that isn't an opcode
+#     mode      addressing mode, one of the keys of Disassembler.sizes
+#     operand   the operand value, or None
+#     target    the address a branch, JMP or JSR goes to, or None
+#
+# A Formatter turns a record into a line of text. Any object with a
+# format(instruction) method can be used in its place.
+#
+# source() disassembles by following the flow of control instead, from the
+# entry point and the 6502 vectors, and returns assembler source with
+# labels for every target and .BYTE lines for whatever is never reached.
 
+import sys
+import json
+import collections
 import settings
+import utilities
+
+Instruction = collections.namedtuple("Instruction", "address raw mnemonic mode operand target")
+
+class Formatter:
+
+    operands = {
+        "Imp": "{1}",
+        "Data": ".BYTE {2}",
+        "Imm": "{1} #${2:02X}",
+        "ZPage": "{1} ${2:02X}",
+        "ZPageX": "{1} ${2:02X},X",
+        "ZPageY": "{1} ${2:02X},Y",
+        "Abs": "{1} ${2:04X}",
+        "AbsX": "{1} ${2:04X},X",
+        "AbsY": "{1} ${2:04X},Y",
+        "IndX": "{1} (${2:02X},X)",
+        "IndY": "{1} (${2:02X}),Y",
+        "Branch": "{1} {3:04X}",
+        "Jump": "{1} {3:04X}"
+        }
+
+    # Address and raw bytes for each instruction length
+    layouts = {
+        1: "{0:04X}: {4:02X}       ",
+        2: "{0:04X}: {4:02X} {5:02X}    ",
+        3: "{0:04X}: {4:02X} {5:02X} {6:02X} "
+        }
+
+    # One format string per mode and length, so each line takes a single
+    # format() call
+    _templates = None
+
+    def __init__(self):
+        self._templates = {}
+
+    def format(self, ins):
+        raw = ins.raw
+        key = (ins.mode, len(raw))
+        template = self._templates.get(key)
+        if template == None:
+            template = self.layouts[len(raw)] + self.operands[ins.mode]
+            self._templates[key] = template
+        operand = hex(ins.operand) if ins.mode == "Data" else ins.operand
+        return template.format(ins.address, ins.mnemonic, operand, ins.target, *raw)
+
+    # Format every instruction in data straight from the decode tables,
+    # without building records. Gives the same text as format().
+    def lines(self, data, base=0):
+        templates = self.opcodeTemplates()
+        lengths = Disassembler.lengths
+        modes = Disassembler.modes
+        end = len(data)
+        pc = 0
+        while pc < end:
+            opcode = data[pc]
+            size = lengths[opcode]
+            if size == 1:
+                yield templates[opcode].format(base + pc)
+            elif pc + size > end:
+                yield self.format(Disassembler().decode(data, pc, base))
+            elif size == 2:
+                operand = data[pc + 1]
+                target = None
+                if modes[opcode] == "Branch":
+                    target = base + pc + 1 + (operand if operand < 0x80 else operand - 0x100)
+                yield templates[opcode].format(base + pc, operand, target, operand)
+            else:
+                lo = data[pc + 1]
+                hi = data[pc + 2]
+                operand = lo + (hi << 8)
+                yield templates[opcode].format(base + pc, operand, operand, lo, hi)
+            pc += size
+
+    # Format strings for each opcode with the mnemonic and opcode byte filled
+    # in; they take the address, operand, target and operand bytes
+    def opcodeTemplates(self):
+        templates = []
+        for opcode in range(256):
+            mnemonic = Disassembler.mnemonics[opcode]
+            mode = Disassembler.modes[opcode]
+            size = Disassembler.lengths[opcode]
+            layout = self.layouts[size].replace("{4:02X}", "{0:02X}".format(opcode))
+            layout = layout.replace("{6:02X}", "{4:02X}").replace("{5:02X}", "{3:02X}")
+            if mode == "Data":
+                text = ".BYTE " + hex(opcode)
+            else:
+                text = self.operands[mode].replace("{1}", mnemonic)
+                text = text.replace("{2", "{1").replace("{3", "{2")
+            templates.append(layout + text)
+        return templates
 
 class Disassembler:
 
-    # Disassemble all the code to the console
+    _formatter = None
+    _cache = None
+
+    # Flow analyses by image and entry points, shared by every Disassembler
+    # in the process
+    _flows = {}
+
+    # Vectors followed if the image covers them: NMI, RESET and IRQ/BRK
+    VECTORS = (0xFFFA, 0xFFFC, 0xFFFE)
+
+    # cache, if given, is a cache.Cache that also keeps flow analyses
+    # between runs
+    def __init__(self, formatter=None, cache=None):
+        self._formatter = formatter if formatter != None else Formatter()
+        self._cache = cache
+
+    # Disassemble all the code to the console, one segment at a time. Lines
+    # are written in batches rather than one print each.
     def disassemble(self, code):
-        self._code = code
-        self._pc = 0
-        while self._pc < len(self._code):
-            self.disassemble_one()
-
-    # Disassemble one instruction in code[] at pc offset            
-    def disassemble_line(self, code, pc):
-        self._code = code
-        self._pc = pc
-        self.disassemble_one()
-        return self._pc
-        
-    def disassemble_one(self):
-        opcode = self._code[self._pc]
-        self._pc += 1
-        if opcode in self.opcodes:
-            args = self.opcodes[opcode]
-            assert len(args) == 2
-            args[1](self, args[0])
-        else:
-            self.outputNone(".BYTE " + hex(opcode))
+        for address, data in utilities.segments(code):
+            if hasattr(self._formatter, "lines"):
+                text = self._formatter.lines(data, address)
+            else:
+                text = (self._formatter.format(ins) for ins in self.bulk(data, address))
+            lines = []
+            for line in text:
+                lines.append(line)
+                if len(lines) >= 1024:
+                    sys.stdout.write("\n".join(lines) + "\n")
+                    lines = []
+            if lines:
+                sys.stdout.write("\n".join(lines) + "\n")
 
-    ################################
-    # Output
+    # Yield an Instruction for each instruction in the code, one segment
+    # at a time
+    def instructions(self, code):
+        for address, data in utilities.segments(code):
+            for ins in self.bulk(data, address):
+                yield ins
+
+    # Offsets of the instructions in data (bytes, bytearray, memoryview or
+    # a list of byte values), found in one pass over the length table
+    def split(self, data):
+        lengths = self.lengths
+        offsets = []
+        pc = 0
+        end = len(data)
+        while pc < end:
+            offsets.append(pc)
+            pc += lengths[data[pc]]
+        return offsets
+
+    # Decode every instruction in data, loaded at base. This is decode()
+    # with the tables held in locals, for large images.
+    def bulk(self, data, base=0):
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(bytearray(data))
+        mnemonics = self.mnemonics
+        modes = self.modes
+        lengths = self.lengths
+        end = len(data)
+        pc = 0
+        while pc < end:
+            opcode = data[pc]
+            size = lengths[opcode]
+            mode = modes[opcode]
+            raw = data[pc:pc + size]
+            operand = None
+            target = None
+            if size == 2:
+                operand = raw[1] if len(raw) > 1 else 0
+                if mode == "Branch":
+                    target = base + pc + 1 + (operand if operand < 0x80 else operand - 0x100)
+            elif size == 3:
+                operand = raw[1] + (raw[2] << 8) if len(raw) > 2 else 0
+                if mode == "Jump":
+                    target = operand
+            elif mode == "Data":
+                operand = opcode
+            yield Instruction(base + pc, bytes(raw), mnemonics[opcode], mode, operand, target)
+            pc += size
+
+    # Disassemble one instruction in code[] at pc offset to the console and
+    # return the offset of the next. Code is taken to be loaded at base, so
+    # memory images are shown at their real address.
+    def disassemble_line(self, code, pc, base=0):
+        ins = self.decode(code, pc, base)
+        print (self._formatter.format(ins))
+        return pc + len(ins.raw)
+
+    # Decode the instruction at offset pc of code[]
+    def decode(self, code, pc, base=0):
+        opcode = code[pc]
+        mode = self.modes[opcode]
+        size = self.lengths[opcode]
+        raw = bytes(bytearray(code[pc:pc + size]))
+        operand = opcode if mode == "Data" else None
+        target = None
+        if size == 2:
+            operand = raw[1] if len(raw) > 1 else 0
+        elif size == 3:
+            operand = raw[1] + (raw[2] << 8) if len(raw) > 2 else 0
+        if mode == "Branch":
+            target = base + pc + 1 + self.signExtend(operand)
+        elif mode == "Jump":
+            target = operand
+        return Instruction(base + pc, raw, self.mnemonics[opcode], mode, operand, target)
 
     def signExtend(self, r):
         return r if r < 0x80 else r - 0x100
 
-    def num8(self):
-        return self._code[self._pc]
-
-    def num16(self):
-        if self._pc + 1 >= len(self._code):
-            return 0
-        return self._code[self._pc] + (0x100 * self._code[self._pc + 1])
-
-    def output(self, size, str):
-        str_out = []
-        off = self._pc - 1   # Opcode is at PC-1 when we get here
-        end = len(self._code)
-        str_out.append("{0:04X}: ".format(off + settings.BASE_PC))
-        str_out.append("{0:02X} ".format(self._code[off]))
-        str_out.append("{0:02X} ".format(self._code[off + 1]) if size > 0 and off + 1 < end else "   ")
-        str_out.append("{0:02X} ".format(self._code[off + 2]) if size > 1 and off + 2 < end else "   ")
-        str_out.append(str)
-        print (''.join(str_out))
-        self._pc += size
-
-    def outputNone(self, str):
-        self.output(0, str)
-
-    def outputImm(self, str):
-        self.output(1, "{0} #${1:02X}".format(str, self.num8()))
-
-    def outputZPage(self, str):
-        self.output(1, "{0} ${1:02X}".format(str, self.num8()))
-
-    def outputZPageX(self, str):
-        self.output(1, "{0} ${1:02X},X".format(str, self.num8()))
-
-    def outputZPageY(self, str):
-        self.output(1, "{0} ${1:02X},Y".format(str, self.num8()))
-
-    def outputAbs(self, str):
-        self.output(2, "{0} ${1:04X}".format(str, self.num16()))
-
-    def outputAbsX(self, str):
-        self.output(2, "{0} ${1:04X},X".format(str, self.num16()))
-
-    def outputAbsY(self, str):
-        self.output(2, "{0} ${1:04X},Y".format(str, self.num16()))
-
-    def outputIndX(self, str):
-        self.output(1, "{0} (${1:02X},X)".format(str, self.num8()))
-
-    def outputIndY(self, str):
-        self.output(1, "{0} (${1:02X}),Y".format(str, self.num8()))
-        
-    def outputBranch(self, str):
-        self.output(1, "{0} {1:04X}".format(str, self._pc + self.signExtend(self.num8())))
-        
-    def outputJump(self, str):
-        self.output(2, "{0} {1:04X}".format(str, self.num16()))
-        
+    ################################
+    # Recursive traversal
+
+    # Find the instructions reachable from the entry points. Returns a
+    # dictionary from the address of each instruction to its length and
+    # one from every address that needs a label to the label.
+    def analyze(self, code, entries=None):
+        segments = utilities.segments(code)
+        if entries == None:
+            entries = [self.entry(segments)]
+        import hashlib
+        key = hashlib.sha1(json.dumps([segments, sorted(entries)]).encode()).hexdigest()
+        if key in self._flows:
+            return self._flows[key]
+        flow = None
+        if self._cache != None:
+            entry = self._cache.load(self._cache.key("flow", key))
+            if entry != None:
+                flow = (dict((a, n) for a, n in entry["starts"]), dict((a, l) for a, l in entry["labels"]))
+        if flow == None:
+            flow = self.traverse(segments, entries)
+            if self._cache != None:
+                self._cache.store(self._cache.key("flow", key),
+                    { "starts": sorted(flow[0].items()), "labels": sorted(flow[1].items()) })
+        self._flows[key] = flow
+        return flow
+
+    # Where the simulator would start running the code
+    def entry(self, segments):
+        for address, data in segments:
+            if address <= settings.BASE_PC < address + len(data):
+                return settings.BASE_PC
+        return segments[0][0] if segments else settings.BASE_PC
+
+    def traverse(self, segments, entries):
+        mem, loaded = self.memory(segments)
+        entries = list(entries)
+        for vector in self.VECTORS:
+            if loaded[vector] and loaded[vector + 1]:
+                entries.append(mem[vector] + (mem[vector + 1] << 8))
+
+        starts = {}
+        owned = bytearray(0x10003)
+        targets = set(entries)
+        references = set()
+        work = list(entries)
+        while work:
+            pc = work.pop()
+            while loaded[pc] and pc not in starts and not owned[pc]:
+                opcode = mem[pc]
+                mode = self.modes[opcode]
+                size = self.lengths[opcode]
+                if mode == "Data" or 0 in loaded[pc:pc + size] or 1 in owned[pc:pc + size]:
+                    break
+                starts[pc] = size
+                owned[pc:pc + size] = b"\x01" * size
+                mnemonic = self.mnemonics[opcode]
+                if mode == "Branch":
+                    target = (pc + 1 + self.signExtend(mem[pc + 1])) & 0xFFFF
+                    targets.add(target)
+                    work.append(target)
+                elif mode == "Jump":
+                    target = mem[pc + 1] + (mem[pc + 2] << 8)
+                    targets.add(target)
+                    work.append(target)
+                elif mode in ("Abs", "AbsX", "AbsY"):
+                    references.add(mem[pc + 1] + (mem[pc + 2] << 8))
+                if mnemonic in ("JMP", "RTS", "RTI", "BRK"):
+                    break
+                pc += size
+
+        # Label branch targets and data the code refers to, unless they
+        # fall inside an instruction
+        labels = {}
+        for address in targets | references:
+            if loaded[address] and (address in starts or not owned[address]):
+                labels[address] = "L{0:04X}".format(address)
+        return starts, labels
+
+    def memory(self, segments):
+        mem = bytearray(0x10003)
+        loaded = bytearray(0x10003)
+        for address, data in segments:
+            mem[address:address + len(data)] = bytearray(data)
+            loaded[address:address + len(data)] = b"\x01" * len(data)
+        return mem, loaded
+
+    # Assembler source for the code: an origin for each run of loaded memory,
+    # the instructions found by analyze() and .BYTE lines for the rest.
+    def source(self, code, entries=None):
+        segments = utilities.segments(code)
+        starts, labels = self.analyze(segments, entries)
+        mem, loaded = self.memory(segments)
+        lines = []
+        pc = 0
+        while pc < 0x10000:
+            if not loaded[pc]:
+                pc += 1
+                continue
+            lines.append("        * = ${0:04X}".format(pc))
+            while pc < 0x10000 and loaded[pc]:
+                label = labels.get(pc, "")
+                if pc in starts:
+                    size = starts[pc]
+                    lines.append("{0:<8}{1}".format(label, self.sourceLine(mem, pc, labels)))
+                    pc += size
+                    continue
+                data = []
+                while pc < 0x10000 and loaded[pc] and pc not in starts and len(data) < 8:
+                    if data and pc in labels:
+                        break
+                    data.append("${0:02X}".format(mem[pc]))
+                    pc += 1
+                lines.append("{0:<8}.BYTE {1}".format(label, ",".join(data)))
+        return lines
+
+    def sourceLine(self, mem, pc, labels):
+        opcode = mem[pc]
+        mnemonic = self.mnemonics[opcode]
+        mode = self.modes[opcode]
+        operand = mem[pc + 1]
+        if mode in ("Abs", "AbsX", "AbsY", "Jump"):
+            operand += mem[pc + 2] << 8
+            index = self.indexes.get(mode, "")
+            if operand <= 0xFF and (mnemonic, "ZPage" + mode[3:]) in self.encodings:
+                # The assembler would pick the zero page form
+                return ".BYTE ${0:02X},${1:02X},${2:02X} ; {3} ${4:04X}{5}".format(opcode,
+                    mem[pc + 1], mem[pc + 2], mnemonic, operand, index)
+            return "{0} {1}{2}".format(mnemonic, labels.get(operand, "${0:04X}".format(operand)), index)
+        if mode == "Branch":
+            target = (pc + 1 + self.signExtend(operand)) & 0xFFFF
+            return "{0} {1}".format(mnemonic, labels.get(target, "${0:02X}".format(operand)))
+        if mode == "Imp":
+            return mnemonic
+        return Formatter.operands[mode].format(None, mnemonic, operand, None)
+
+    indexes = { "AbsX": ",X", "AbsY": ",Y" }
+
+    # Instruction length for each addressing mode
+    sizes = {
+        "Imp": 1,
+        "Data": 1,
+        "Imm": 2,
+        "ZPage": 2,
+        "ZPageX": 2,
+        "ZPageY": 2,
+        "IndX": 2,
+        "IndY": 2,
+        "Branch": 2,
+        "Abs": 3,
+        "AbsX": 3,
+        "AbsY": 3,
+        "Jump": 3
+        }
+
     ################################
     # List of opcodes
 
     opcodes = {
-        0x00: ("BRK", outputNone),
-        0x01: ("ORA", outputIndX),
-        0x05: ("ORA", outputZPage),
-        0x06: ("ASL", outputZPage),
-        0x08: ("PHP", outputNone),
-        0x09: ("ORA", outputImm),
-        0x0A: ("LDY", outputImm),
-        0x0D: ("ORA", outputAbs),
-        0x0E: ("ASL", outputAbs),
-        0x10: ("BPL", outputBranch),
-        0x11: ("ORA", outputIndY),
-        0x15: ("ORA", outputZPageX),
-        0x16: ("ASL", outputZPageX),
-        0x18: ("CLC", outputNone),
-        0x19: ("ORA", outputAbsY),
-        0x1D: ("ORA", outputAbsX),
-        0x1E: ("ASL", outputAbsX),
-        0x20: ("JSR", outputJump),
-        0x21: ("AND", outputIndX),
-        0x24: ("BIT", outputZPage),
-        0x25: ("AND", outputZPage),
-        0x26: ("ROL", outputZPage),
-        0x28: ("PLP", outputNone),
-        0x29: ("AND", outputImm),
-        0x2A: ("ROL", outputNone),
-        0x2C: ("BIT", outputAbs),
-        0x2D: ("AND", outputAbs),
-        0x2E: ("ROL", outputAbs),
-        0x30: ("BMI", outputBranch),
-        0x31: ("AND", outputIndY),
-        0x35: ("AND", outputZPageX),
-        0x36: ("ROL", outputZPageX),
-        0x38: ("SEC", outputNone),
-        0x39: ("AND", outputAbsY),
-        0x3D: ("AND", outputAbsX),
-        0x3E: ("ROL", outputAbsX),
-        0x40: ("RTI", outputNone),
-        0x41: ("EOR", outputIndX),
-        0x45: ("EOR", outputZPage),
-        0x46: ("LSR", outputZPage),
-        0x48: ("PHA", outputNone),
-        0x49: ("EOR", outputImm),
-        0x4A: ("LSR", outputNone),
-        0x4C: ("JMP", outputJump),
-        0x4D: ("EOR", outputAbs),
-        0x4E: ("LSR", outputAbs),
-        0x50: ("BVC", outputBranch),
-        0x51: ("EOR", outputIndY),
-        0x55: ("EOR", outputZPageX),
-        0x56: ("LSR", outputZPageX),
-        0x58: ("CLI", outputNone),
-        0x59: ("EOR", outputAbsY),
-        0x5A: ("PHY", outputNone),
-        0x5D: ("EOR", outputAbsX),
-        0x5E: ("LSR", outputAbsX),
-        0x60: ("RTS", outputNone),
-        0x61: ("ADC", outputIndX),
-        0x65: ("ADC", outputZPage),
-        0x66: ("ROR", outputZPage),
-        0x68: ("PLA", outputNone),
-        0x69: ("ADC", outputImm),
-        0x6A: ("ROR", outputNone),
-        0x6D: ("ADC", outputAbs),
-        0x6E: ("ROR", outputAbs),
-        0x70: ("BVS", outputBranch),
-        0x71: ("ADC", outputIndY),
-        0x75: ("ADC", outputZPageX),
-        0x76: ("ROR", outputZPageX),
-        0x78: ("SEI", outputNone),
-        0x79: ("ADC", outputAbsY),
-        0x7A: ("PLY", outputNone),
-        0x7D: ("ADC", outputAbsX),
-        0x7E: ("ROR", outputAbsX),
-        0x81: ("STA", outputIndX),
-        0x84: ("STY", outputZPage),
-        0x85: ("STA", outputZPage),
-        0x86: ("STX", outputZPage),
-        0x88: ("DEY", outputNone),
-        0x8A: ("TXA", outputNone),
-        0x8C: ("STY", outputAbs),
-        0x8D: ("STA", outputAbs),
-        0x8E: ("STX", outputAbs),
-        0x90: ("BCC", outputBranch),
-        0x91: ("STA", outputIndY),
-        0x94: ("STY", outputZPageX),
-        0x95: ("STA", outputZPageX),
-        0x96: ("STX", outputZPageY),
-        0x98: ("TYA", outputNone),
-        0x99: ("STA", outputAbsY),
-        0x9A: ("TXS", outputNone),
-        0x9D: ("STA", outputAbsX),
-        0xA0: ("LDY", outputImm),
-        0xA1: ("LDA", outputIndX),
-        0xA2: ("LDX", outputImm),
-        0xA4: ("LDY", outputZPage),
-        0xA5: ("LDA", outputZPage),
-        0xA6: ("LDX", outputZPage),
-        0xA8: ("TAY", outputNone),
-        0xA9: ("LDA", outputImm),
-        0xAA: ("TAX", outputNone),
-        0xAC: ("LDY", outputAbs),
-        0xAD: ("LDA", outputAbs),
-        0xAE: ("LDX", outputAbs),
-        0xB0: ("BCS", outputBranch),
-        0xB1: ("LDA", outputIndY),
-        0xB4: ("LDY", outputZPageX),
-        0xB5: ("LDA", outputZPageX),
-        0xB6: ("LDX", outputZPageY),
-        0xB8: ("CLV", outputNone),
-        0xB9: ("LDA", outputAbsY),
-        0xBA: ("TSX", outputNone),
-        0xBC: ("LDY", outputAbsX),
-        0xBD: ("LDA", outputAbsX),
-        0xBE: ("LDX", outputAbsY),
-        0xC0: ("CPY", outputImm),
-        0xC1: ("CMP", outputIndX),
-        0xC4: ("CPY", outputZPage),
-        0xC5: ("CMP", outputZPage),
-        0xC6: ("DEC", outputZPage),
-        0xC8: ("INY", outputNone),
-        0xC9: ("CMP", outputImm),
-        0xCA: ("DEX", outputNone),
-        0xCC: ("CPY", outputAbs),
-        0xCD: ("CMP", outputAbs),
-        0xCE: ("DEC", outputAbs),
-        0xD0: ("BNE", outputBranch),
-        0xD1: ("CMP", outputIndY),
-        0xD5: ("CMP", outputZPageX),
-        0xD6: ("DEC", outputZPageX),
-        0xD8: ("CLD", outputNone),
-        0xD9: ("CMP", outputAbsY),
-        0xDA: ("PHX", outputNone),
-        0xDD: ("CMP", outputAbsX),
-        0xDE: ("DEC", outputAbsX),
-        0xE0: ("CPX", outputImm),
-        0xE1: ("SBC", outputIndX),
-        0xE4: ("CPX", outputZPage),
-        0xE5: ("SBC", outputZPage),
-        0xE6: ("INC", outputZPage),
-        0xE8: ("INX", outputNone),
-        0xE9: ("SBC", outputImm),
-        0xEA: ("NOP", outputNone),
-        0xEC: ("CPX", outputAbs),
-        0xED: ("SBC", outputAbs),
-        0xEE: ("INC", outputAbs),
-        0xF0: ("BEQ", outputBranch),
-        0xF1: ("SBC", outputIndY),
-        0xF5: ("SBC", outputZPageX),
-        0xF6: ("INC", outputZPageX),
-        0xF8: ("SED", outputNone),
-        0xF9: ("SBC", outputAbsY),
-        0xFA: ("PLX", outputNone),
-        0xFD: ("SBC", outputAbsX),
-        0xFE: ("INC", outputAbsX),
-        0xFF: (".SYS", outputImm)
+        0x00: ("BRK", "Imp"),
+        0x01: ("ORA", "IndX"),
+        0x05: ("ORA", "ZPage"),
+        0x06: ("ASL", "ZPage"),
+        0x08: ("PHP", "Imp"),
+        0x09: ("ORA", "Imm"),
+        0x0A: ("ASL", "Imp"),
+        0x0D: ("ORA", "Abs"),
+        0x0E: ("ASL", "Abs"),
+        0x10: ("BPL", "Branch"),
+        0x11: ("ORA", "IndY"),
+        0x15: ("ORA", "ZPageX"),
+        0x16: ("ASL", "ZPageX"),
+        0x18: ("CLC", "Imp"),
+        0x19: ("ORA", "AbsY"),
+        0x1D: ("ORA", "AbsX"),
+        0x1E: ("ASL", "AbsX"),
+        0x20: ("JSR", "Jump"),
+        0x21: ("AND", "IndX"),
+        0x24: ("BIT", "ZPage"),
+        0x25: ("AND", "ZPage"),
+        0x26: ("ROL", "ZPage"),
+        0x28: ("PLP", "Imp"),
+        0x29: ("AND", "Imm"),
+        0x2A: ("ROL", "Imp"),
+        0x2C: ("BIT", "Abs"),
+        0x2D: ("AND", "Abs"),
+        0x2E: ("ROL", "Abs"),
+        0x30: ("BMI", "Branch"),
+        0x31: ("AND", "IndY"),
+        0x35: ("AND", "ZPageX"),
+        0x36: ("ROL", "ZPageX"),
+        0x38: ("SEC", "Imp"),
+        0x39: ("AND", "AbsY"),
+        0x3D: ("AND", "AbsX"),
+        0x3E: ("ROL", "AbsX"),
+        0x40: ("RTI", "Imp"),
+        0x41: ("EOR", "IndX"),
+        0x45: ("EOR", "ZPage"),
+        0x46: ("LSR", "ZPage"),
+        0x48: ("PHA", "Imp"),
+        0x49: ("EOR", "Imm"),
+        0x4A: ("LSR", "Imp"),
+        0x4C: ("JMP", "Jump"),
+        0x4D: ("EOR", "Abs"),
+        0x4E: ("LSR", "Abs"),
+        0x50: ("BVC", "Branch"),
+        0x51: ("EOR", "IndY"),
+        0x55: ("EOR", "ZPageX"),
+        0x56: ("LSR", "ZPageX"),
+        0x58: ("CLI", "Imp"),
+        0x59: ("EOR", "AbsY"),
+        0x5A: ("PHY", "Imp"),
+        0x5D: ("EOR", "AbsX"),
+        0x5E: ("LSR", "AbsX"),
+        0x60: ("RTS", "Imp"),
+        0x61: ("ADC", "IndX"),
+        0x65: ("ADC", "ZPage"),
+        0x66: ("ROR", "ZPage"),
+        0x68: ("PLA", "Imp"),
+        0x69: ("ADC", "Imm"),
+        0x6A: ("ROR", "Imp"),
+        0x6D: ("ADC", "Abs"),
+        0x6E: ("ROR", "Abs"),
+        0x70: ("BVS", "Branch"),
+        0x71: ("ADC", "IndY"),
+        0x75: ("ADC", "ZPageX"),
+        0x76: ("ROR", "ZPageX"),
+        0x78: ("SEI", "Imp"),
+        0x79: ("ADC", "AbsY"),
+        0x7A: ("PLY", "Imp"),
+        0x7D: ("ADC", "AbsX"),
+        0x7E: ("ROR", "AbsX"),
+        0x81: ("STA", "IndX"),
+        0x84: ("STY", "ZPage"),
+        0x85: ("STA", "ZPage"),
+        0x86: ("STX", "ZPage"),
+        0x88: ("DEY", "Imp"),
+        0x8A: ("TXA", "Imp"),
+        0x8C: ("STY", "Abs"),
+        0x8D: ("STA", "Abs"),
+        0x8E: ("STX", "Abs"),
+        0x90: ("BCC", "Branch"),
+        0x91: ("STA", "IndY"),
+        0x94: ("STY", "ZPageX"),
+        0x95: ("STA", "ZPageX"),
+        0x96: ("STX", "ZPageY"),
+        0x98: ("TYA", "Imp"),
+        0x99: ("STA", "AbsY"),
+        0x9A: ("TXS", "Imp"),
+        0x9D: ("STA", "AbsX"),
+        0xA0: ("LDY", "Imm"),
+        0xA1: ("LDA", "IndX"),
+        0xA2: ("LDX", "Imm"),
+        0xA4: ("LDY", "ZPage"),
+        0xA5: ("LDA", "ZPage"),
+        0xA6: ("LDX", "ZPage"),
+        0xA8: ("TAY", "Imp"),
+        0xA9: ("LDA", "Imm"),
+        0xAA: ("TAX", "Imp"),
+        0xAC: ("LDY", "Abs"),
+        0xAD: ("LDA", "Abs"),
+        0xAE: ("LDX", "Abs"),
+        0xB0: ("BCS", "Branch"),
+        0xB1: ("LDA", "IndY"),
+        0xB4: ("LDY", "ZPageX"),
+        0xB5: ("LDA", "ZPageX"),
+        0xB6: ("LDX", "ZPageY"),
+        0xB8: ("CLV", "Imp"),
+        0xB9: ("LDA", "AbsY"),
+        0xBA: ("TSX", "Imp"),
+        0xBC: ("LDY", "AbsX"),
+        0xBD: ("LDA", "AbsX"),
+        0xBE: ("LDX", "AbsY"),
+        0xC0: ("CPY", "Imm"),
+        0xC1: ("CMP", "IndX"),
+        0xC4: ("CPY", "ZPage"),
+        0xC5: ("CMP", "ZPage"),
+        0xC6: ("DEC", "ZPage"),
+        0xC8: ("INY", "Imp"),
+        0xC9: ("CMP", "Imm"),
+        0xCA: ("DEX", "Imp"),
+        0xCC: ("CPY", "Abs"),
+        0xCD: ("CMP", "Abs"),
+        0xCE: ("DEC", "Abs"),
+        0xD0: ("BNE", "Branch"),
+        0xD1: ("CMP", "IndY"),
+        0xD5: ("CMP", "ZPageX"),
+        0xD6: ("DEC", "ZPageX"),
+        0xD8: ("CLD", "Imp"),
+        0xD9: ("CMP", "AbsY"),
+        0xDA: ("PHX", "Imp"),
+        0xDD: ("CMP", "AbsX"),
+        0xDE: ("DEC", "AbsX"),
+        0xE0: ("CPX", "Imm"),
+        0xE1: ("SBC", "IndX"),
+        0xE4: ("CPX", "ZPage"),
+        0xE5: ("SBC", "ZPage"),
+        0xE6: ("INC", "ZPage"),
+        0xE8: ("INX", "Imp"),
+        0xE9: ("SBC", "Imm"),
+        0xEA: ("NOP", "Imp"),
+        0xEC: ("CPX", "Abs"),
+        0xED: ("SBC", "Abs"),
+        0xEE: ("INC", "Abs"),
+        0xF0: ("BEQ", "Branch"),
+        0xF1: ("SBC", "IndY"),
+        0xF5: ("SBC", "ZPageX"),
+        0xF6: ("INC", "ZPageX"),
+        0xF8: ("SED", "Imp"),
+        0xF9: ("SBC", "AbsY"),
+        0xFA: ("PLX", "Imp"),
+        0xFD: ("SBC", "AbsX"),
+        0xFE: ("INC", "AbsX"),
+        0xFF: (".SYS", "Imm")
         }
+
+# Flat 256 entry decode tables built from the opcode list. Bytes that
+# aren't opcodes decode as a one byte .BYTE.
+Disassembler.mnemonics = [".BYTE"] * 256
+Disassembler.modes = ["Data"] * 256
+Disassembler.lengths = [1] * 256
+for opcode, (mnemonic, mode) in Disassembler.opcodes.items():
+    Disassembler.mnemonics[opcode] = mnemonic
+    Disassembler.modes[opcode] = mode
+    Disassembler.lengths[opcode] = Disassembler.sizes[mode]
+
+# (mnemonic, mode) pairs that have an encoding, to tell when the assembler
+# would choose a different one
+Disassembler.encodings = set(Disassembler.opcodes.values())
@@ -0,0 +1,271 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Coverage guided fuzzing of guest input
+#
+# The bytes a program reads with .SYS #0 are the fuzz input. The program is
+# run once up to its first read and every case starts from a snapshot taken
+# there. Cases are mutations of the inputs in the corpus, run over a pool of
+# processes with the code coverage bitmaps as feedback: an input that
+# executes an instruction or takes a branch edge no earlier input did joins
+# the corpus.
+#
+# A case crashes if it faults (an address outside memory, an unknown opcode
+# or a stack overflow or underflow) or breaks the simulator, and hangs if it
+# gets stuck in an idle loop or runs past its instruction budget. Running out
+# of input ends a case normally, and python py6502.py -x --input FILE runs
+# the program on a saved input. Inputs are kept in the output directory:
+# the corpus in queue, crashing inputs in crashes and hanging ones in hangs,
+# one for each place a failure happens.
+
+import os
+import sys
+import time
+import random
+import multiprocessing
+import replay
+import simulator
+import stackusage
+import codecoverage
+
+INTERESTING = (0x00, 0x01, 0x0A, 0x0D, 0x20, 0x2C, 0x30, 0x39, 0x41, 0x5A, 0x7F, 0x80, 0xFE, 0xFF)
+
+class Ready(Exception):
+    pass
+
+# Coverage that also stops the case when its budget is spent or it hits a
+# BRK, which would otherwise start the interactive trace
+class Feedback(codecoverage.Coverage):
+
+    _budget = 0
+
+    def __init__(self, budget):
+        codecoverage.Coverage.__init__(self)
+        self._budget = budget
+
+    def step(self, sim):
+        codecoverage.Coverage.step(self, sim)
+        if sim._trace:
+            raise simulator.Fault("BRK before ${0:04X}".format(sim._pc))
+        if sim._steps > self._budget:
+            raise simulator.Idle("Instruction budget of {0} used up at ${1:04X}".format(self._budget, sim._pc))
+
+    # All three bitmaps as one number
+    def bits(self):
+        return int.from_bytes(bytes(self._executed + self._taken + self._nottaken), "little")
+
+# Run code until it first asks for input and return a snapshot taken there,
+# or None if it never does within budget instructions or stops at a BRK
+def prepare(code, budget):
+    sim = simulator.Simulator(code)
+    sim.setInteractive(False)
+    sim.attach(simulator.Budget(budget))
+    def ready():
+        raise Ready()
+    sim._input = ready
+    try:
+        sim.run(False)
+    except Ready:
+        sim._pc -= 1
+        sim._steps -= 1
+        return sim.snapshot()
+    return None
+
+################################
+# Worker processes
+
+_sim = None
+_snapshot = None
+_budget = 0
+
+def start(code, snapshot, budget):
+    global _sim, _snapshot, _budget
+    _sim = simulator.Simulator(code)
+    _snapshot = snapshot
+    _budget = budget
+    sys.stdout = open(os.devnull, "w")
+
+# Run one case. Returns (outcome, message, pc, coverage bits) where outcome
+# is "ok", "crash" or "hang".
+def case(data):
+    sim = _sim
+    feedback = Feedback(_budget + _snapshot[6])
+    stack = stackusage.StackMonitor(True)
+    sim._hooks = [feedback, stack]
+    replay.Stream(data).install(sim)
+    try:
+        sim.run(False, _snapshot)
+    except Exception as e:
+        return ("crash", "{0}: {1}".format(type(e).__name__, e), sim._pc, feedback.bits())
+    stopped = sim._stopped
+    if isinstance(stopped, simulator.Fault):
+        return ("crash", str(stopped), sim._pc, feedback.bits())
+    if isinstance(stopped, simulator.Idle):
+        return ("hang", str(stopped), sim._pc, feedback.bits())
+    return ("ok", None, sim._pc, feedback.bits())
+
+################################
+# Mutation
+
+def mutate(data, corpus, rand):
+    data = bytearray(data)
+    for i in range(1 << rand.randrange(4)):
+        choice = rand.randrange(8)
+        if not data or choice == 0:
+            data.insert(rand.randrange(len(data) + 1), rand.randrange(256))
+        elif choice == 1:
+            data[rand.randrange(len(data))] ^= 1 << rand.randrange(8)
+        elif choice == 2:
+            data[rand.randrange(len(data))] = rand.randrange(256)
+        elif choice == 3:
+            data[rand.randrange(len(data))] = rand.choice(INTERESTING)
+        elif choice == 4:
+            p = rand.randrange(len(data))
+            data[p] = (data[p] + rand.randrange(-16, 17)) & 0xFF
+        elif choice == 5 and len(data) > 1:
+            p = rand.randrange(len(data))
+            del data[p:p + rand.randrange(1, 9)]
+        elif choice == 6:
+            p = rand.randrange(len(data))
+            block = data[p:p + rand.randrange(1, 17)]
+            q = rand.randrange(len(data) + 1)
+            data[q:q] = block
+        else:
+            other = rand.choice(corpus)
+            p = rand.randrange(len(data) + 1)
+            data[p:] = other[rand.randrange(len(other) + 1):]
+    return bytes(data[0:4096])
+
+################################
+# Driver
+
+class Fuzzer:
+
+    _code = None
+    _outdir = None
+    _corpus = None
+    _seen = 0
+    _failures = None
+    _crashes = 0
+    _hangs = 0
+    _runs = 0
+
+    BATCH = 64
+
+    def __init__(self, code, outdir):
+        self._code = code
+        self._outdir = outdir
+        self._corpus = []
+        self._failures = set()
+        for name in ("queue", "crashes", "hangs"):
+            path = os.path.join(outdir, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        # Failures found by earlier sessions, from the address in the name
+        for outcome, name in (("crash", "crashes"), ("hang", "hangs")):
+            for filename in os.listdir(os.path.join(outdir, name)):
+                try:
+                    self._failures.add((outcome, int(filename.split("-")[-1], 16)))
+                except ValueError:
+                    pass
+
+    # Inputs already in the queue, or a single empty one
+    def seeds(self):
+        queue = os.path.join(self._outdir, "queue")
+        seeds = []
+        for name in sorted(os.listdir(queue)):
+            f = open(os.path.join(queue, name), "rb")
+            seeds.append(f.read())
+            f.close()
+        return seeds or [b""]
+
+    def save(self, kind, data, label):
+        path = os.path.join(self._outdir, kind, "{0:06d}-{1}".format(self._runs, label))
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+
+    # Fold in the result of running data. Inputs that find new coverage join
+    # the corpus and the first input for each failure is kept.
+    def result(self, data, outcome, message, pc, bits, seed=False):
+        self._runs += 1
+        if bits & ~self._seen:
+            self._seen |= bits
+            self._corpus.append(data)
+            if not seed:
+                self.save("queue", data, "cov")
+        if outcome != "ok":
+            key = (outcome, pc)
+            if key not in self._failures:
+                self._failures.add(key)
+                if outcome == "crash":
+                    self._crashes += 1
+                    self.save("crashes", data, "{0:04X}".format(pc))
+                else:
+                    self._hangs += 1
+                    self.save("hangs", data, "{0:04X}".format(pc))
+                print ("{0} at ${1:04X}: {2}".format(outcome.capitalize(), pc, message))
+
+    # Run about runs cases over jobs processes with budget instructions
+    # each. Returns the number of distinct crashes found.
+    def fuzz(self, runs, budget, jobs=None, seed=None):
+        try:
+            snapshot = prepare(self._code, budget)
+        except simulator.Fault as e:
+            print ("!" + str(e))
+            return 0
+        if snapshot == None:
+            print ("Error: The program never reads input")
+            return 0
+        try:
+            context = multiprocessing.get_context("fork")
+            pool = context.Pool(jobs, start, (self._code, snapshot, budget))
+            run = pool.map
+        except ValueError:
+            pool = None         # No fork (Windows), run in-process
+            stdout = sys.stdout
+            start(self._code, snapshot, budget)
+            sys.stdout = stdout
+            run = lambda function, cases: [function(data) for data in cases]
+        rand = random.Random(seed)
+        started = time.time()
+        seeds = self.seeds()
+        for data, result in zip(seeds, run(case, seeds)):
+            self.result(data, *result, seed=True)
+        reported = started
+        while self._runs < runs:
+            cases = [mutate(rand.choice(self._corpus), self._corpus, rand) for i in range(self.BATCH)]
+            for data, result in zip(cases, run(case, cases)):
+                self.result(data, *result)
+            if time.time() - reported >= 5:
+                reported = time.time()
+                self.status(started)
+        if pool != None:
+            pool.close()
+            pool.join()
+        self.status(started)
+        return self._crashes
+
+    def status(self, started):
+        elapsed = max(time.time() - started, 0.001)
+        print ("{0} runs, {1:.0f}/s, corpus {2}, crashes {3}, hangs {4}".format(self._runs, self._runs / elapsed,
+            len(self._corpus), self._crashes, self._hangs))
@@ -0,0 +1,195 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Memory access heatmap
+#
+# Counts the data reads and writes made to every address, including the
+# stack and the zero page pointers of indirect modes. Installing a Heatmap
+# in a simulator gives that instance a subclass with counting versions of
+# its memory access methods, so a simulator without one runs as before.
+# Instruction fetches aren't counted.
+#
+# Results come as a text map of the pages, a PGM image with one pixel per
+# address and a list of the busiest addresses named after the nearest
+# symbol.
+
+import math
+import array
+
+class Heatmap:
+
+    _reads = None
+    _writes = None
+
+    SHADES = " .:-=+*#%@"
+
+    def __init__(self):
+        self._reads = array.array('L', [0]) * 0x10000
+        self._writes = array.array('L', [0]) * 0x10000
+
+    # Install counting versions of the simulator's memory access methods
+    def install(self, sim):
+        reads = self._reads
+        writes = self._writes
+        mem = sim._mem
+        cls = type(sim)
+        methods = {"__slots__": ()}
+
+        def wrap(method, count):
+            def counted(self, *args):
+                count(*args)
+                return method(self, *args)
+            methods[method.__name__] = counted
+
+        def zpage(off, v=None):
+            return (mem[sim._pc] + off) & 0xFF
+        def absolute(off, v=None):
+            return (mem[sim._pc] + (0x100 * mem[sim._pc + 1]) + off) & 0xFFFF
+        def indexedIndirect(off):
+            p = mem[sim._pc]
+            reads[(p + off) & 0xFFFF] += 1
+            reads[(p + off + 1) & 0xFFFF] += 1
+            return (mem[p + off] + (0x100 * mem[p + off + 1])) & 0xFFFF
+        def indirectIndexed(off):
+            p = mem[sim._pc]
+            reads[p] += 1
+            reads[(p + 1) & 0xFFFF] += 1
+            return (mem[p] + (0x100 * mem[p + 1]) + off) & 0xFFFF
+
+        def readZPage(off):
+            reads[zpage(off)] += 1
+        def readAbs(off):
+            reads[absolute(off)] += 1
+        def readIndexedIndirect(off):
+            reads[indexedIndirect(off)] += 1
+        def readIndirectIndexed(off):
+            reads[indirectIndexed(off)] += 1
+        def writeZPage(off, v):
+            writes[zpage(off)] += 1
+        def writeAbs(off, v):
+            writes[absolute(off)] += 1
+        def writeIndexedIndirect(off, v):
+            writes[indexedIndirect(off)] += 1
+        def writeIndirectIndexed(off, v):
+            writes[indirectIndexed(off)] += 1
+        def push8(v):
+            writes[(0x100 + sim._S) & 0xFFFF] += 1
+        def push16(v):
+            writes[(0x100 + sim._S) & 0xFFFF] += 1
+            writes[(0xFF + sim._S) & 0xFFFF] += 1
+        def pop8():
+            reads[(0x101 + sim._S) & 0xFFFF] += 1
+        def pop16():
+            reads[(0x102 + sim._S) & 0xFFFF] += 1
+            reads[(0x101 + sim._S) & 0xFFFF] += 1
+
+        wrap(cls.readMem8, readZPage)
+        wrap(cls.readMem16, readAbs)
+        wrap(cls.readMemIndexedIndirect, readIndexedIndirect)
+        wrap(cls.readMemIndirectIndexed, readIndirectIndexed)
+        wrap(cls.storeMem8, writeZPage)
+        wrap(cls.storeMem16, writeAbs)
+        wrap(cls.storeMemIndexedIndirect, writeIndexedIndirect)
+        wrap(cls.storeMemIndirectIndexed, writeIndirectIndexed)
+        wrap(cls.stackPush8, push8)
+        wrap(cls.stackPush16, push16)
+        wrap(cls.stackPop8, pop8)
+        wrap(cls.stackPop16, pop16)
+        sim.__class__ = type("Counted" + cls.__name__, (cls,), methods)
+        sim._accelerate = False
+
+    def reads(self, address):
+        return self._reads[address]
+
+    def writes(self, address):
+        return self._writes[address]
+
+    # Reads and writes for each 256 byte page
+    def pages(self):
+        result = []
+        for page in range(256):
+            start = page << 8
+            result.append((sum(self._reads[start:start + 256]), sum(self._writes[start:start + 256])))
+        return result
+
+    ################################
+    # Reports
+
+    # A character for count on a log scale up to highest
+    def shade(self, count, highest):
+        if count == 0:
+            return self.SHADES[0]
+        level = 1 + int((len(self.SHADES) - 2) * math.log(count) / math.log(highest)) if highest > 1 else len(self.SHADES) - 1
+        return self.SHADES[level]
+
+    # One row per 16 pages up to size, one character per page, then the
+    # busiest pages with their counts
+    def text(self, size=0x10000):
+        pages = self.pages()
+        totals = [r + w for r, w in pages]
+        highest = max(totals) or 1
+        lines = ["Page accesses ({0}):".format(self.SHADES.strip())]
+        for row in range(0, (size + 0xFFF) >> 12):
+            line = "".join(self.shade(totals[page], highest) for page in range(row * 16, row * 16 + 16))
+            lines.append("  ${0:02X}xx |{1}|".format(row * 16, line))
+        lines.append("")
+        lines.append("  Page      Reads     Writes")
+        for page in sorted(range(256), key=lambda p: -totals[p]):
+            if totals[page] == 0:
+                break
+            lines.append("  ${0:02X}xx {1:>10} {2:>10}".format(page, pages[page][0], pages[page][1]))
+        return lines
+
+    # Binary PGM, 256 pixels wide, one row per page up to size
+    def pgm(self, size=0x10000):
+        rows = (size + 0xFF) >> 8
+        totals = [self._reads[a] + self._writes[a] for a in range(rows * 256)]
+        highest = max(totals) or 1
+        scale = math.log(highest + 1)
+        pixels = bytearray(int(255 * math.log(t + 1) / scale) for t in totals)
+        return "P5\n256 {0}\n255\n".format(rows).encode() + bytes(pixels)
+
+    # The count busiest addresses as (address, reads, writes, name)
+    def hottest(self, count, symbols=None):
+        names = sorted((value, name) for name, value in (symbols or {}).items())
+        addresses = [a for a in range(0x10000) if self._reads[a] or self._writes[a]]
+        addresses.sort(key=lambda a: -(self._reads[a] + self._writes[a]))
+        result = []
+        for address in addresses[0:count]:
+            result.append((address, self._reads[address], self._writes[address], self.symbol(names, address)))
+        return result
+
+    # Name of address as the nearest symbol at or below it in the same page
+    def symbol(self, names, address):
+        best = None
+        for value, name in names:
+            if value > address:
+                break
+            if address - value < 0x100:
+                best = name if value == address else "{0}+{1}".format(name, address - value)
+        return best or ""
+
+    def hotlist(self, count, symbols=None):
+        lines = ["  Address      Reads     Writes  Symbol"]
+        for address, reads, writes, name in self.hottest(count, symbols):
+            lines.append("  ${0:04X}  {1:>10} {2:>10}  {3}".format(address, reads, writes, name))
+        return lines
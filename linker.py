@@ -0,0 +1,190 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Separate compilation and linking
+#
+# Each source is assembled on its own to a relocatable object (<file>.obj,
+# JSON) holding the code assembled at address 0, its exported symbols, the
+# symbols it imports and a relocation record for every operand that depends
+# on where the code ends up:
+#
+#     [offset, kind, symbol, addend]
+#
+# kind is 'W' for a 16 bit address, 'L' or 'H' for its low or high byte and
+# 'B' for a byte that must hold the whole value. symbol is "" for the start
+# of the module itself or an imported name.
+
+import json
+import hashlib
+import functools
+import multiprocessing
+import settings
+import assembler
+
+def objectName(filename):
+    return filename + ".obj"
+
+def digest(filename):
+    try:
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+    except (IOError, OSError):
+        return None
+    return hashlib.sha1(data).hexdigest()
+
+# Assemble one source file to an object. This runs in a worker process so
+# it only takes and returns plain data.
+def compileModule(filename, optimize=False, peephole=False):
+    asm = assembler.Assembler(filename, True, optimize, peephole)
+    asm.assemble()
+    if asm.errorcount() > 0:
+        return (filename, None)
+    obj = asm.object()
+    tools = [assembler.__file__]
+    if peephole:
+        import peephole as optimizer
+        tools += optimizer.sources()
+    obj["sources"] = [[name, digest(name)] for name in asm.sources() + tools]
+    obj["optimize"] = optimize
+    obj["peephole"] = peephole
+    return (filename, obj)
+
+# An object is up to date if none of the files it was built from, including
+# the assembler itself and the peephole optimizer if it was used, changed
+def upToDate(filename, optimize, peephole=False):
+    try:
+        f = open(objectName(filename), "r")
+        obj = json.load(f)
+        f.close()
+    except (IOError, OSError, ValueError):
+        return False
+    if obj.get("optimize", False) != optimize or obj.get("peephole", False) != peephole:
+        return False
+    for name, hash in obj.get("sources", []):
+        if digest(name) != hash:
+            return False
+    return True
+
+# Compile every out of date source, spread over a pool of processes, and
+# return the number that failed.
+def compileModules(filenames, optimize=False, peephole=False, jobs=None):
+    stale = [name for name in filenames if not upToDate(name, optimize, peephole)]
+    compile = functools.partial(compileModule, optimize=optimize, peephole=peephole)
+    if len(stale) > 1:
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            context = None          # No fork (Windows), compile in-process
+    else:
+        context = None
+    if context != None:
+        pool = context.Pool(jobs)
+        results = pool.map(compile, stale)
+        pool.close()
+        pool.join()
+    else:
+        results = [compile(name) for name in stale]
+
+    failed = 0
+    for filename, obj in results:
+        if obj == None:
+            failed += 1
+            continue
+        f = open(objectName(filename), "w")
+        json.dump(obj, f)
+        f.close()
+    return failed
+
+class Linker:
+
+    _objects = None
+    _symbols = None
+    _errors = 0
+
+    def __init__(self):
+        self._objects = []
+        self._symbols = {}
+
+    def errorcount(self):
+        return self._errors
+
+    def error(self, name, str):
+        print ("PY6502: {0} : error: {1}".format(name, str))
+        self._errors += 1
+
+    def load(self, filename):
+        try:
+            f = open(filename, "r")
+            obj = json.load(f)
+            f.close()
+        except (IOError, OSError, ValueError):
+            self.error(filename, "Could not read object file")
+            return
+        self.add(filename, obj)
+
+    def add(self, name, obj):
+        self._objects.append((name, obj))
+
+    # Place the objects one after the other from base, resolve the exported
+    # symbols and patch every relocation. Returns the code as a segment list.
+    def link(self, base=settings.BASE_PC):
+        placed = []
+        address = base
+        for name, obj in self._objects:
+            placed.append((name, obj, address))
+            for symbol, (value, relative) in obj["exports"].items():
+                if symbol in self._symbols:
+                    self.error(name, "Duplicate symbol: " + symbol)
+                self._symbols[symbol] = value + address if relative else value
+            address += len(obj["code"])
+        if address > 0x10000:
+            self.error(self._objects[-1][0], "Program too large")
+            return []
+
+        image = []
+        for name, obj, start in placed:
+            code = list(obj["code"])
+            for offset, kind, symbol, addend in obj["relocs"]:
+                if symbol == "":
+                    value = start + addend
+                elif symbol in self._symbols:
+                    value = self._symbols[symbol] + addend
+                else:
+                    self.error(name, "Undefined symbol: " + symbol)
+                    continue
+                if kind == 'W':
+                    code[offset] = value & 0xFF
+                    code[offset + 1] = (value >> 8) & 0xFF
+                elif kind == 'L':
+                    code[offset] = value & 0xFF
+                elif kind == 'B':
+                    if value > 0xFF:
+                        self.error(name, "Value out of range: " + (symbol or "module address"))
+                    code[offset] = value & 0xFF
+                else:
+                    code[offset] = (value >> 8) & 0xFF
+            image.extend(code)
+        return [[base, image]] if len(image) > 0 else []
+
+    def symbols(self):
+        return self._symbols
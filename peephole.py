@@ -0,0 +1,432 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Peephole optimizer
+#
+# Works on the statements the assembler emitted in one pass, each recorded
+# as (number, segment, address, bytes, labelled, data, target) where target
+# is the label a branch or jump names, if any. The result is a dictionary
+# from statement number to a replacement opcode, or DELETE, which the
+# assembler applies on its next pass, and a dictionary of notes for the
+# listing. Every rewrite only changes opcodes or drops whole instructions so
+# operands, labels and relocations stay valid.
+#
+# Register and flag liveness is worked out backwards over the whole
+# program, following branches and jumps to their targets. A conditional
+# branch reads only the flag it tests. Calls, returns, data and anything
+# else not understood are taken to read everything, as is the end of a
+# segment. Rewrites are made within basic blocks: a block ends at a
+# label, a branch, jump, call or return, .SYS, data or a change of segment.
+# The arithmetic rewrites assume binary mode and are not used in programs
+# that contain SED.
+#
+# Each straight line rewrite is checked on the simulator before it is used:
+# the original and the rewritten instructions are run from the same random
+# machine states and must agree on memory and on every register and flag
+# that is live afterwards.
+
+import array
+import random
+import settings
+import disassembler
+import simulator
+
+DELETE = -1
+
+# The files the optimized code depends on besides the assembler: this one
+# and the simulator and disassembler rewrites are checked with. Caches of
+# assembled code include them.
+def sources():
+    return [__file__, simulator.__file__, disassembler.__file__]
+
+ALL = frozenset("AXYCZNVD")
+
+# Registers and flags each instruction reads and writes. Writes only list
+# what is always written, so liveness errs on the safe side.
+EFFECTS = {
+    'ADC': ("ACD", "ACZNV"),
+    'AND': ("A", "AZN"),
+    'ASL': ("", "CZN"),
+    'BIT': ("A", "ZNV"),
+    'CLC': ("", "C"),
+    'CLD': ("", "D"),
+    'CLI': ("", ""),
+    'CLV': ("", "V"),
+    'CMP': ("A", "CZN"),
+    'CPX': ("X", "CZN"),
+    'CPY': ("Y", "CZN"),
+    'DEC': ("", "ZN"),
+    'DEX': ("X", "XZN"),
+    'DEY': ("Y", "YZN"),
+    'EOR': ("A", "AZN"),
+    'INC': ("", "ZN"),
+    'INX': ("X", "XZN"),
+    'INY': ("Y", "YZN"),
+    'LDA': ("", "AZN"),
+    'LDX': ("", "XZN"),
+    'LDY': ("", "YZN"),
+    'LSR': ("", "CZN"),
+    'NOP': ("", ""),
+    'ORA': ("A", "AZN"),
+    'PHA': ("A", ""),
+    'PHP': ("CZNVD", ""),
+    'PHX': ("X", ""),
+    'PHY': ("Y", ""),
+    'PLA': ("", "AZN"),
+    'PLP': ("", "CZNVD"),
+    'PLX': ("", "X"),
+    'PLY': ("", "Y"),
+    'ROL': ("C", "CZN"),
+    'ROR': ("C", "CZN"),
+    'SBC': ("ACD", "ACZNV"),
+    'SEC': ("", "C"),
+    'SED': ("", "D"),
+    'SEI': ("", ""),
+    'STA': ("A", ""),
+    'STX': ("X", ""),
+    'STY': ("Y", ""),
+    'TAX': ("A", "XZN"),
+    'TAY': ("A", "YZN"),
+    'TSX': ("", "XZN"),
+    'TXA': ("X", "AZN"),
+    'TXS': ("X", ""),
+    'TYA': ("Y", "AZN")
+    }
+
+# Registers read and written by the built-in .SYS functions: #0 reads a
+# character into A and #1 writes the one in A
+SYSCALLS = { 0: ("", "A"), 1: ("A", "") }
+
+# Flag tested by each conditional branch
+BRANCHES = { 'BPL': "N", 'BMI': "N", 'BVC': "V", 'BVS': "V", 'BCC': "C", 'BCS': "C", 'BNE': "Z", 'BEQ': "Z" }
+
+# Index register read by each addressing mode
+INDEX = { 'ZPageX': "X", 'AbsX': "X", 'IndX': "X", 'ZPageY': "Y", 'AbsY': "Y", 'IndY': "Y" }
+
+# Load and store of the same register
+STORELOAD = { 'STA': 'LDA', 'STX': 'LDX', 'STY': 'LDY' }
+
+# Compare with zero after an instruction that already set N and Z from
+# the same register
+COMPARES = { 'CMP': "A", 'CPX': "X", 'CPY': "Y" }
+SETSNZ = { 'LDA': "A", 'TXA': "A", 'TYA': "A", 'PLA': "A", 'AND': "A", 'ORA': "A", 'EOR': "A",
+           'LDX': "X", 'TAX': "X", 'TSX': "X", 'INX': "X", 'DEX': "X",
+           'LDY': "Y", 'TAY': "Y", 'INY': "Y", 'DEY': "Y" }
+
+# LDA m / STA m opcodes to the INC m / DEC m opcode for the same mode
+MEMORYINC = { (0xA5, 0x85): (0xE6, 0xC6), (0xAD, 0x8D): (0xEE, 0xCE),
+              (0xB5, 0x95): (0xF6, 0xD6), (0xBD, 0x9D): (0xFE, 0xDE) }
+
+# Transfer opcodes to the increment and decrement of the register
+REGISTERINC = { (0x8A, 0xAA): (0xE8, 0xCA), (0x98, 0xA8): (0xC8, 0x88) }
+
+class Instruction:
+
+    def __init__(self, stmt):
+        self.num, self.segment, self.address, self.bytes, self.labelled, data, self.target = stmt
+        self.name = None
+        self.mode = None
+        op = self.bytes[0]
+        if not data and op in disassembler.Disassembler.opcodes:
+            name, mode = disassembler.Disassembler.opcodes[op]
+            if disassembler.Disassembler.sizes[mode] == len(self.bytes):
+                self.name = name
+                self.mode = mode
+        if self.name == '.SYS' and self.bytes[1] in SYSCALLS:
+            reads, writes = SYSCALLS[self.bytes[1]]
+            self.reads = frozenset(reads)
+            self.writes = frozenset(writes)
+            self.barrier = False
+        elif self.name in EFFECTS:
+            reads, writes = EFFECTS[self.name]
+            if self.mode == 'Imp' and self.name in ('ASL', 'LSR', 'ROL', 'ROR'):
+                reads += "A"
+                writes += "A"
+            self.reads = frozenset(reads + INDEX.get(self.mode, ""))
+            self.writes = frozenset(writes)
+            self.barrier = False
+        else:
+            self.reads = ALL
+            self.writes = frozenset()
+            self.barrier = True
+
+    def operand(self):
+        return self.bytes[1:]
+
+class Peephole:
+
+    TRIALS = 32
+
+    def __init__(self):
+        self._verified = {}
+        self._random = random.Random(6502)
+
+    def optimize(self, stmts, labels):
+        rewrites = {}
+        notes = {}
+        code = [Instruction(stmt) for stmt in stmts]
+        decimal = any(ins.name == 'SED' for ins in code)
+        after = self.liveness(code, labels)
+        for block in self.blocks(code):
+            live = [after[ins.num] for ins in block]
+            i = 0
+            while i < len(block):
+                n = self.match(block, live, i, decimal, rewrites, notes)
+                i += n if n > 0 else 1
+        self.tailcalls(code, rewrites, notes)
+        return rewrites, notes
+
+    ################################
+    # Analysis
+
+    def blocks(self, code):
+        blocks = []
+        block = []
+        for ins in code:
+            if block and (ins.labelled or ins.segment != block[-1].segment):
+                blocks.append(block)
+                block = []
+            if ins.barrier:
+                if block:
+                    blocks.append(block)
+                block = []
+                continue
+            block.append(ins)
+        if block:
+            blocks.append(block)
+        return blocks
+
+    # Where control can go after code[i]: indexes into code, with None for
+    # somewhere unknown. A named target is looked up in the labels of the
+    # same pass, since forward operands still hold the previous pass's
+    # addresses.
+    def successors(self, code, i, targets, labels):
+        ins = code[i]
+        following = [i + 1] if i + 1 < len(code) and code[i + 1].segment == ins.segment else [None]
+        if ins.target != None:
+            target = labels.get(ins.target)
+        elif ins.name in BRANCHES:
+            # Offsets are relative to the operand, as in the simulator
+            offset = ins.bytes[1] if ins.bytes[1] < 0x80 else ins.bytes[1] - 0x100
+            target = ins.address + 1 + offset
+        elif ins.name == 'JMP':
+            target = ins.bytes[1] + (ins.bytes[2] << 8)
+        else:
+            target = None
+        if ins.name in BRANCHES:
+            return following + [targets.get(target)]
+        if ins.name == 'JMP':
+            return [targets.get(target)]
+        return following
+
+    # The set of registers and flags live after each instruction, by
+    # statement number. Iterates backwards over the program until nothing
+    # changes.
+    def liveness(self, code, labels):
+        # A branch goes to the labelled statement at its target address, or
+        # to the first statement there
+        targets = {}
+        for i in range(len(code) - 1, -1, -1):
+            if code[i].labelled or code[i].address not in targets or not code[targets[code[i].address]].labelled:
+                targets[code[i].address] = i
+        succs = [self.successors(code, i, targets, labels) for i in range(len(code))]
+        before = [frozenset()] * len(code)
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(code) - 1, -1, -1):
+                ins = code[i]
+                if ins.name in BRANCHES:
+                    live = self.exit(succs[i], before) | frozenset(BRANCHES[ins.name])
+                elif ins.name == 'JMP':
+                    live = self.exit(succs[i], before)
+                elif ins.barrier:
+                    live = ALL
+                else:
+                    live = (self.exit(succs[i], before) - ins.writes) | ins.reads
+                if live != before[i]:
+                    before[i] = live
+                    changed = True
+        after = {}
+        for i in range(len(code)):
+            after[code[i].num] = self.exit(succs[i], before)
+        return after
+
+    # Registers and flags live on leaving an instruction for successors
+    def exit(self, successors, before):
+        live = frozenset()
+        for j in successors:
+            live = live | (ALL if j == None else before[j])
+        return live
+
+    ################################
+    # Rewrites. Each returns the number of instructions consumed, or 0.
+
+    def match(self, block, live, i, decimal, rewrites, notes):
+        a = block[i]
+        b = block[i + 1] if i + 1 < len(block) else None
+        if b == None:
+            return 0
+
+        # STA m / LDA m: the load only sets N and Z again
+        if STORELOAD.get(a.name) == b.name and a.mode == b.mode and a.operand() == b.operand() \
+                and a.mode in ('ZPage', 'ZPageX', 'ZPageY', 'Abs', 'AbsX', 'AbsY') \
+                and not (live[i + 1] & set("ZN")):
+            if self.verify([a, b], [a], live[i + 1]):
+                rewrites[b.num] = DELETE
+                notes[a.num] = "{0} {1} after {2} removed".format(b.name, self.describe(b), a.name)
+                return 2
+
+        # LDA x / CMP #0: the load already set N and Z
+        if b.name in COMPARES and b.mode == 'Imm' and b.bytes[1] == 0 \
+                and SETSNZ.get(a.name) == COMPARES[b.name] and "C" not in live[i + 1]:
+            if self.verify([a, b], [a], live[i + 1]):
+                rewrites[b.num] = DELETE
+                notes[a.num] = "{0} #0 after {1} removed".format(b.name, a.name)
+                return 2
+
+        if decimal or i + 3 >= len(block):
+            return 0
+        c = block[i + 2]
+        d = block[i + 3]
+
+        # LDA m / CLC / ADC #1 / STA m  ->  INC m   (and SEC / SBC #1 -> DEC m)
+        # TXA / CLC / ADC #1 / TAX      ->  INX     (and the Y and DEX/DEY forms)
+        if c.mode == 'Imm' and c.bytes[1] == 1 and a.operand() == d.operand():
+            step = None
+            if b.name == 'CLC' and c.name == 'ADC':
+                step = 0
+            elif b.name == 'SEC' and c.name == 'SBC':
+                step = 1
+            pair = (a.bytes[0], d.bytes[0])
+            table = MEMORYINC if pair in MEMORYINC else REGISTERINC
+            if step != None and pair in table and not (live[i + 3] & set("ACV")):
+                op = table[pair][step]
+                replaced = Instruction((a.num, a.segment, a.address, [op] + a.operand(), a.labelled, False, a.target))
+                if self.verify([a, b, c, d], [replaced], live[i + 3]):
+                    rewrites[a.num] = op
+                    rewrites[b.num] = DELETE
+                    rewrites[c.num] = DELETE
+                    rewrites[d.num] = DELETE
+                    notes[a.num] = "{0} / {1} / {2} #1 / {3} replaced by {4}".format(
+                        a.name, b.name, c.name, d.name, replaced.name + (" " + self.describe(a) if a.operand() else ""))
+                    return 4
+        return 0
+
+    # JSR x / RTS  ->  JMP x. The RTS is kept if something branches to it.
+    # Control flow is not run on the simulator; the rewrite holds for any
+    # routine that returns with RTS and doesn't inspect its return address.
+    def tailcalls(self, code, rewrites, notes):
+        for i in range(len(code) - 1):
+            a = code[i]
+            b = code[i + 1]
+            if a.name == 'JSR' and b.name == 'RTS' \
+                    and a.segment == b.segment and a.num not in rewrites:
+                rewrites[a.num] = 0x4C
+                if not b.labelled:
+                    rewrites[b.num] = DELETE
+                notes[a.num] = "JSR / RTS replaced by JMP"
+
+    def describe(self, ins):
+        value = ins.bytes[1] + (ins.bytes[2] << 8 if len(ins.bytes) > 2 else 0)
+        text = "${0:02X}".format(value) if len(ins.bytes) == 2 else "${0:04X}".format(value)
+        if ins.mode in INDEX:
+            text += "," + INDEX[ins.mode]
+        return text
+
+    ################################
+    # Verification on the simulator
+
+    ZEROPAGE = 0x80
+    ABSOLUTE = 0x800
+
+    def verify(self, original, replacement, live):
+        key = (tuple(tuple(ins.bytes) for ins in original),
+               tuple(tuple(ins.bytes) for ins in replacement), live)
+        if key not in self._verified:
+            self._verified[key] = self.check(original, replacement, live)
+        return self._verified[key]
+
+    # Move memory operands somewhere that exists in the simulated machine.
+    # The same address maps to the same place in both sequences.
+    def relocate(self, sequence, places):
+        code = []
+        for ins in sequence:
+            data = list(ins.bytes)
+            if len(data) > 1 and ins.mode != 'Imm':
+                key = tuple(data[1:])
+                if key not in places:
+                    if len(data) == 2:
+                        places[key] = [self.ZEROPAGE + len(places)]
+                    else:
+                        address = self.ABSOLUTE + 0x100 * len(places)
+                        places[key] = [address & 0xFF, address >> 8]
+                data[1:] = places[key]
+            code.extend(data)
+        return code
+
+    def check(self, original, replacement, live):
+        places = {}
+        before = self.relocate(original, places)
+        after = self.relocate(replacement, places)
+        scratch = self.ABSOLUTE + 0x100 * len(places)
+        if scratch > settings.MEMORY_SIZE:
+            return False
+        for trial in range(self.TRIALS):
+            state = self.randomstate(scratch)
+            first = self.run(before, state, scratch)
+            second = self.run(after, state, scratch)
+            if first[0] != second[0]:
+                return False
+            for reg in live:
+                if first[1][reg] != second[1][reg]:
+                    return False
+        return True
+
+    # Random registers and flags, in binary mode, and random contents for
+    # the zero page and the pages operands were moved to
+    def randomstate(self, scratch):
+        rnd = self._random
+        memory = bytearray(rnd.randrange(256) for i in range(0x100))
+        pages = bytearray(rnd.randrange(256) for i in range(scratch - self.ABSOLUTE))
+        regs = { 'A': rnd.randrange(256), 'X': rnd.randrange(256), 'Y': rnd.randrange(256),
+                 'C': rnd.randrange(2), 'Z': rnd.randrange(2), 'N': rnd.randrange(2),
+                 'V': rnd.randrange(2), 'D': 0 }
+        return memory, pages, regs
+
+    def run(self, code, state, scratch):
+        memory, pages, regs = state
+        sim = simulator.Simulator([[settings.BASE_PC, code]])
+        sim._mem[0:0x100] = array.array('B', memory)
+        sim._mem[self.ABSOLUTE:scratch] = array.array('B', pages)
+        sim._Acc = regs['A']
+        sim._X = regs['X']
+        sim._Y = regs['Y']
+        sim.setCFlag(regs['C'])
+        sim.setZFlag(regs['Z'])
+        sim.setNFlag(regs['N'])
+        sim.setOFlag(regs['V'])
+        sim.setDFlag(regs['D'])
+        sim.run(False)
+        result = { 'A': sim._Acc, 'X': sim._X, 'Y': sim._Y, 'C': sim.CFlag(), 'Z': sim.ZFlag(),
+                   'N': sim.NFlag(), 'V': sim.OFlag(), 'D': sim.DFlag() }
+        return sim._mem[0:0x100].tobytes() + sim._mem[self.ABSOLUTE:scratch].tobytes(), result
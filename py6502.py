@@ -23,11 +23,18 @@
 # Usage:
 #  python py6502.py -a <asmfile>
 #    assembles the 6502 assembler source file and outputs to <asmfile>.out. The output is basic
-#    JSON format for portability and is really only intended to be consumed by py6502.
+#    JSON format for portability and is really only intended to be consumed by py6502. It holds a
+#    list of [address, bytes] segments, one for each "* = address" or ".ORG address" in the source.
 #
 #  python py6502.py -d <outfile>
 #    disassembles the output file produced by the assembler step.
 #
+#  python py6502.py -d --flow [--entry ADDR ...] <outfile>
+#    disassembles by following the flow of control from the entry point (BASE_PC, or ADDR in hex)
+#    and the NMI, RESET and IRQ vectors if the code covers them. Bytes that are never reached are
+#    shown as data and every jump target gets a label, so the output can be assembled again. With
+#    --cache the analysis is kept as well.
+#
 #  python py6502.py -x <outfile>
 #    simulates the output file produces by the assembler step and dumps the contents of the registers
 #    and flags at the end.
@@ -37,6 +44,103 @@
 #    simulation and examine the register and flag states at each step. Enter 'h' at the prompt to see
 #    the list of commands available during tracing.
 #
+#  python py6502.py -a -x --cache [DIR] <asmfile>
+#    assembles and then executes the result directly without re-reading the output file. With --cache
+#    the assembled code is kept in DIR (default .py6502cache) keyed by a hash of the source and settings
+#    so unchanged sources are not assembled again.
+#
+#  python py6502.py -c <asmfile> [<asmfile> ...]
+#    assembles each source file on its own (in parallel) to a relocatable object <asmfile>.obj. Sources
+#    whose object is newer than every file they were built from are skipped. Symbols shared between
+#    modules are declared with .EXPORT name[, name...] and .IMPORT name[, name...].
+#
+#  python py6502.py --link [-o <outfile>] <file> [<file> ...]
+#    links objects (compiling any .asm files given first) one after the other from BASE_PC and writes
+#    the program to <outfile>, by default <file>.out for the first file.
+#
+#  python py6502.py -a -O <asmfile>
+#    optimizing assembly. The first pass is repeated until every label has settled so forward
+#    references to zero page get the short encoding, and a conditional branch that can't reach its
+#    target is replaced by the opposite branch over a JMP. -O works with -c and --link as well.
+#
+#  python py6502.py -a --peephole -l <asmfile>
+#    peephole optimization. Short instruction sequences are replaced by cheaper ones (LDA m / CLC /
+#    ADC #1 / STA m by INC m, JSR x / RTS by JMP x, a load straight after a store of the same register
+#    and so on) where the registers and flags they leave behind aren't used afterwards. Each rewrite is
+#    checked by running both versions in the simulator first. -l writes a listing to <asmfile>.lst
+#    that shows every rewrite made.
+#
+#  python py6502.py -x --trace-file FILE [--trace-range LOW-HIGH] [--trace-op MNEMONIC]
+#                   [--trace-inside ADDR] [--trace-first N | --trace-last N] <outfile>
+#    runs without stopping and writes a trace line (disassembly, registers and flags) for each
+#    instruction to FILE. The trace can be limited to address ranges and mnemonics (both may be
+#    repeated), to the instructions run inside the subroutine at ADDR and to the first or last N
+#    lines. Addresses are in hex. Without -t a BRK ends the run rather than waiting at the Step:
+#    prompt.
+#
+#  python py6502.py -a -x --coverage FILE [--lcov LCOVFILE] [--coverage-listing LSTFILE] <asmfile>
+#    records which instructions ran and which way each conditional branch went, and adds that to the
+#    coverage already in FILE, so the coverage of a series of runs builds up in one file. --lcov and
+#    --coverage-listing write the combined coverage by source line as an lcov tracefile and as the
+#    listing with each line marked + (run), - (never run) and T/N (branch taken/not taken). Both
+#    need -a so the lines are known.
+#
+#  python py6502.py -a -x --heatmap FILE [--hot N] <asmfile>
+#    counts the reads and writes made to each address (data, stack and indirect pointers, not
+#    instruction fetches). FILE gets a map of the pages, or a 256 pixel wide grey scale image with
+#    one pixel per address if it ends in .pgm. --hot lists the N busiest addresses, named after the
+#    nearest symbol when the source was assembled in the same run.
+#
+#  python py6502.py -a -x --stack [--stack-check] <asmfile>
+#    reports the most stack used, the deepest subroutine nesting and the calls that led there.
+#    --stack-check also stops the run, with the report, when the stack overflows or underflows.
+#
+#  python py6502.py -a -x --record FILE <asmfile>
+#  python py6502.py -a -x --replay FILE <asmfile>
+#    --record saves every character read by .SYS #0, with the number of the instruction that read
+#    it. --replay runs the program again with that input instead of the keyboard, stopping if it
+#    asks for input anywhere else.
+#
+#  python py6502.py -a -x --hle PYFILE [--hle-verify] <asmfile>
+#    runs Python functions in place of subroutines. PYFILE defines install(simulator, symbols),
+#    which registers each function with simulator.hle(address, function, flags); symbols are the
+#    assembler's when the source was assembled in the same run, which then skips the cache. A
+#    function reads and changes the registers and memory through getA/setA, getX/setX,
+#    getY/setY, peek/poke, peek16, memory and the flag methods, and the simulator returns from
+#    the subroutine for it. flags names the flags the function sets, such as "NZC", and defaults
+#    to none. For example:
+#
+#      def multiply(sim):
+#          sim.setA(sim.peek(0x40) * sim.peek(0x41))
+#
+#      def install(simulator, symbols):
+#          simulator.hle(symbols["MULT"], multiply)
+#
+#    --hle-verify also runs each subroutine as 6502 code and stops if the registers, memory or
+#    named flags differ.
+#
+#  python py6502.py -a --fuzz DIR [--fuzz-runs N] [--fuzz-budget N] [-j N] <asmfile>
+#    fuzzes the input the program reads with .SYS #0, guided by code coverage. Each case runs from
+#    a snapshot taken at the first read, for up to --fuzz-budget instructions, over -j processes.
+#    Inputs that reach new code or branches go to DIR/queue, which seeds the next session, and the
+#    first input for each distinct fault or hang goes to DIR/crashes or DIR/hangs. The run up to
+#    the first read has the same budget and ends at a BRK.
+#
+#  python py6502.py -x --input FILE <file>
+#    runs the program with the bytes of FILE as its input, for example a saved crash.
+#
+#  python py6502.py --watch [-O] [--peephole] [--input FILE] <asmfile>
+#    assembles and runs the program, then again each time the source, a file it includes or the input
+#    file changes, showing how the output and the final registers differ from the run before. Only the
+#    lines that changed are tokenized again and runs start from a snapshot taken after loading.
+#
+#  python py6502.py -a -l --cycles <asmfile>
+#    static timing. The reachable code is split into basic blocks and each is given its best and
+#    worst cycle count, allowing for taken branches and page crossings. Subroutines without loops get
+#    a worst case from entry to RTS and every loop gets a cost per iteration. The results are written
+#    to <file>.cycles.json and printed, and with -l the listing shows the cycles of each instruction.
+#    --cycles works on an output file too, and --entry adds entry points as for --flow.
+#
 #  python py6502.py -h
 #    displays the help page. The other command line options are documented here so I've not bothered
 #    to repeat them here.
@@ -54,6 +158,16 @@
 #    With this you should be able to adapt microchess or other programs to run in the simulator. I have
 #    not included this in the package for copyright purposes.
 #
+#    Larger programs can be split up with a few more directives:
+#        .INCLUDE "file"            ...  assembles file in place (relative to the including file)
+#        .MACRO name p1, p2 ... .ENDM  defines a macro; "name a, b" expands it with p1=a and p2=b
+#        .REPT count ... .ENDR      ...  repeats the enclosed lines count times
+#
+#    The assembler can also be used from Python without going through files:
+#        result = assembler.assemble(text)   ...  text is a string, a list of lines or an open file
+#    result.segments, result.bytes(), result.symbols and result.diagnostics hold the code, the
+#    symbol table and the errors found. result.bytes() raises ValueError if there were errors.
+#
 #    I developed and tested this on both a Mac OSX and Windows running python3 but I've tested the
 #    the same code with python2 and it should work fine with both.
 #
@@ -65,35 +179,135 @@ import os
 import sys
 import argparse
 import json
-import simulator
-import assembler
-import disassembler
+import settings
 
 ################################
 # Main program
 
 app_version = "1.01"
 
-parser = argparse.ArgumentParser(usage="%(prog)s option filename", description="6502 Assembler/Disassembler/Simulator")
+parser = argparse.ArgumentParser(usage="%(prog)s option filename [filename ...]", description="6502 Assembler/Disassembler/Simulator")
 parser.add_argument("-a", "--assemble", action="store_true", dest="assemble", default=False, help="assemble the code in FILE")
+parser.add_argument("-c", "--compile", action="store_true", dest="compile", default=False, help="assemble each FILE to a relocatable object")
+parser.add_argument("--coverage", dest="coverage", default=None, metavar="FILE", help="add the coverage of this run to FILE")
+parser.add_argument("--coverage-listing", dest="coveragelisting", default=None, metavar="FILE", help="write the listing marked with coverage to FILE")
+parser.add_argument("--cycles", action="store_true", dest="cycles", default=False, help="estimate cycle counts for the code in FILE")
 parser.add_argument("-d", "--disassemble", action="store_true", dest="disassemble", default=False, help="disassemble the code in FILE")
+parser.add_argument("--entry", action="append", dest="entries", default=None, metavar="ADDR", help="entry point in hex for --flow, may be repeated")
+parser.add_argument("--flow", action="store_true", dest="flow", default=False, help="disassemble by following the flow of control")
+parser.add_argument("--fuzz", dest="fuzz", default=None, metavar="DIR", help="fuzz the program's input, keeping results in DIR")
+parser.add_argument("--fuzz-runs", type=int, dest="fuzzruns", default=10000, metavar="N", help="number of fuzz cases to run")
+parser.add_argument("--fuzz-budget", type=int, dest="fuzzbudget", default=100000, metavar="N", help="instructions allowed for each fuzz case")
+parser.add_argument("--heatmap", dest="heatmap", default=None, metavar="FILE", help="write a map of memory accesses to FILE (.pgm for an image)")
+parser.add_argument("--hot", type=int, dest="hot", default=None, metavar="N", help="list the N most accessed addresses")
+parser.add_argument("--hle", dest="hle", default=None, metavar="PYFILE", help="run Python functions from PYFILE in place of subroutines")
+parser.add_argument("--hle-verify", action="store_true", dest="hleverify", default=False, help="check Python functions against the subroutines they replace")
+parser.add_argument("--input", dest="input", default=None, metavar="FILE", help="take the program's input from the bytes of FILE")
+parser.add_argument("-j", "--jobs", type=int, dest="jobs", default=None, metavar="N", help="processes to use for -c, --link and --fuzz")
+parser.add_argument("-l", "--listing", action="store_true", dest="listing", default=False, help="write an assembler listing to FILE.lst")
+parser.add_argument("--lcov", dest="lcov", default=None, metavar="FILE", help="write the coverage as an lcov tracefile to FILE")
+parser.add_argument("--link", action="store_true", dest="link", default=False, help="link the objects for each FILE into one program")
+parser.add_argument("-o", "--output", dest="output", default=None, metavar="OUTFILE", help="output file for --link")
+parser.add_argument("-O", "--optimize", action="store_true", dest="optimize", default=False, help="optimize instruction encoding and branches")
+parser.add_argument("--peephole", action="store_true", dest="peephole", default=False, help="peephole optimize the assembled code")
 parser.add_argument("-q", "--quiet", action="store_true", dest="quiet", default=False, help="quiet mode")
+parser.add_argument("--record", dest="record", default=None, metavar="FILE", help="record the program's input to FILE")
+parser.add_argument("--replay", dest="replay", default=None, metavar="FILE", help="take the program's input from a recording")
+parser.add_argument("--stack", action="store_true", dest="stack", default=False, help="report stack use and call depth")
+parser.add_argument("--stack-check", action="store_true", dest="stackcheck", default=False, help="stop on stack overflow or underflow")
 parser.add_argument("-t", "--trace", action="store_true", dest="trace", default=False, help="trace the code in FILE")
+parser.add_argument("--cache", nargs="?", dest="cache", default=None, const=settings.CACHE_DIR, metavar="DIR", help="reuse assembled code cached in DIR")
+parser.add_argument("--trace-file", dest="tracefile", default=None, metavar="FILE", help="write a trace of the run to FILE")
+parser.add_argument("--trace-range", action="append", dest="traceranges", default=None, metavar="LOW-HIGH", help="only trace addresses in this range (hex)")
+parser.add_argument("--trace-op", action="append", dest="traceops", default=None, metavar="MNEMONIC", help="only trace this instruction")
+parser.add_argument("--trace-inside", dest="traceinside", default=None, metavar="ADDR", help="only trace inside the subroutine at ADDR (hex)")
+parser.add_argument("--trace-first", type=int, dest="tracefirst", default=None, metavar="N", help="only trace the first N instructions")
+parser.add_argument("--trace-last", type=int, dest="tracelast", default=None, metavar="N", help="only trace the last N instructions")
 parser.add_argument("-x", "--execute", action="store_true", dest="execute", default=False, help="execute the code in FILE")
+parser.add_argument("--watch", action="store_true", dest="watch", default=False, help="assemble and run FILE again whenever it changes")
 parser.add_argument("-v", "--version", action="version", version="%(prog)s " + app_version)
-parser.add_argument("filename")
+parser.add_argument("filenames", nargs="+", metavar="filename")
 args = parser.parse_args()
 
-infile = args.filename
+infile = args.filenames[0]
+code = None
+lineinfo = None
+symbols = None
+
+# Entry points given in hex with --entry, or None for the default
+def entries(addresses):
+    if not addresses:
+        return None
+    try:
+        return [int(address.lstrip("$"), 16) for address in addresses]
+    except ValueError:
+        print ("Error: Invalid entry point")
+        sys.exit()
+
+if args.cache:
+    import cache
+    cache = cache.Cache(args.cache)
+
+if args.watch:
+    import watch
+    watch.Watcher(infile, args.optimize, args.peephole, args.input).watch()
+    sys.exit()
+
+if args.compile or args.link:
+    import linker
+    sources = [name for name in args.filenames if not name.endswith(".obj")]
+    if len(sources) > 0:
+        if not args.quiet:
+            print ("Compiling...")
+        if linker.compileModules(sources, args.optimize, args.peephole, args.jobs) > 0:
+            sys.exit()
+
+    if args.link:
+        if not args.quiet:
+            print ("Linking...")
+        objects = [name if name.endswith(".obj") else linker.objectName(name) for name in args.filenames]
+        linker = linker.Linker()
+        for name in objects:
+            linker.load(name)
+        code = linker.link()
+        if linker.errorcount() > 0:
+            sys.exit()
+
+        outfile = args.output if args.output != None else infile + ".out"
+        f = open(outfile, "w")
+        json.dump(code, f)
+        f.close()
+
+        infile = outfile
 
 if args.assemble:
     if not args.quiet:
         print ("Assembling...")
-    assembler = assembler.Assembler(infile)
-    code = assembler.assemble()
-    
-    if assembler.errorcount() > 0:
-        sys.exit()
+    options = ("O" if args.optimize else "") + ("P" if args.peephole else "")
+    needlines = args.listing or args.lcov or args.coveragelisting
+    needsymbols = args.hle or args.hot or args.stack or args.stackcheck
+    if args.cache and not needlines and not needsymbols:
+        code = cache.lookupAssembly(infile, options)
+    if code == None:
+        import assembler
+        assembler = assembler.Assembler(infile, optimize=args.optimize, peephole=args.peephole, listing=needlines)
+        code = assembler.assemble()
+        lineinfo = assembler.lineinfo()
+        symbols = assembler.symbols()
+
+        if args.listing:
+            cycles = None
+            if args.cycles and assembler.errorcount() == 0:
+                import analysis
+                cycles = analysis.Analysis(code, entries(args.entries)).cycles()
+            f = open(infile + ".lst", "w")
+            for line in assembler.listing(cycles):
+                f.write(line + "\n")
+            f.close()
+        if assembler.errorcount() > 0:
+            sys.exit()
+        if args.cache:
+            cache.storeAssembly(infile, code, assembler.sources(), options)
 
     outfile = infile + ".out"
     f = open(outfile, "w")
@@ -105,30 +319,149 @@ if args.assemble:
 if args.disassemble:
     if not args.quiet:
         print ("Disassembling...")
-    try:
-        f = open(infile, "r")
-        code = json.load(f)
-        f.close()
-    except:
-        print ("Error: Could not decode input file: " + infile)
-        sys.exit()
+    if code == None:
+        try:
+            f = open(infile, "r")
+            code = json.load(f)
+            f.close()
+        except:
+            print ("Error: Could not decode input file: " + infile)
+            sys.exit()
 
-    disassembler = disassembler.Disassembler()
-    disassembler.disassemble(code)
+    import disassembler
+    disassembler = disassembler.Disassembler(cache=cache if args.cache else None)
+    if args.flow:
+        for line in disassembler.source(code, entries(args.entries)):
+            print (line)
+    else:
+        disassembler.disassemble(code)
 
-if args.execute or args.trace:
-    try:
-        f = open(infile, "r")
-        code = json.load(f)
-        f.close()
-    except:
-        print ("Error: Could not decode input file: " + infile)
-        sys.exit()
+if args.cycles:
+    if code == None:
+        try:
+            f = open(infile, "r")
+            code = json.load(f)
+            f.close()
+        except:
+            print ("Error: Could not decode input file: " + infile)
+            sys.exit()
+
+    import analysis
+    analysis = analysis.Analysis(code, entries(args.entries))
+    f = open(os.path.splitext(infile)[0] + ".cycles.json", "w")
+    f.write(analysis.json())
+    f.close()
+    if not args.quiet:
+        for line in analysis.listing():
+            print (line)
+
+if (args.lcov or args.coveragelisting) and lineinfo == None:
+    print ("Error: Coverage reports need the source, use -a")
+    sys.exit()
+
+if args.execute or args.trace or args.tracefile or args.coverage or args.heatmap or args.hot or args.stack or args.stackcheck or args.replay or args.hle or args.input:
+    if code == None:
+        try:
+            f = open(infile, "r")
+            code = json.load(f)
+            f.close()
+        except:
+            print ("Error: Could not decode input file: " + infile)
+            sys.exit()
 
     if not args.quiet:
         print ("Executing...")
-    action = simulator.Simulator(code)
+    import simulator
+    try:
+        action = simulator.Simulator(code)
+    except simulator.Fault as e:
+        print ("!" + str(e))
+        sys.exit()
+    if args.record or args.replay:
+        import replay
+        if args.record:
+            recording = open(args.record, "wb")
+            replay.Recorder(recording).install(action)
+        else:
+            try:
+                f = open(args.replay, "rb")
+                replayer = replay.Replayer(f)
+                f.close()
+            except (IOError, ValueError):
+                print ("Error: Could not read input recording: " + args.replay)
+                sys.exit()
+            replayer.install(action)
+    if args.input:
+        import replay
+        try:
+            f = open(args.input, "rb")
+            replay.Stream(f.read()).install(action)
+            f.close()
+        except IOError:
+            print ("Error: Could not read input file: " + args.input)
+            sys.exit()
+    if args.hle:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location("hle", args.hle)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.install(action, symbols or {})
+        action.setHLEVerify(args.hleverify)
+    if args.tracefile:
+        import tracer
+        try:
+            ranges = [tracer.parseRange(r) for r in args.traceranges] if args.traceranges else None
+            inside = int(args.traceinside.lstrip("$"), 16) if args.traceinside else None
+        except ValueError:
+            print ("Error: Invalid trace address")
+            sys.exit()
+        tracefile = open(args.tracefile, "w")
+        action.attach(tracer.Trace(tracefile, ranges, args.traceops, inside, args.tracefirst, args.tracelast))
+        if not args.trace:
+            action.setInteractive(False)
+    if args.coverage:
+        import codecoverage
+        coverage = codecoverage.Coverage()
+        action.attach(coverage)
+    if args.heatmap or args.hot:
+        import heatmap
+        heatmap = heatmap.Heatmap()
+        heatmap.install(action)
+    if args.stack or args.stackcheck:
+        import stackusage
+        stack = stackusage.StackMonitor(args.stackcheck)
+        action.attach(stack)
     action.run(args.trace)
+    if args.record:
+        recording.close()
+    if args.replay and replayer.remaining():
+        print ("!Replay finished with {0} characters unread".format(replayer.remaining()))
+    if args.stack or args.stackcheck:
+        for line in stack.report(symbols):
+            print (line)
+    if args.heatmap:
+        if args.heatmap.lower().endswith(".pgm"):
+            f = open(args.heatmap, "wb")
+            f.write(heatmap.pgm(len(action.memory())))
+        else:
+            f = open(args.heatmap, "w")
+            f.write("\n".join(heatmap.text(len(action.memory()))) + "\n")
+        f.close()
+    if args.hot:
+        for line in heatmap.hotlist(args.hot, symbols):
+            print (line)
+    if args.tracefile:
+        tracefile.close()
+    if args.coverage:
+        if os.path.exists(args.coverage) and not coverage.load(args.coverage):
+            print ("Error: Not a coverage file: " + args.coverage)
+            sys.exit()
+        coverage.save(args.coverage)
+        for filename, report in ((args.lcov, coverage.lcov), (args.coveragelisting, coverage.listing)):
+            if filename:
+                f = open(filename, "w")
+                f.write("\n".join(report(lineinfo)) + "\n")
+                f.close()
 
     if not args.quiet:
         print ("Execution Completed")
@@ -140,3 +473,17 @@ if args.execute or args.trace:
         print (" SP = {0:02X}".format(action._S))
         print ("Flags:")
         print (" D{0} : C{1} : I{2} : N{3} : Z{4} : O{5}".format(action.DFlag(), action.CFlag(), action.IFlag(), action.NFlag(), action.ZFlag(), action.OFlag()))
+
+if args.fuzz:
+    if code == None:
+        try:
+            f = open(infile, "r")
+            code = json.load(f)
+            f.close()
+        except:
+            print ("Error: Could not decode input file: " + infile)
+            sys.exit()
+
+    import fuzzer
+    fuzzer = fuzzer.Fuzzer(code, args.fuzz)
+    fuzzer.fuzz(args.fuzzruns, args.fuzzbudget, args.jobs)
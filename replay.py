@@ -0,0 +1,103 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Record and replay of guest input
+#
+# A Recorder saves every character a program reads with .SYS #0 together
+# with the number of the instruction that read it. A Replayer feeds them
+# back from the file instead of the keyboard, so a run can be repeated
+# exactly and at full speed. If the program asks for input at any other
+# instruction the replay has diverged and the run stops. A Stream just feeds
+# the bytes of a file in order.
+
+import struct
+import simulator
+
+MAGIC = b"PY6502IN1\n"
+RECORD = struct.Struct("<QB")
+
+class Recorder:
+
+    _file = None
+
+    # f is a file opened for binary writing
+    def __init__(self, f):
+        self._file = f
+        f.write(MAGIC)
+
+    # Record the input the simulator reads
+    def install(self, sim):
+        read = sim._input
+        def recorded():
+            ch = read()
+            self._file.write(RECORD.pack(sim._steps, ord(ch)))
+            self._file.flush()
+            return ch
+        sim._input = recorded
+
+class Replayer:
+
+    _records = None
+    _next = 0
+
+    # f is a file opened for binary reading. Raises ValueError if it isn't
+    # a recording.
+    def __init__(self, f):
+        data = f.read()
+        if not data.startswith(MAGIC) or (len(data) - len(MAGIC)) % RECORD.size:
+            raise ValueError("not an input recording")
+        self._records = [r for r in RECORD.iter_unpack(data[len(MAGIC):])]
+
+    # Feed the simulator recorded input in place of the keyboard
+    def install(self, sim):
+        def replayed():
+            if self._next >= len(self._records):
+                raise simulator.Stop("Replay out of input at ${0:04X}, instruction {1}".format(sim._pc - 1, sim._steps))
+            step, value = self._records[self._next]
+            if step != sim._steps:
+                raise simulator.Stop("Replay diverged at ${0:04X}: input read at instruction {1}, recorded at {2}".format(
+                    sim._pc - 1, sim._steps, step))
+            self._next += 1
+            return chr(value)
+        sim._input = replayed
+
+    # Recorded characters the run never read
+    def remaining(self):
+        return len(self._records) - self._next
+
+# Feeds the bytes of a file, such as an input saved by the fuzzer, to the
+# program in order. The run stops when they run out.
+class Stream:
+
+    _data = None
+    _next = 0
+
+    def __init__(self, data):
+        self._data = data
+
+    def install(self, sim):
+        def streamed():
+            if self._next >= len(self._data):
+                raise simulator.Stop("Out of input at ${0:04X}".format(sim._pc - 1))
+            self._next += 1
+            return chr(self._data[self._next - 1])
+        sim._input = streamed
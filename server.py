@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# Assembler, disassembler and simulator server
+#
+#  python server.py [--socket PATH] [-j N] [--cache [DIR]]
+#    listens on a Unix socket for jobs and runs them on a pool of N processes that have already
+#    loaded everything, so a job doesn't pay for starting Python. client.py takes the same options
+#    as py6502.py and sends them here. --cache reuses assembler output as py6502.py --cache does.
+#
+#  Each request is one line of JSON and gets one line back, {"ok": true, ...} or {"ok": false,
+#  "error": message}. A connection can send any number of requests.
+#
+#    {"op": "assemble", "file": path, "optimize": false, "peephole": false, "listing": false}
+#    {"op": "assemble", "source": text, "name": name, ...}
+#      -> "code", "diagnostics" [[file, line, message], ...], "symbols", and "listing" if asked
+#    {"op": "disassemble", "code": code, "start": address, "end": address}
+#    {"op": "disassemble", "code": code, "flow": true, "entries": [address, ...]}
+#      -> "lines"
+#    {"op": "run", "code": code, "input": text, "budget": instructions}
+#      -> "output", "stopped" (why the run ended early, or null), "steps", "registers", "flags"
+#    {"op": "ping"} and {"op": "shutdown"}
+#
+#  Input for a run is given up front as a string of byte values (latin-1) and the run stops when
+#  it runs out. A BRK stops it too, as no one is at the Step: prompt. Code is in the format of
+#  the assembler's .out files.
+
+import io
+import os
+import sys
+import json
+import argparse
+import threading
+import socketserver
+import multiprocessing
+import settings
+
+################################
+# Jobs, run in the worker processes
+
+_cache = None
+_formatter = None
+
+def start(cachedir):
+    global _cache, _formatter
+    import assembler
+    import disassembler
+    import simulator
+    import replay
+    _formatter = disassembler.Formatter()
+    _formatter.opcodeTemplates()
+    if cachedir != None:
+        import cache
+        _cache = cache.Cache(cachedir)
+
+def job(request):
+    try:
+        op = request.get("op")
+        if op == "assemble":
+            return assemble(request)
+        if op == "disassemble":
+            return disassemble(request)
+        if op == "run":
+            return run(request)
+        if op == "ping":
+            return {"ok": True, "pid": os.getpid()}
+        return {"ok": False, "error": "Unknown op: {0}".format(op)}
+    except Exception as e:
+        return {"ok": False, "error": "{0}: {1}".format(type(e).__name__, e)}
+
+def assemble(request):
+    import assembler
+    options = ("O" if request.get("optimize") else "") + ("P" if request.get("peephole") else "")
+    filename = request.get("file")
+    listing = request.get("listing", False)
+    if filename != None and _cache != None and not listing:
+        code = _cache.lookupAssembly(filename, options)
+        if code != None:
+            return {"ok": True, "code": code, "diagnostics": [], "symbols": None}
+    asm = assembler.Assembler(filename or request.get("name", "<source>"), optimize=request.get("optimize", False),
+                              peephole=request.get("peephole", False), listing=listing,
+                              source=request.get("source") if filename == None else None)
+    asm._print = False
+    code = asm.assemble()
+    reply = {"ok": True, "code": code, "diagnostics": asm.diagnostics(), "symbols": asm.symbols()}
+    if listing:
+        reply["listing"] = asm.listing()
+    if filename != None and _cache != None and asm.errorcount() == 0:
+        _cache.storeAssembly(filename, code, asm.sources(), options)
+    return reply
+
+def disassemble(request):
+    import utilities
+    import disassembler
+    dis = disassembler.Disassembler(_formatter)
+    code = request["code"]
+    if request.get("flow"):
+        return {"ok": True, "lines": list(dis.source(code, request.get("entries")))}
+    start = request.get("start", 0)
+    end = request.get("end", 0xFFFF)
+    lines = []
+    for address, data in utilities.segments(code):
+        low = max(start, address)
+        high = min(end + 1, address + len(data))
+        if low < high:
+            lines.extend(_formatter.lines(bytearray(data[low - address:high - address]), low))
+    return {"ok": True, "lines": lines}
+
+def run(request):
+    import simulator
+    import replay
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        sim = simulator.Simulator(request["code"])
+        replay.Stream(request.get("input", "").encode("latin-1")).install(sim)
+        sim.setInteractive(False)
+        sim.attach(simulator.Budget(request.get("budget", settings.SERVER_BUDGET)))
+        sim.run(False)
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    flags = dict((name, 1 if sim._Flags & mask else 0) for name, mask in (("D", sim.DFLAG), ("C", sim.CFLAG),
+        ("I", sim.IFLAG), ("N", sim.NFLAG), ("Z", sim.ZFLAG), ("O", sim.OFLAG)))
+    return {"ok": True, "output": output, "stopped": str(sim._stopped) if sim._stopped != None else None,
+            "steps": sim._steps, "registers": {"A": sim._Acc, "X": sim._X, "Y": sim._Y, "S": sim._S},
+            "flags": flags}
+
+################################
+# Server
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                reply = {"ok": False, "error": "Bad request"}
+            elif request.get("op") == "shutdown":
+                self.reply({"ok": True})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            else:
+                reply = self.server.pool.apply(job, (request,))
+            self.reply(reply)
+
+    def reply(self, reply):
+        self.wfile.write((json.dumps(reply) + "\n").encode())
+        self.wfile.flush()
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+    pool = None
+
+def serve(path, jobs=None, cachedir=None):
+    if os.path.exists(path):
+        os.remove(path)
+    pool = multiprocessing.get_context("fork").Pool(jobs, start, (cachedir,))
+    server = Server(path, Handler)
+    server.pool = pool
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
+        if os.path.exists(path):
+            os.remove(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve py6502 jobs over a Unix socket")
+    parser.add_argument("--socket", dest="socket", default=settings.SERVER_SOCKET, metavar="PATH", help="socket to listen on")
+    parser.add_argument("-j", "--jobs", type=int, dest="jobs", default=None, metavar="N", help="worker processes")
+    parser.add_argument("--cache", nargs="?", dest="cache", default=None, const=settings.CACHE_DIR, metavar="DIR", help="reuse assembled code cached in DIR")
+    args = parser.parse_args()
+    serve(args.socket, args.jobs, args.cache)
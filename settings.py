@@ -24,3 +24,8 @@
 
 BASE_PC = 0x200                # Address at which programs are loaded and run
 MEMORY_SIZE = 0x1000           # Size of memory on target PC (4K default)
+CACHE_DIR = ".py6502cache"     # Default directory for cached assembler output
+SERVER_SOCKET = "/tmp/py6502.sock"   # Default Unix socket for server.py and client.py
+SERVER_BUDGET = 10000000       # Default instructions allowed for a run sent to the server
+WATCH_INTERVAL = 0.05          # Seconds between checks of the files in watch mode
+WATCH_BUDGET = 1000000         # Instructions allowed for each run in watch mode
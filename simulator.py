@@ -28,6 +28,53 @@ import utilities
 import array
 import settings
 
+# Raised by instrumentation to end a run early. The message says why.
+class Stop(Exception):
+    pass
+
+# Ends a run quietly, as when the program jumps to itself.
+class Halt(Stop):
+    pass
+
+# The program did something the machine can't: an address outside memory,
+# an unknown opcode or a stack overflow.
+class Fault(Stop):
+    pass
+
+# The program can't make any more progress.
+class Idle(Stop):
+    pass
+
+# A hook that stops a run once it has used up its budget of instructions
+class Budget:
+
+    _budget = 0
+
+    def __init__(self, budget):
+        self._budget = budget
+
+    def step(self, sim):
+        if sim._steps >= self._budget:
+            raise Idle("Instruction budget of {0} used up at ${1:04X}".format(self._budget, sim._pc))
+
+    def finish(self, sim):
+        pass
+
+# The machine a Simulator models: the size of its memory, up to 64K, the
+# address programs are loaded and started at, an entry point to start at
+# instead, and Python functions handling .SYS functions, by number, as well as or in
+# place of .SYS #0 and #1. Each is called with the simulator. Anything not
+# given comes from settings.
+class Machine:
+
+    __slots__ = ("memory", "load", "entry", "io")
+
+    def __init__(self, memory=None, load=None, entry=None, io=None):
+        self.memory = settings.MEMORY_SIZE if memory == None else memory
+        self.load = settings.BASE_PC if load == None else load
+        self.entry = entry
+        self.io = io
+
 class Simulator:
 
     # Bit masks for CPU flags
@@ -38,50 +85,405 @@ class Simulator:
     NFLAG = 16
     OFLAG = 32
 
-    # Processor registers and memory
-    _pc = 0
-    _Acc = 0
-    _X = 0
-    _Y = 0
-    _S = 0xFF
-    _Flags = 0
-
-    # Other flags
-    _endpos = 0
-    _trace = False
-    _breaks = {}
-
-    # Fixed size memory
-    assert settings.MEMORY_SIZE < 0x10000
-    _mem = array.array('B', [0] * settings.MEMORY_SIZE)
-
-    # Copy the code into memory at offset BASE_PC
-    def __init__(self, code):
-        index = settings.BASE_PC
-        for byt in code:
-            self._mem[index] = byt
-            index += 1
-        self._endpos = index
-
-    # Run the code from offset BASE_PC
-    def run(self, trace):
-        self._pc = settings.BASE_PC
+    # Flags by the letter a high level function names them with
+    FLAGNAMES = { 'N': NFLAG, 'V': OFLAG, 'D': DFLAG, 'I': IFLAG, 'Z': ZFLAG, 'C': CFLAG }
+
+    # Per-instance state. Instrumentation that replaces methods does it by
+    # giving the instance a subclass with __slots__ = ().
+    __slots__ = (
+        # Processor registers, memory and its size, and the handler for each
+        # .SYS function
+        "_pc", "_Acc", "_X", "_Y", "_S", "_Flags", "_mem", "_size", "_io",
+
+        # Other flags
+        "_entry", "_loaded", "_trace", "_breaks", "_interactive",
+
+        # Instructions run so far, and where .SYS #0 gets its input characters
+        "_steps", "_input",
+
+        # The Stop that ended the last run, if one did
+        "_stopped",
+
+        # Idle loops. _spins maps the address of each backward branch or jump
+        # seen to the number of instructions in its loop, or None if the loop
+        # might change memory. _spin is the branch, step count and registers
+        # the last time one was taken.
+        "_spins", "_spin",
+
+        # Python functions standing in for subroutines, by address
+        "_hle", "_hleVerify",
+
+        # Copy and fill loops recognised, by the address of their branch, and
+        # whether they may be run in one go. Instrumentation that needs to see
+        # every instruction turns _accelerate off.
+        "_idioms", "_accelerate",
+
+        # Instrumentation. Each hook's step(simulator) is called before every
+        # instruction, with _pc at the opcode, and finish(simulator) when the
+        # run ends. A hook can end the run by raising Stop, or drop out of it
+        # with detach.
+        "_hooks",
+    )
+
+    # Copy each code segment into memory at its address. Execution starts at
+    # the machine's entry point if it has one, otherwise at its load address
+    # if that was loaded, otherwise at the first segment, and stops when the
+    # PC leaves the loaded code. Raises Fault if the code doesn't fit.
+    def __init__(self, code, machine=None):
+        if machine == None:
+            machine = Machine()
+        assert machine.memory <= 0x10000
+        self._pc = 0
+        self._Acc = 0
+        self._X = 0
+        self._Y = 0
+        self._S = 0xFF
+        self._Flags = 0
+        self._size = machine.memory
+        self._mem = array.array('B', bytes(machine.memory))
+        self._io = self.IO
+        if machine.io:
+            self._io = dict(self.IO)
+            self._io.update(machine.io)
+        self._trace = False
+        self._breaks = {}
+        self._interactive = True
+        self._steps = 0
+        self._input = utilities.getch
+        self._stopped = None
+        self._spins = {}
+        self._spin = None
+        self._hle = {}
+        self._hleVerify = False
+        self._idioms = {}
+        self._accelerate = True
+        self._hooks = []
+        self._loaded = bytearray(machine.memory + 3)
+        self._entry = None
+        for address, data in utilities.segments(code, machine.load):
+            end = address + len(data)
+            if address < 0 or end > machine.memory:
+                raise Fault("Code segment ${0:04X}-${1:04X} outside memory".format(address, end - 1))
+            self._mem[address:end] = array.array('B', data)
+            self._loaded[address:end] = b"\x01" * len(data)
+            if self._entry == None or address <= machine.load < end:
+                self._entry = address
+        if machine.entry != None:
+            self._entry = machine.entry
+        elif self._entry == None:
+            self._entry = machine.load
+
+    def attach(self, hook):
+        self._hooks.append(hook)
+        self._accelerate = False
+
+    # Stop calling a hook, even from inside its own step. Its finish isn't
+    # called either.
+    def detach(self, hook):
+        self._hooks = [h for h in self._hooks if h is not hook]
+
+    # Put the registers as they are at power on, with the PC at the entry
+    # point
+    def reset(self):
+        self._pc = self._entry
+        self._Acc = self._X = self._Y = self._Flags = 0
+        self._S = 0xFF
+        self._steps = 0
+
+    # Run the code from the entry point, or on from a snapshot
+    def run(self, trace, state=None):
+        if state == None:
+            self._pc = self._entry
+            self._steps = 0
+        else:
+            self.restore(state)
         self._trace = trace
+        self._spin = None
+        self._stopped = None
         dis = disassembler.Disassembler()
-        while self._pc < self._endpos:
-            if self._trace or self._pc in self._breaks:
-                self._trace = True
-                dis.disassemble_line(self._mem, self._pc)
-                self.traceCPU()
-                if not self.traceStep(dis):
-                    return
+        hooks = self._hooks
+        try:
+            while self._loaded[self._pc]:
+                if hooks:
+                    for hook in hooks:
+                        hook.step(self)
+                    hooks = self._hooks
+                if self._trace or self._pc in self._breaks:
+                    self._trace = True
+                    dis.disassemble_line(self._mem, self._pc)
+                    self.traceCPU()
+                    if not self.traceStep(dis):
+                        break
+                opcode = self._mem[self._pc]
+                self._pc += 1
+                self._steps += 1
+                self.execute[opcode](self)
+        except Halt:
+            pass
+        except Stop as e:
+            self._stopped = e
+            print ("!" + str(e))
+        except IndexError:
+            # Only the code in memory is marked loaded, so the PC can run off
+            # the end of the marks, and an instruction at the top of memory
+            # can have its operand run off the end
+            if self._pc + 1 < self._size:
+                raise
+            if self._pc < len(self._loaded):
+                self._stopped = Fault("Operand past the end of memory at ${0:04X}".format(self._pc - 1))
+                print ("!" + str(self._stopped))
+        except KeyError:
+            if self._mem[self._pc - 1] in self.execute:
+                raise
+            self._pc -= 1
+            self._stopped = Fault("Unknown opcode ${0:02X} at ${1:04X}".format(self._mem[self._pc], self._pc))
+            print ("!" + str(self._stopped))
+        for hook in hooks:
+            hook.finish(self)
+
+    # The registers, memory and instruction count, to run from again later
+    def snapshot(self):
+        return (self._pc, self._Acc, self._X, self._Y, self._S, self._Flags, self._steps, self._mem[:])
+
+    def restore(self, state):
+        self._pc, self._Acc, self._X, self._Y, self._S, self._Flags, self._steps, mem = state
+        self._mem[:] = mem
+
+    ################################
+    # High level emulation
+    #
+    # A Python function can stand in for the subroutine at an address. When
+    # a JSR or JMP reaches the address the function is called with the
+    # simulator, which then returns from the subroutine itself as an RTS
+    # would. The function works through the methods below; they don't check
+    # addresses. In verify mode the subroutine is also run as 6502 code from
+    # the same state and the run stops if the results differ. Only the flags
+    # named in flags, such as "NZC", are compared: a function that leaves
+    # the others alone still matches a subroutine that changes them.
+
+    def hle(self, address, function, flags=""):
+        mask = 0
+        for flag in flags:
+            mask |= self.FLAGNAMES[flag]
+        self._hle[address] = (function, mask)
+
+    def setHLEVerify(self, verify):
+        self._hleVerify = verify
+
+    def getA(self):
+        return self._Acc
+
+    def setA(self, v):
+        self._Acc = v & 0xFF
+
+    def getX(self):
+        return self._X
+
+    def setX(self, v):
+        self._X = v & 0xFF
+
+    def getY(self):
+        return self._Y
+
+    def setY(self, v):
+        self._Y = v & 0xFF
+
+    def peek(self, address):
+        return self._mem[address]
+
+    def poke(self, address, v):
+        self._mem[address] = v & 0xFF
+
+    def peek16(self, address):
+        return self._mem[address] + (self._mem[address + 1] << 8)
+
+    # The memory array itself, for copying and filling with slices
+    def memory(self):
+        return self._mem
+
+    # Where the subroutine returns to, the address after the JSR. Routines
+    # that take their arguments from the bytes after the call move it on.
+    def returnAddress(self):
+        return self._mem[0x102 + self._S] + (0x100 * self._mem[0x101 + self._S])
+
+    def setReturnAddress(self, address):
+        self._mem[0x102 + self._S] = address & 0xFF
+        self._mem[0x101 + self._S] = (address >> 8) & 0xFF
+
+    # Run the function for the subroutine at target, entered with its
+    # return address on the stack
+    def highLevel(self, target):
+        function, mask = self._hle[target]
+        if not self._hleVerify:
+            function(self)
+            self._pc = self.stackPop16()
+            return
+        s = self._S
+        before = (self._Acc, self._X, self._Y, self._Flags, self._mem[:])
+        function(self)
+        self._pc = self.stackPop16()
+        python = (self._pc, self._S, self._Acc, self._X, self._Y, self._Flags & mask, self._mem[:])
+        self._Acc, self._X, self._Y, self._Flags, self._mem[:] = before
+        self._S = s
+        self._pc = target
+        # Run the 6502 code until it drops the return address
+        while self._S < s + 2:
+            if self._pc >= len(self._loaded) or not self._loaded[self._pc]:
+                raise Stop("HLE verify: ${0:04X} left the loaded code at ${1:04X}".format(target, self._pc))
             opcode = self._mem[self._pc]
             self._pc += 1
+            self._steps += 1
             self.execute[opcode](self)
+        guest = (self._pc, self._S, self._Acc, self._X, self._Y, self._Flags & mask, self._mem)
+        differences = []
+        for name, p, g in zip(("PC", "SP", "A", "X", "Y", "Flags"), python, guest):
+            if p != g:
+                differences.append("{0} {1:0{3}X}/{2:0{3}X}".format(name, p, g, 4 if name == "PC" else 2))
+        # Below the stack pointer on entry is scratch space
+        for address in range(len(guest[6]) if python[6] != guest[6] else 0):
+            if python[6][address] != guest[6][address] and not 0x100 <= address <= 0x100 + s:
+                differences.append("${0:04X} {1:02X}/{2:02X}".format(address, python[6][address], guest[6][address]))
+        if differences:
+            raise Stop("HLE mismatch for ${0:04X} (Python/6502): {1}".format(target, ", ".join(differences[0:8])))
+
+    ################################
+    # Idle loops
+    #
+    # A loop that is a straight run of instructions writing nothing, closed
+    # by a backward branch or jump, can't end once an iteration leaves the
+    # registers and flags as they were: nothing outside the program changes
+    # memory. The run stops there instead of spinning for ever, and a jump
+    # to itself is taken as the end of the program.
+
+    # Instructions that write memory, use the stack or transfer control
+    WRITES = set(("STA", "STX", "STY", "INC", "DEC", "PHA", "PHP", "PHX", "PHY", "PLA", "PLP", "PLX", "PLY", "JMP",
+                  "JSR", "RTS", "RTI", "BRK", ".SYS", ".BYTE"))
+    SHIFTS = set(("ASL", "LSR", "ROL", "ROR"))
+    SPIN_BYTES = 32
+
+    # Called before the branch or jump at pc goes back to target. Returns
+    # True if the rest of the loop was run and the branch should fall through.
+    def backEdge(self, pc, target):
+        if target == pc and self._mem[pc] == 0x4C:
+            raise Halt()
+        if pc not in self._spins:
+            self._spins[pc] = self.spinLength(target, pc)
+            self._idioms[pc] = self.idiom(target, pc)
+        length = self._spins[pc]
+        if length == None:
+            idiom = self._idioms[pc]
+            if idiom and self._accelerate and not self._trace and not self._breaks:
+                return self.runIdiom(target, pc, idiom)
+            return False
+        spin = (pc, self._steps, self._Acc, self._X, self._Y, self._S, self._Flags)
+        last = self._spin
+        self._spin = spin
+        if last != None and last[0] == pc and spin[1] - last[1] == length and spin[2:] == last[2:] \
+                and self.spinLength(target, pc) == length:
+            raise Idle("Idle loop at ${0:04X}".format(target))
+        return False
+
+    # Instructions in the loop from target to the branch at pc, or None if
+    # it isn't a short straight run that leaves memory alone
+    def spinLength(self, target, pc):
+        if pc - target > self.SPIN_BYTES:
+            return None
+        dis = disassembler.Disassembler
+        count = 1
+        while target < pc:
+            opcode = self._mem[target]
+            mnemonic = dis.mnemonics[opcode]
+            mode = dis.modes[opcode]
+            if mnemonic in self.WRITES or mnemonic in self.SHIFTS and mode != "Imp" or mode == "Branch":
+                return None
+            target += dis.lengths[opcode]
+            count += 1
+        return count if target == pc else None
+
+    ################################
+    # Copy and fill loops
+    #
+    # Loops of the shapes below, closed by BNE, are run in one go with a
+    # slice copy or fill the first time their branch is taken, leaving the
+    # registers, flags and instruction count as running them would. The
+    # index counts up to 0 with INX or INY, or down to 1 with DEX or DEY.
+    #
+    #   LDA (src),Y / STA (dst),Y / INY or DEY / BNE     copy
+    #   STA (dst),Y / INY or DEY / BNE                    fill
+    #   STA abs,X / INX or DEX / BNE                      fill
+    #   STA abs,Y / INY or DEY / BNE                      fill
+    #
+    # Anything the loop can't be sure of, addresses outside memory, writes
+    # over its own code or pointers, or an overlapping copy the wrong way,
+    # is left to run an instruction at a time.
+
+    STEPS = {0xC8: ("Y", 1), 0x88: ("Y", -1), 0xE8: ("X", 1), 0xCA: ("X", -1)}
+
+    # The idiom of the loop from target to the BNE at pc as (code, kind,
+    # source pointer, destination pointer or address, index register, step),
+    # or None
+    def idiom(self, target, pc):
+        code = self._mem[target:pc + 1].tobytes()
+        if code[-1:] != b"\xD0":
+            return None
+        if len(code) == 6 and code[0] == 0xB1 and code[2] == 0x91 and code[4] in (0xC8, 0x88):
+            return (code, "copy", code[1], code[3]) + self.STEPS[code[4]]
+        if len(code) == 4 and code[0] == 0x91 and code[2] in (0xC8, 0x88):
+            return (code, "fill", None, code[1]) + self.STEPS[code[2]]
+        if len(code) == 5 and code[0] == 0x9D and code[3] in (0xE8, 0xCA):
+            return (code, "abs", None, code[1] + (code[2] << 8)) + self.STEPS[code[3]]
+        if len(code) == 5 and code[0] == 0x99 and code[3] in (0xC8, 0x88):
+            return (code, "abs", None, code[1] + (code[2] << 8)) + self.STEPS[code[3]]
+        return None
+
+    # Run the remaining iterations of the loop from target to the BNE at pc.
+    # Returns False, having changed nothing, if it can't be done safely.
+    def runIdiom(self, target, pc, idiom):
+        code, kind, source, dest, register, step = idiom
+        mem = self._mem
+        # The code may have been changed since it was recognised
+        if mem[target:pc + 1].tobytes() != code:
+            return False
+        index = self._X if register == "X" else self._Y
+        low, high = (index, 0xFF) if step > 0 else (1, index)
+        count = high - low + 1
+        if kind == "abs":
+            dst = dest
+        else:
+            dst = mem[dest] + (mem[dest + 1] << 8)
+        if dst + high >= len(mem) or dst + low <= pc + 1 and target <= dst + high:
+            return False
+        if kind != "abs" and dst + low <= dest + 1 and dest <= dst + high:
+            return False
+        if kind == "copy":
+            src = mem[source] + (mem[source + 1] << 8)
+            if src + high >= len(mem) or dst + low <= source + 1 and source <= dst + high:
+                return False
+            # A byte at a time, copying up is only the same as a slice when
+            # the destination is below the source, and copying down above it
+            if dst != src and dst + low <= src + high and src + low <= dst + high and (dst > src) == (step > 0):
+                return False
+            self._Acc = mem[src + (high if step > 0 else low)]
+            mem[dst + low:dst + high + 1] = mem[src + low:src + high + 1]
+            self._steps += 4 * count
+        else:
+            mem[dst + low:dst + high + 1] = array.array('B', [self._Acc]) * count
+            self._steps += 3 * count
+        if register == "X":
+            self._X = 0
+        else:
+            self._Y = 0
+        self.setFlagsFromOp(0)
+        return True
 
     ################################
     # Trace - dump after each step
 
+    # Whether BRK starts stepping at the Step: prompt or ends the run. Runs
+    # with no one at the keyboard turn it off.
+    def setInteractive(self, interactive):
+        self._interactive = interactive
+
     def traceCPU(self):
         print ("PC:{0:04X} A:{1:02X} X:{2:02X} Y:{3:02X} SP:{4:04X} D{5} C{6} I{7} N{8} Z{9} O{10}".format(self._pc, self._Acc, self._X, self._Y, 0x100 + self._S, self.DFlag(), self.CFlag(), self.IFlag(), self.NFlag(), self.ZFlag(), self.OFlag()))
 
@@ -128,7 +530,7 @@ class Simulator:
                 continue
             if str == "r" or str == "restart":
                 print ("Restarting...")
-                self._pc = 0
+                self._pc = self._entry
                 return True
             if str == "c" or str == "continue":
                 self._trace = False
@@ -212,9 +614,8 @@ class Simulator:
     # Execution utilities
 
     def validateAddress(self, p):
-        if p < 0 or p >= settings.MEMORY_SIZE:
-            print ("!Address reference overflow: ${0:04X}".format(p))
-            sys.exit()
+        if p < 0 or p >= self._size:
+            raise Fault("Address reference overflow: ${0:04X}".format(p))
     
     def signExtend(self, r):
         return r if r < 0x80 else r - 0x100
@@ -256,7 +657,7 @@ class Simulator:
     def storeMemIndirectIndexed(self, off, v):
         p = self._mem[self._pc]
         self.validateAddress(p)
-        addr = self._mem[p, 0] + (0x100 * self._mem[p + 1])
+        addr = self._mem[p] + (0x100 * self._mem[p + 1])
         self.validateAddress(addr)
         self._mem[addr + off] = v
         
@@ -432,19 +833,19 @@ class Simulator:
         
     def exeBCC(self):
         if not self.CFlag():
-            self._pc += self.signExtend(self._mem[self._pc])
+            self.branchTaken()
         else:
             self._pc += 1
         
     def exeBCS(self):
         if self.CFlag():
-            self._pc += self.signExtend(self._mem[self._pc])
+            self.branchTaken()
         else:
             self._pc += 1
 
     def exeBEQ(self):
         if self.ZFlag():
-            self._pc += self.signExtend(self._mem[self._pc])
+            self.branchTaken()
         else:
             self._pc += 1
             
@@ -464,35 +865,44 @@ class Simulator:
 
     def exeBMI(self):
         if self.NFlag():
-            self._pc += self.signExtend(self._mem[self._pc])
+            self.branchTaken()
         else:
             self._pc += 1
 
     def exeBNE(self):
         if not self.ZFlag():
-            self._pc += self.signExtend(self._mem[self._pc])
+            self.branchTaken()
         else:
             self._pc += 1
 
     def exeBPL(self):
         if not self.NFlag():
-            self._pc += self.signExtend(self._mem[self._pc])
+            self.branchTaken()
         else:
             self._pc += 1
 
+    def branchTaken(self):
+        offset = self.signExtend(self._mem[self._pc])
+        if offset < 0 and self.backEdge(self._pc - 1, self._pc + offset):
+            self._pc += 1
+            return
+        self._pc += offset
+
     def exeBRK(self):
+        if not self._interactive:
+            raise Stop("BRK at ${0:04X}".format(self._pc - 1))
         print ("!BRK")
         self._trace = True
 
     def exeBVC(self):
         if not self.OFlag():
-            self._pc += self.signExtend(self._mem[self._pc])
+            self.branchTaken()
         else:
             self._pc += 1
 
     def exeBVS(self):
         if self.OFlag():
-            self._pc += self.signExtend(self._mem[self._pc])
+            self.branchTaken()
         else:
             self._pc += 1
 
@@ -712,11 +1122,18 @@ class Simulator:
         self.setFlagsFromOp(self._Y)
         
     def exeJMP(self):
-        self._pc = (self._mem[self._pc + 1] * 0x100) + self._mem[self._pc]
+        target = (self._mem[self._pc + 1] * 0x100) + self._mem[self._pc]
+        if target < self._pc:
+            self.backEdge(self._pc - 1, target)
+        self._pc = target
+        if self._hle and target in self._hle:
+            self.highLevel(target)
         
     def exeJSR(self):
         self.stackPush16(self._pc + 2)
         self._pc = (self._mem[self._pc + 1] * 0x100) + self._mem[self._pc]
+        if self._hle and self._pc in self._hle:
+            self.highLevel(self._pc)
 
     def exeLDAImm(self):
         self._Acc = self._mem[self._pc]
@@ -1107,12 +1524,18 @@ class Simulator:
         self._pc += 2
 
     def exeSYS(self):
-        code = self._mem[self._pc]
-        if code == 0:
-            self._Acc = ord(utilities.getch())
-        elif code == 1:
-            sys.stdout.write(chr(self._Acc))
+        handler = self._io.get(self._mem[self._pc])
+        if handler != None:
+            handler(self)
         self._pc += 1
+
+    # .SYS #0 waits for a character and returns it in the accumulator
+    def sysInput(self):
+        self._Acc = ord(self._input())
+
+    # .SYS #1 echoes the character in the accumulator to the console
+    def sysOutput(self):
+        sys.stdout.write(chr(self._Acc))
         
     def exeTAX(self):
         self._X = self._Acc
@@ -1297,3 +1720,9 @@ class Simulator:
         0xFE: exeINCAbsX,
         0xFF: exeSYS
         }
+
+    # Default .SYS functions
+    IO = {
+        0: sysInput,
+        1: sysOutput
+        }
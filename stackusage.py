@@ -0,0 +1,122 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Stack usage and call depth
+#
+# A simulator hook that records the lowest stack pointer reached, the
+# deepest JSR nesting and the chain of calls that led there. The stack is
+# checked before each instruction from the number of bytes its opcode pushes
+# or pops, so with check set an overflow or underflow ends the run before it
+# wraps out of page 1. An RTS with nothing on the stack ends the program
+# and doesn't count as an underflow.
+#
+# Calls are matched by JSR and RTS. Code that drops return addresses off the
+# stack by hand or calls through RTS tricks leaves the depth approximate,
+# though the stack pointer figures are exact.
+
+import simulator
+
+class StackMonitor:
+
+    _check = False
+    _lowest = 0xFF
+    _lowestAt = None
+    _calls = None
+    _deepest = None
+    _pushes = None
+    _pops = None
+
+    # Bytes pushed and popped by each opcode
+    PUSHES = {0x20: 2, 0x48: 1, 0x08: 1, 0xDA: 1, 0x5A: 1}
+    POPS = {0x60: 2, 0x40: 3, 0x68: 1, 0x28: 1, 0xFA: 1, 0x7A: 1}
+
+    def __init__(self, check=False):
+        self._check = check
+        self._calls = []
+        self._deepest = []
+        self._pushes = bytearray(256)
+        self._pops = bytearray(256)
+        for opcode, size in self.PUSHES.items():
+            self._pushes[opcode] = size
+        for opcode, size in self.POPS.items():
+            self._pops[opcode] = size
+
+    ################################
+    # Simulator hook
+
+    def step(self, sim):
+        pc = sim._pc
+        opcode = sim._mem[pc]
+        s = sim._S - self._pushes[opcode]
+        if s < self._lowest:
+            if s < -1 and self._check:
+                raise simulator.Fault("Stack overflow at ${0:04X}, SP ${1:04X}".format(pc, 0x100 + sim._S))
+            self._lowest = s
+            self._lowestAt = pc
+        if self._pops[opcode]:
+            # An RTS with the stack empty is how a program ends
+            if sim._S + self._pops[opcode] > 0xFF and self._check and not (opcode == 0x60 and sim._S == 0xFF):
+                raise simulator.Fault("Stack underflow at ${0:04X}, SP ${1:04X}".format(pc, 0x100 + sim._S))
+            if opcode == 0x60 and self._calls:
+                self._calls.pop()
+        elif opcode == 0x20:
+            self._calls.append((pc, sim._mem[pc + 1] + (sim._mem[pc + 2] << 8)))
+            if len(self._calls) > len(self._deepest):
+                self._deepest = list(self._calls)
+
+    def finish(self, sim):
+        pass
+
+    ################################
+    # Results
+
+    # Bytes of page 1 in use at the lowest point
+    def used(self):
+        return 0xFF - self._lowest
+
+    def depth(self):
+        return len(self._deepest)
+
+    # The (call site, subroutine) of each JSR at the deepest point
+    def path(self):
+        return list(self._deepest)
+
+    def report(self, symbols=None):
+        names = dict((value, name) for name, value in (symbols or {}).items())
+        lines = []
+        if self._lowestAt == None:
+            lines.append("Stack: unused")
+        else:
+            lines.append("Stack: {0} bytes used, lowest SP ${1:04X} at ${2:04X}".format(self.used(),
+                0x100 + self._lowest, self._lowestAt))
+        lines.append("Call depth: {0}".format(self.depth()))
+        # Runs of the same call, as in recursion, are shown once with a count
+        runs = []
+        for call in self._deepest:
+            if runs and runs[-1][0] == call:
+                runs[-1][1] += 1
+            else:
+                runs.append([call, 1])
+        for (site, target), count in runs:
+            repeat = " x{0}".format(count) if count > 1 else ""
+            lines.append("  ${0:04X}  JSR ${1:04X}{2}  {3}".format(site, target, repeat, names.get(target, "")))
+        return lines
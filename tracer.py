@@ -0,0 +1,151 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Non-interactive trace to a file
+#
+# A simulator hook that writes one line per executed instruction, the
+# disassembly followed by the registers and flags before it runs, in the
+# same layout as the interactive trace. Lines can be filtered by address
+# range, by mnemonic and to the instructions run inside a subroutine (from
+# its entry by a JSR to its RTS, including anything it calls), and limited
+# to the first or last N of those that pass. Once it has the first N the
+# trace detaches itself.
+
+import collections
+import disassembler
+import simulator
+
+class Trace:
+
+    _file = None
+    _ranges = None
+    _mnemonics = None
+    _inside = None
+    _first = None
+    _lines = None
+    _count = 0
+    _calls = None
+    _depth = 0
+    _templates = None
+    _flags = None
+
+    BUFFER = 8192
+
+    # ranges is a list of (low, high) inclusive address ranges, mnemonics a
+    # list of mnemonics, inside the address of a subroutine. first and last
+    # keep only the first or last N lines.
+    def __init__(self, f, ranges=None, mnemonics=None, inside=None, first=None, last=None):
+        self._file = f
+        self._ranges = ranges
+        self._mnemonics = set(m.upper() for m in mnemonics) if mnemonics else None
+        self._inside = inside
+        self._first = first
+        self._lines = collections.deque(maxlen=last) if last else []
+        self._calls = []
+        self._templates = disassembler.Formatter().opcodeTemplates()
+        self._flags = self.flagTable()
+
+    # "D0 C0 I0 N0 Z0 O0" for every value of the flags register
+    def flagTable(self):
+        sim = simulator.Simulator
+        table = []
+        for flags in range(256):
+            table.append("D{0} C{1} I{2} N{3} Z{4} O{5}".format(*[1 if flags & mask else 0 for mask in
+                (sim.DFLAG, sim.CFLAG, sim.IFLAG, sim.NFLAG, sim.ZFLAG, sim.OFLAG)]))
+        return table
+
+    def step(self, sim):
+        pc = sim._pc
+        opcode = sim._mem[pc]
+        if self._inside != None:
+            if opcode == 0x60 and self._calls:
+                # The RTS still belongs to the routine it returns from
+                active = self._depth > 0
+                if self._calls.pop() == self._inside:
+                    self._depth -= 1
+                if not active:
+                    return
+            elif opcode == 0x20:
+                target = sim._mem[pc + 1] + (sim._mem[pc + 2] << 8)
+                active = self._depth > 0
+                self._calls.append(target)
+                if target == self._inside:
+                    self._depth += 1
+                if not active:
+                    return
+            elif self._depth == 0:
+                return
+        if self._ranges != None:
+            for low, high in self._ranges:
+                if low <= pc <= high:
+                    break
+            else:
+                return
+        if self._mnemonics != None and disassembler.Disassembler.mnemonics[opcode] not in self._mnemonics:
+            return
+        self._count += 1
+        if self._first == None or self._count <= self._first:
+            self._lines.append(self.format(sim, pc, opcode))
+        if self._first != None and self._count >= self._first:
+            # Nothing more to write, so don't slow the rest of the run
+            self.finish(sim)
+            sim.detach(self)
+        elif isinstance(self._lines, list) and len(self._lines) >= self.BUFFER:
+            self.flush()
+
+    def format(self, sim, pc, opcode):
+        mem = sim._mem
+        size = disassembler.Disassembler.lengths[opcode]
+        if size == 1:
+            text = self._templates[opcode].format(pc)
+        elif pc + size > len(mem):
+            text = disassembler.Formatter().format(disassembler.Disassembler().decode(mem, pc))
+        elif size == 2:
+            operand = mem[pc + 1]
+            target = None
+            if disassembler.Disassembler.modes[opcode] == "Branch":
+                target = pc + 1 + (operand if operand < 0x80 else operand - 0x100)
+            text = self._templates[opcode].format(pc, operand, target, operand)
+        else:
+            operand = mem[pc + 1] + (mem[pc + 2] << 8)
+            text = self._templates[opcode].format(pc, operand, operand, mem[pc + 1], mem[pc + 2])
+        return "%-30s A:%02X X:%02X Y:%02X SP:%04X %s" % (text, sim._Acc, sim._X, sim._Y,
+            0x100 + sim._S, self._flags[sim._Flags & 0xFF])
+
+    def flush(self):
+        if self._lines:
+            self._file.write("\n".join(self._lines) + "\n")
+        if isinstance(self._lines, list):
+            self._lines = []
+        else:
+            self._lines.clear()
+
+    def finish(self, sim):
+        self.flush()
+        self._file.flush()
+
+# Parse "LOW-HIGH" or "ADDR" in hex
+def parseRange(text):
+    parts = text.split("-")
+    low = int(parts[0].lstrip("$"), 16)
+    high = int(parts[-1].lstrip("$"), 16)
+    return (low, high)
@@ -22,6 +22,16 @@
 ################################
 # Utilities
 
+import settings
+
+# Assembled code is a list of [address, bytes] segments. Output from older
+# versions of the assembler is a flat list of bytes loaded at base, or
+# BASE_PC.
+def segments(code, base=None):
+    if len(code) > 0 and isinstance(code[0], list):
+        return code
+    return [[settings.BASE_PC if base == None else base, code]]
+
 # Implements a mechanism for single key input that works on both Windows
 # and Unix (including Mac OSX).
 
@@ -0,0 +1,174 @@
+# Simple 6502 Microprocessor Simulator in Python
+#
+# Copyright 2012 Steve Palmer, steve@stevewpalmer.com
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+################################
+# Watch mode
+#
+# Polls the source file, everything it includes and the input file, and
+# each time one of them changes assembles the program again and runs it.
+# The assembler keeps the tokenized lines of every file it has read, so
+# only the lines that changed are tokenized again. A run starts from a
+# snapshot of the machine taken after the program was loaded, so when only
+# the input changes the program isn't loaded again either. After each run
+# the output and final registers are compared with the previous run's and
+# the differences shown. A run ends at a BRK, rather than waiting at the
+# Step: prompt, or when it has used up its budget of instructions.
+
+import io
+import os
+import sys
+import time
+import difflib
+import assembler
+import simulator
+import replay
+import settings
+
+class Watcher:
+
+    _filename = None
+    _optimize = False
+    _peephole = False
+    _inputfile = None
+    _budget = 0
+    _stamps = None
+    _sources = None
+    _sim = None
+    _reset = None
+    _input = b""
+    _result = None
+
+    REGISTERS = (("A", "_Acc"), ("X", "_X"), ("Y", "_Y"), ("SP", "_S"), ("Flags", "_Flags"))
+
+    def __init__(self, filename, optimize=False, peephole=False, inputfile=None, budget=settings.WATCH_BUDGET):
+        self._filename = filename
+        self._optimize = optimize
+        self._peephole = peephole
+        self._inputfile = inputfile
+        self._budget = budget
+        self._stamps = {}
+        self._sources = [filename]
+
+    # Poll until interrupted, rebuilding and rerunning on every change
+    def watch(self, interval=settings.WATCH_INTERVAL):
+        print ("Watching {0}, press Ctrl-C to stop".format(self._filename))
+        try:
+            while True:
+                self.update()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+    # The mtime and size of filename, or None if it can't be read
+    def stamp(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    # Check the files once. Returns True if the program was run again.
+    def update(self):
+        changed = [name for name in self._sources if self.stamp(name) != self._stamps.get(name)]
+        inputchanged = self._inputfile != None and self.stamp(self._inputfile) != self._stamps.get(self._inputfile)
+        if not changed and not inputchanged and self._stamps:
+            return False
+        start = time.time()
+        if inputchanged:
+            self._stamps[self._inputfile] = self.stamp(self._inputfile)
+            self._input = self.readinput()
+        if changed or self._sim == None:
+            if not self.build():
+                return False
+        self.report(self.run(), time.time() - start)
+        return True
+
+    def readinput(self):
+        try:
+            f = open(self._inputfile, "rb")
+            data = f.read()
+            f.close()
+        except IOError:
+            print ("Error: Could not read input file: " + self._inputfile)
+            return b""
+        return data
+
+    # Assemble the program and load it. Errors are reported by the assembler
+    # and leave the last good program loaded.
+    def build(self):
+        for name in self._sources:
+            self._stamps[name] = self.stamp(name)
+        asm = assembler.Assembler(self._filename, optimize=self._optimize, peephole=self._peephole)
+        try:
+            code = asm.assemble()
+        except IOError as e:
+            print ("Error: {0}".format(e))
+            return False
+        self._sources = asm.sources()
+        for name in self._sources:
+            self._stamps.setdefault(name, self.stamp(name))
+        if asm.errorcount() > 0:
+            return False
+        try:
+            sim = simulator.Simulator(code)
+        except simulator.Fault as e:
+            print ("!" + str(e))
+            return False
+        sim.reset()
+        sim.setInteractive(False)
+        sim.attach(simulator.Budget(self._budget))
+        self._sim = sim
+        self._reset = sim.snapshot()
+        return True
+
+    # Run from the snapshot with the output captured. Returns the output
+    # and the registers at the end.
+    def run(self):
+        sim = self._sim
+        replay.Stream(self._input).install(sim)
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            sim.run(False, self._reset)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return (output, [getattr(sim, attr) for name, attr in self.REGISTERS], sim._steps)
+
+    # Show the output and registers, or what changed in them since the last
+    # run
+    def report(self, result, elapsed):
+        output, registers, steps = result
+        print ("---- {0} instructions, {1:.0f} ms".format(steps, elapsed * 1000))
+        if self._result == None:
+            sys.stdout.write(output)
+            if output and not output.endswith("\n"):
+                print ("")
+            print ("  ".join("{0}={1:02X}".format(name, value) for (name, attr), value in zip(self.REGISTERS, registers)))
+        else:
+            before, previous, _ = self._result
+            diff = list(difflib.unified_diff(before.splitlines(), output.splitlines(), "previous", "current", lineterm=""))
+            for line in diff or ["Output unchanged"]:
+                print (line)
+            changes = ["{0}={1:02X}->{2:02X}".format(name, old, new) for (name, attr), old, new in
+                       zip(self.REGISTERS, previous, registers) if old != new]
+            print ("  ".join(changes) if changes else "Registers unchanged")
+        self._result = result